@@ -0,0 +1,112 @@
+import io
+import time
+
+import pandas as pd
+
+from mock_bdc_api import MOCK_STATES, MOCK_TECHNOLOGY_CODES, \
+    generate_availability_csv
+from utils import AVAILABILITY_DTYPES, GEOS, RELIABLE_TECHNOLOGY_CODES, \
+    augment_availability_data, decode_geoids, parent_geoids
+
+
+def augment_availability_data_per_row(file_df):
+    """Augments availability records as done before the augmentation was
+    vectorized (i.e., deriving GEOIDs with a Python call per record and the
+    service status with one masked assignment per status)."""
+    GEOS = ['state', 'county', 'tract', 'block_group']
+    GEOID_LENS = [2, 5, 11, 12]
+    for geo, geoid_len in zip(GEOS, GEOID_LENS):
+        file_df[f"{geo}_geoid"] = file_df['block_geoid'].apply(
+            lambda x: str(x)[:geoid_len] if x else x
+        )
+    unserved_index = \
+        (~file_df.technology.isin(RELIABLE_TECHNOLOGY_CODES)) | \
+        (file_df.business_residential_code.isin(['B'])) | \
+        (file_df.max_advertised_download_speed < 25) | \
+        (file_df.max_advertised_upload_speed < 3) | \
+        (file_df.low_latency == 0)
+    underserved_index = \
+        ~unserved_index & (
+            (file_df.max_advertised_download_speed < 100) |
+            (file_df.max_advertised_upload_speed < 20) |
+            (file_df.low_latency == 0)
+        )
+    served_index = ~unserved_index & ~underserved_index
+    file_df.loc[unserved_index, 'status'] = 2  # Unserved
+    file_df.loc[underserved_index, 'status'] = 1  # Underserved
+    file_df.loc[served_index, 'status'] = 0  # Served
+    return file_df
+
+
+def generate_availability_data(n_rows):
+    """Generates a dataframe of synthetic availability records across the
+    states and technologies of the mock BDC API."""
+    files_df = []
+    for i, state in enumerate(MOCK_STATES):
+        for j, technology_code in enumerate(MOCK_TECHNOLOGY_CODES):
+            csv_contents = generate_availability_csv(
+                state,
+                technology_code,
+                "2024-06-30",
+                n_rows=5000,
+                seed=i * len(MOCK_TECHNOLOGY_CODES) + j,
+            )
+            files_df.append(
+                pd.read_csv(io.StringIO(csv_contents),
+                            dtype=AVAILABILITY_DTYPES)
+            )
+    df = pd.concat(files_df, ignore_index=True)
+    n_copies = -(-n_rows // len(df))
+    return pd.concat([df] * n_copies, ignore_index=True).head(n_rows)
+
+
+def benchmark_augmentation(n_rows, repeats):
+    """Benchmarks the per-record and the vectorized availability augmentation
+    on synthetic records, reporting rows/s, after checking that both produce
+    the same GEOIDs (derived from the integer block GEOIDs for the vectorized
+    augmentation) and service statuses.
+
+    Args:
+        n_rows: Number of availability records to augment.
+
+        repeats: Number of times each implementation is timed (the fastest
+        time is reported).
+    """
+    df = generate_availability_data(n_rows)
+    augmenters = [
+        ("per-row", augment_availability_data_per_row),
+        ("vectorized", augment_availability_data),
+    ]
+    results = {}
+    print(f"{'augmentation':<14}{'rows':>10}{'seconds':>9}{'rows/s':>12}")
+    for name, augment in augmenters:
+        elapsed = float('inf')
+        for _ in range(repeats):
+            file_df = df.copy()
+            start = time.perf_counter()
+            file_df = augment(file_df)
+            elapsed = min(elapsed, time.perf_counter() - start)
+        results[name] = file_df
+        print(f"{name:<14}{len(file_df):>10}{elapsed:>9.2f}"
+              f"{len(file_df) / elapsed:>12,.0f}")
+    # Check that both implementations produce the same augmented data
+    expected = results["per-row"]
+    actual = results["vectorized"]
+    for geo in GEOS:
+        geoids = decode_geoids(parent_geoids(actual['block_geoid'], geo), geo)
+        assert expected[f"{geo}_geoid"].equals(geoids), \
+            f"The vectorized augmentation changed the {geo}_geoid column."
+    assert (expected['status'].to_numpy() == actual['status']).all(), \
+        "The vectorized augmentation changed the service statuses."
+
+
+if __name__ == "__main__":
+    # Number of synthetic availability records to augment
+    n_rows = 2_000_000
+    # Number of timed runs of each implementation
+    repeats = 3
+
+    benchmark_augmentation(
+        n_rows=n_rows,
+        repeats=repeats,
+    )
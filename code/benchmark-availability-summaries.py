@@ -0,0 +1,186 @@
+import io
+import time
+
+import pandas as pd
+
+from mock_bdc_api import MOCK_STATES, MOCK_TECHNOLOGY_CODES, \
+    generate_availability_csv
+from utils import AVAILABILITY_DTYPES, STATUS_CODES, TECHNOLOGY_CODES, \
+    add_geoids, augment_availability_data, decode_geoids, \
+    summarize_availability_data
+
+
+def summarize_availability_per_geoid(a_df, geos):
+    """Summarizes availability records per GEOID as done before the summaries
+    were vectorized (i.e., looping in Python over the GEOIDs of each level,
+    with nested groupings by technology, and merging the counters of the
+    records, the BSLs, and the <BSL, technology> pairs)."""
+    # Order records by service statuses
+    a_df = a_df.sort_values(by="status", ascending=True)
+    # Determine the service status of each BSL
+    bsl_df = a_df.drop(columns='technology').drop_duplicates(
+        subset='location_id', keep='first'
+    )
+    # Determine unique availability records for each pair of location_id and
+    # technology
+    unique_pairs_df = a_df.drop_duplicates(
+        subset=['location_id', 'technology'],
+        keep='first',
+    )
+    summaries = {}
+    for geo in geos:
+        group1_dl = []
+        for geoid, geoid_df in a_df.groupby(f"{geo}_geoid"):
+            geoid_dict = {'geoid': geoid}
+            geoid_dict['total_records'] = int(geoid_df.shape[0])
+            geoid_dict['total_bsls'] = geoid_df.location_id.nunique()
+            for sc, recs in geoid_df.status.value_counts().items():
+                geoid_dict[f"s{int(sc)}_records"] = recs
+            for tc, tc_df in geoid_df.groupby('technology'):
+                geoid_dict[f"t{tc}_records"] = tc_df.shape[0]
+                for sc, recs in tc_df.status.value_counts().items():
+                    geoid_dict[f"t{tc}_s{int(sc)}_records"] = recs
+            group1_dl.append(geoid_dict)
+        group2_dl = []
+        for geoid, geoid_df in bsl_df.groupby(f"{geo}_geoid"):
+            geoid_dict = {'geoid': geoid}
+            for sc, bsls in geoid_df.status.value_counts().items():
+                geoid_dict[f"s{int(sc)}_bsls"] = bsls
+            group2_dl.append(geoid_dict)
+        group3_dl = []
+        for geoid, geoid_df in unique_pairs_df.groupby(f"{geo}_geoid"):
+            geoid_dict = {'geoid': geoid}
+            for tc, tc_df in geoid_df.groupby('technology'):
+                geoid_dict[f"t{tc}_bsls"] = tc_df.shape[0]
+                for sc, bsls in tc_df.status.value_counts().items():
+                    geoid_dict[f"t{tc}_s{int(sc)}_bsls"] = bsls
+            group3_dl.append(geoid_dict)
+        summary_df = pd.merge(
+            left=pd.DataFrame().from_dict(group1_dl),
+            right=pd.DataFrame().from_dict(group2_dl),
+            on="geoid",
+            how="outer",
+        )
+        summary_df = pd.merge(
+            left=summary_df,
+            right=pd.DataFrame().from_dict(group3_dl),
+            on="geoid",
+            how="outer",
+        )
+        summary_cols = ['geoid', 'total_records', 'total_bsls']
+        for sc in STATUS_CODES:
+            for cnt in ['records', 'bsls']:
+                value_lbl = f"s{int(sc)}_{cnt}"
+                summary_cols.append(value_lbl)
+                if value_lbl not in summary_df.columns:
+                    summary_df[value_lbl] = 0
+        for tc in TECHNOLOGY_CODES:
+            for cnt in ['records', 'bsls']:
+                value_lbl = f"t{int(tc)}_{cnt}"
+                summary_cols.append(value_lbl)
+                if value_lbl not in summary_df.columns:
+                    summary_df[value_lbl] = 0
+        for tc in TECHNOLOGY_CODES:
+            for sc in STATUS_CODES:
+                for cnt in ['records', 'bsls']:
+                    value_lbl = f"t{tc}_s{int(sc)}_{cnt}"
+                    summary_cols.append(value_lbl)
+                    if value_lbl not in summary_df.columns:
+                        summary_df[value_lbl] = 0
+        summary_df['geoid'] = decode_geoids(summary_df['geoid'], geo)
+        summary_df = summary_df.sort_index(
+            axis='columns',
+            key=lambda x: pd.Index([summary_cols.index(y) for y in x])
+        )
+        summary_df = summary_df.fillna(0)
+        for col in summary_df.columns:
+            if col not in ['geoid']:
+                summary_df[col] = summary_df[col].astype(int)
+        summaries[geo] = summary_df
+    return summaries
+
+
+def summarize_availability(a_df, geos):
+    """Summarizes availability records per GEOID as done by
+    summarize-availability-per-geo.py (i.e., counting the records of every
+    Census Block with a few grouping operations and summing the block counts
+    up to the coarser levels, see utils.summarize_availability_data)."""
+    summaries = summarize_availability_data(a_df, geos)
+    for geo, summary_df in summaries.items():
+        summary_df['geoid'] = decode_geoids(summary_df['geoid'], geo)
+    return summaries
+
+
+def generate_availability_data(n_rows):
+    """Generates a dataframe of synthetic augmented availability records of a
+    state of the mock BDC API, with n_rows records per technology, and the
+    GEOIDs of their BSLs at every geographic level."""
+    files_df = []
+    for j, technology_code in enumerate(MOCK_TECHNOLOGY_CODES):
+        csv_contents = generate_availability_csv(
+            MOCK_STATES[0],
+            technology_code,
+            "2024-06-30",
+            n_rows=n_rows,
+            seed=j,
+        )
+        files_df.append(
+            pd.read_csv(io.StringIO(csv_contents), dtype=AVAILABILITY_DTYPES)
+        )
+    df = augment_availability_data(pd.concat(files_df, ignore_index=True))
+    df = add_geoids(df)
+    return df[
+        ['location_id', 'technology', 'status', 'block_geoid']
+        + [f"{geo}_geoid" for geo in ['state', 'county', 'tract',
+                                      'block_group']]
+    ]
+
+
+def benchmark_availability_summaries(n_rows, repeats):
+    """Benchmarks the per-GEOID and the vectorized availability summaries on
+    synthetic records of a state, reporting records/s, after checking that
+    both write byte-identical summary files at every geographic level.
+
+    Args:
+        n_rows: Number of availability records per technology.
+
+        repeats: Number of times each implementation is timed (the fastest
+        time is reported).
+    """
+    geos = ['state', 'county', 'tract', 'block_group', 'block']
+    df = generate_availability_data(n_rows)
+    summarizers = [
+        ("per-geoid", summarize_availability_per_geoid),
+        ("vectorized", summarize_availability),
+    ]
+    results = {}
+    print(f"{len(df)} availability records, {df['block_geoid'].nunique()}"
+          " blocks")
+    print(f"{'summaries':<12}{'seconds':>9}{'records/s':>12}")
+    for name, summarize in summarizers:
+        elapsed = float('inf')
+        for _ in range(repeats):
+            a_df = df.copy()
+            start = time.perf_counter()
+            summaries = summarize(a_df, geos)
+            elapsed = min(elapsed, time.perf_counter() - start)
+        results[name] = summaries
+        print(f"{name:<12}{elapsed:>9.2f}{len(df) / elapsed:>12,.0f}")
+    # Check that both implementations write the same summary files
+    for geo in geos:
+        expected = results["per-geoid"][geo].to_csv(index=False)
+        actual = results["vectorized"][geo].to_csv(index=False)
+        assert expected == actual, \
+            f"The vectorized summaries changed the {geo} summary file."
+
+
+if __name__ == "__main__":
+    # Number of synthetic availability records per technology
+    n_rows = 5_000
+    # Number of timed runs of each implementation
+    repeats = 3
+
+    benchmark_availability_summaries(
+        n_rows=n_rows,
+        repeats=repeats,
+    )
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from mock_bdc_api import MOCK_STATES, generate_challenge_csv, zip_csv
+from utils import COMPACT_CHALLENGE_DTYPES, RAW_CHALLENGE_DTYPES, \
+    apply_dtypes, determine_outcome_codes, encode_location_ids, \
+    latest_challenges, read_challenge_files
+
+
+def consolidate_challenges_per_file(file_paths):
+    """Consolidates challenge files as done before the consolidation was
+    rebuilt (i.e., concatenating each file to the records read so far,
+    sorting every record to remove duplicate challenges, and determining
+    outcome codes with one masked assignment per outcome)."""
+    challenges = pd.DataFrame()
+    for file_path in file_paths:
+        state_df = pd.read_csv(file_path, dtype=RAW_CHALLENGE_DTYPES)
+        challenges = pd.concat([challenges, state_df], ignore_index=True)
+    challenges['location_id'] = encode_location_ids(challenges['location_id'])
+    challenges = apply_dtypes(challenges, COMPACT_CHALLENGE_DTYPES)
+    challenges = challenges.sort_values(by='adjudication_date')
+    challenges = challenges.drop_duplicates(subset='challenge_id', keep='last')
+    upheld_oc = [
+        'Challenge Upheld - Provider Conceded',
+        'Challenge Upheld - Service Change',
+        'Challenge Upheld - Adjudicated by FCC',
+    ]
+    overturned_oc = ['Challenge Overturned']
+    withdrawn_oc = ['Challenge Withdrawn']
+    upheld_index = challenges['outcome'].isin(upheld_oc)
+    challenges.loc[upheld_index, 'outcome_code'] = 0  # Upheld
+    overturned_index = challenges['outcome'].isin(overturned_oc)
+    challenges.loc[overturned_index, 'outcome_code'] = 1  # Overtuned
+    withdrawn_index = challenges['outcome'].isin(withdrawn_oc)
+    challenges.loc[withdrawn_index, 'outcome_code'] = 2  # Withdrawn
+    challenges['outcome_code'] = challenges['outcome_code'].astype(np.int8)
+    return challenges
+
+
+def consolidate_challenges(file_paths, max_workers=1):
+    """Consolidates challenge files as done by process-bdc-challenge.py
+    (i.e., reading files in parallel, concatenating them at once, removing
+    duplicate challenges in linear time, and determining outcome codes with a
+    vectorized lookup)."""
+    challenges = read_challenge_files(file_paths, max_workers=max_workers)
+    challenges = latest_challenges(challenges)
+    challenges['outcome_code'] = determine_outcome_codes(challenges)
+    return challenges
+
+
+def generate_challenge_files(directory, n_as_of_dates, n_rows):
+    """Writes synthetic (zipped) resolved challenge files, one per state of
+    the mock BDC API and semiannual As of Date, to a directory.
+
+    Args:
+        directory: Directory to write the files to.
+
+        n_as_of_dates: Number of As of Dates (vintages).
+
+        n_rows: Number of challenge records per file.
+
+    Returns:
+        List with the paths of the files, by As of Date and state.
+    """
+    file_paths = []
+    for i in range(n_as_of_dates):
+        as_of_date = f"{2020 + i // 2}-{'06-30' if i % 2 == 0 else '12-31'}"
+        for j, state in enumerate(MOCK_STATES):
+            csv_contents = generate_challenge_csv(
+                state,
+                as_of_date,
+                n_rows=n_rows,
+                seed=i * len(MOCK_STATES) + j,
+            )
+            name = f"{as_of_date}_{state[0]}"
+            file_path = os.path.join(directory, f"{name}.zip")
+            with open(file_path, "wb") as f:
+                f.write(zip_csv(name, csv_contents))
+            file_paths.append(file_path)
+    return file_paths
+
+
+def benchmark_challenge_consolidation(n_as_of_dates, n_rows, max_workers,
+                                      repeats):
+    """Benchmarks the per-file and the linear-time challenge consolidation on
+    synthetic challenge files of many As of Dates, reporting records/s, after
+    checking that both keep the same challenges, adjudication dates, and
+    outcome codes.
+
+    Args:
+        n_as_of_dates: Number of As of Dates (vintages).
+
+        n_rows: Number of challenge records per file.
+
+        max_workers: Number of processes reading files concurrently in the
+        linear-time consolidation.
+
+        repeats: Number of times each implementation is timed (the fastest
+        time is reported).
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_paths = generate_challenge_files(directory, n_as_of_dates,
+                                              n_rows)
+        n_records = len(file_paths) * n_rows
+        consolidators = [
+            ("per-file", consolidate_challenges_per_file),
+            ("linear", lambda paths: consolidate_challenges(paths,
+                                                            max_workers)),
+        ]
+        results = {}
+        print(f"{len(file_paths)} files, {n_records} challenge records")
+        print(f"{'consolidation':<15}{'challenges':>11}{'seconds':>9}"
+              f"{'records/s':>12}")
+        for name, consolidate in consolidators:
+            elapsed = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                challenges = consolidate(file_paths)
+                elapsed = min(elapsed, time.perf_counter() - start)
+            results[name] = challenges.sort_values('challenge_id')
+            print(f"{name:<15}{len(challenges):>11}{elapsed:>9.2f}"
+                  f"{n_records / elapsed:>12,.0f}")
+    # Check that both implementations keep the same challenges
+    expected = results["per-file"]
+    actual = results["linear"]
+    for column in ['challenge_id', 'adjudication_date', 'outcome_code']:
+        assert (expected[column].to_numpy()
+                == actual[column].to_numpy()).all(), \
+            f"The linear-time consolidation changed the {column} column."
+
+
+if __name__ == "__main__":
+    # Number of synthetic As of Dates (vintages) and records per file
+    n_as_of_dates = 64
+    n_rows = 5_000
+    # Number of processes reading files in the linear-time consolidation
+    max_workers = os.cpu_count()
+    # Number of timed runs of each implementation
+    repeats = 3
+
+    benchmark_challenge_consolidation(
+        n_as_of_dates=n_as_of_dates,
+        n_rows=n_rows,
+        max_workers=max_workers,
+        repeats=repeats,
+    )
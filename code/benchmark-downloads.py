@@ -0,0 +1,109 @@
+import contextlib
+import importlib.util
+import io
+import os
+import tempfile
+import time
+
+from pathlib import Path
+
+from mock_bdc_api import start_mock_server
+
+
+def load_script(name):
+    """Loads one of the pipeline scripts (whose file names are not valid
+    module names) as a module."""
+    path = Path(__file__).parent / f"{name}.py"
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def directory_stats(directory):
+    """Counts the ZIP files and their total size (bytes) in a directory."""
+    n_files = 0
+    n_bytes = 0
+    for file_path in Path(directory).rglob("*.zip"):
+        n_files = n_files + 1
+        n_bytes = n_bytes + os.path.getsize(file_path)
+    return n_files, n_bytes
+
+
+def benchmark_downloads(workers, rows_per_file, latency, bandwidth,
+                        error_rate):
+    """Benchmarks the availability and challenge download code paths against
+    a local mock of the FCC Broadband Map API, reporting files/s and MB/s for
+    each number of concurrent workers.
+
+    Args:
+        workers: List with the numbers of concurrent workers to benchmark.
+
+        rows_per_file: Number of records in each synthetic availability file.
+
+        latency: Delay (seconds) added by the mock API to every request.
+
+        bandwidth: Maximum transfer rate (bytes/s) of each connection, or None
+        for no limit.
+
+        error_rate: Fraction of requests failed by the mock API.
+    """
+    availability = load_script("download-bdc-availability")
+    challenge = load_script("download-bdc-challenge")
+    downloaders = [
+        ("availability", availability.download_fixed_availability_data),
+        ("challenge", challenge.download_resolved_fixed_challenge_data),
+    ]
+    server = start_mock_server(
+        rows_per_file=rows_per_file,
+        latency=latency,
+        bandwidth=bandwidth,
+        error_rate=error_rate,
+    )
+    api_url = f"http://127.0.0.1:{server.server_port}"
+    # Generate every synthetic file upfront so it is not timed
+    for file_id in server.catalog['files']:
+        server.file_contents(file_id)
+    headers = {"username": "benchmark", "hash_value": "benchmark"}
+    print(f"{'data':<14}{'workers':>8}{'files':>8}{'MB':>9}{'seconds':>9}"
+          f"{'files/s':>9}{'MB/s':>8}{'requests':>10}")
+    try:
+        for data_type, download in downloaders:
+            for max_workers in workers:
+                with tempfile.TemporaryDirectory() as destination:
+                    requests_before = server.requests
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        download(
+                            headers=headers,
+                            destination=destination,
+                            max_workers=max_workers,
+                            api_url=api_url,
+                        )
+                    elapsed = time.perf_counter() - start
+                    n_files, n_bytes = directory_stats(destination)
+                n_requests = server.requests - requests_before
+                mb = n_bytes / 1024 / 1024
+                print(f"{data_type:<14}{max_workers:>8}{n_files:>8}"
+                      f"{mb:>9.1f}{elapsed:>9.2f}{n_files / elapsed:>9.1f}"
+                      f"{mb / elapsed:>8.2f}{n_requests:>10}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # Numbers of concurrent workers to benchmark
+    workers = [1, 4, 16]
+    # Synthetic data and network conditions of the mock API
+    rows_per_file = 2000
+    latency = 0.05
+    bandwidth = 2 * 1024 * 1024
+    error_rate = 0.0
+
+    benchmark_downloads(
+        workers=workers,
+        rows_per_file=rows_per_file,
+        latency=latency,
+        bandwidth=bandwidth,
+        error_rate=error_rate,
+    )
@@ -0,0 +1,103 @@
+import json
+
+from storage_utils import find_table, read_table
+from utils import AVAILABILITY_DTYPES, CHALLENGE_DTYPES, \
+    COMPACT_AVAILABILITY_DTYPES, COMPACT_CHALLENGE_DTYPES, apply_dtypes
+
+# Data type profiles compared (profile: (availability, challenge))
+DTYPE_PROFILES = {
+    "default": (AVAILABILITY_DTYPES, CHALLENGE_DTYPES),
+    "compact": (COMPACT_AVAILABILITY_DTYPES, COMPACT_CHALLENGE_DTYPES),
+}
+
+
+def load_dataframe(path, dtypes):
+    """Loads a table with the given data types (whatever the types it is
+    stored with)."""
+    return apply_dtypes(read_table(path, dtype=dtypes), dtypes)
+
+
+def memory_usage(df):
+    """Determines the memory (MiB) used by each column of a dataframe."""
+    return df.memory_usage(index=False, deep=True) / 1024 ** 2
+
+
+def benchmark_dtypes(availability_source, challenge_source, as_of_date,
+                     per_column):
+    """Reports the memory used by the processed availability and challenge
+    dataframes when loaded with the default and with the compact data types.
+
+    Args:
+        availability_source: Directory where the processed availability data
+        is stored.
+
+        challenge_source: Directory where the processed challenge data is
+        stored.
+
+        as_of_date: As of Date of the availability data to load.
+
+        per_column: Whether to also report the memory used by each column.
+    """
+    with open(f"{availability_source}/{as_of_date}/metadata.json") as f:
+        aod_md = json.load(f)
+    # Dataframes to load (label, path without extension, dataset index)
+    dataframes = [
+        (state_id, f"{availability_source}/{as_of_date}/{state_id}", 0)
+        for state_id in sorted(aod_md['states'])
+    ]
+    dataframes.extend(
+        (f"bsl/{state_id}", f"{availability_source}/{as_of_date}/bsl/"
+         f"{state_id}", 0)
+        for state_id in sorted(aod_md['states'])
+    )
+    dataframes.append(
+        ("cbsl", f"{availability_source}/{as_of_date}/cbsl", 0)
+    )
+    dataframes.append(
+        ("challenge", f"{challenge_source}/challenge", 1)
+    )
+    print(f"{'dataframe':<34}{'records':>10}{'default':>12}{'compact':>12}"
+          f"{'ratio':>8}")
+    totals = {profile: 0 for profile in DTYPE_PROFILES}
+    for label, path, dataset in dataframes:
+        if find_table(path) is None:
+            continue
+        usages = {}
+        for profile, dtypes in DTYPE_PROFILES.items():
+            df = load_dataframe(path, dtypes[dataset])
+            usages[profile] = memory_usage(df)
+            dtypes_used = df.dtypes
+            n_records = len(df)
+            df = None  # Help free up memory
+        default = usages["default"].sum()
+        compact = usages["compact"].sum()
+        totals["default"] = totals["default"] + default
+        totals["compact"] = totals["compact"] + compact
+        print(f"{label:<34}{n_records:>10}{default:>8.1f} MiB{compact:>8.1f}"
+              f" MiB{default / compact:>7.1f}x")
+        if per_column:
+            for column in usages["default"].index:
+                default = usages["default"][column]
+                compact = usages["compact"][column]
+                print(f"    {column:<30}{str(dtypes_used[column]):>10}"
+                      f"{default:>8.1f} MiB{compact:>8.1f} MiB"
+                      f"{default / max(compact, 1e-9):>7.1f}x")
+    print(f"{'total':<34}{'':>10}{totals['default']:>8.1f} MiB"
+          f"{totals['compact']:>8.1f} MiB"
+          f"{totals['default'] / max(totals['compact'], 1e-9):>7.1f}x")
+
+
+if __name__ == "__main__":
+    availability_source = "data/processed/bdc/availability/fixed/"
+    challenge_source = "data/processed/bdc/challenge/fixed_resolved/"
+    # As of Date of the availability data to report on
+    as_of_date = "2024-06-30"
+    # Report the memory used by each column as well
+    per_column = True
+
+    benchmark_dtypes(
+        availability_source=availability_source,
+        challenge_source=challenge_source,
+        as_of_date=as_of_date,
+        per_column=per_column,
+    )
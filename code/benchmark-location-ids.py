@@ -0,0 +1,128 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils import decode_location_ids, encode_location_ids
+
+
+def generate_bsl_data(n_bsls, records_per_bsl, n_challenged, seed):
+    """Generates synthetic availability records, BSL geolocations, and
+    challenged BSLs, identified by int64 location_ids.
+
+    Args:
+        n_bsls: Number of unique BSLs.
+
+        records_per_bsl: Average number of availability records per BSL.
+
+        n_challenged: Number of challenged BSLs.
+
+        seed: Seed of the random number generator.
+
+    Returns:
+        (availability, bsls, challenges) tuple of dataframes.
+    """
+    rng = np.random.default_rng(seed)
+    bsl_ids = 1000000000 + rng.choice(9 * 10 ** 8, n_bsls, replace=False)
+    availability = pd.DataFrame({
+        'location_id': rng.choice(bsl_ids, n_bsls * records_per_bsl),
+        'technology': rng.choice([10, 40, 50, 70], n_bsls * records_per_bsl),
+        'status': rng.integers(0, 3, n_bsls * records_per_bsl),
+    })
+    bsls = pd.DataFrame({
+        'location_id': bsl_ids,
+        'block_geoid': rng.integers(10 ** 14, 10 ** 15, n_bsls).astype(str),
+    })
+    challenges = pd.DataFrame({
+        'location_id': rng.choice(bsl_ids, n_challenged),
+        'outcome_code': rng.integers(0, 3, n_challenged),
+    })
+    return availability, bsls, challenges
+
+
+def decode_dataframe(df):
+    """Converts the location_ids of a dataframe into their published (string)
+    form."""
+    df = df.copy()
+    df['location_id'] = decode_location_ids(df['location_id'])
+    return df
+
+
+def benchmark_location_ids(n_bsls, records_per_bsl, n_challenged, repeats):
+    """Benchmarks the steps of the pipeline keyed by location_id (i.e., dedup,
+    merge, groupby and filtering) with location_ids held as strings and as
+    int64 integers, reporting the fastest time of each, and checks that the
+    encoding of location_ids round-trips losslessly.
+
+    Args:
+        n_bsls: Number of unique BSLs.
+
+        records_per_bsl: Average number of availability records per BSL.
+
+        n_challenged: Number of challenged BSLs.
+
+        repeats: Number of times each step is timed.
+    """
+    availability, bsls, challenges = generate_bsl_data(
+        n_bsls, records_per_bsl, n_challenged, seed=0
+    )
+    # Check the lossless round-trip between published and encoded forms
+    published = decode_location_ids(bsls['location_id'])
+    encoded = encode_location_ids(published)
+    assert encoded.equals(bsls['location_id']), \
+        "Encoding location_ids is not lossless."
+    # Steps keyed by location_id (as in the pipeline stages)
+    steps = [
+        ("dedup", lambda a, b, c: a.drop_duplicates(subset='location_id')),
+        ("merge", lambda a, b, c: pd.merge(c, b, how='left',
+                                           on='location_id')),
+        ("groupby", lambda a, b, c: a.groupby('location_id').size()),
+        ("isin", lambda a, b, c: a[a.location_id.isin(
+            c.location_id.unique())]),
+    ]
+    forms = {
+        "str": [decode_dataframe(df)
+                for df in [availability, bsls, challenges]],
+        "int64": [availability, bsls, challenges],
+    }
+    print(f"{len(availability)} availability records, {n_bsls} BSLs,"
+          f" {n_challenged} challenges")
+    print(f"{'step':<10}{'str (s)':>10}{'int64 (s)':>11}{'speedup':>9}")
+    for step, function in steps:
+        elapsed = {}
+        results = {}
+        for form, dfs in forms.items():
+            elapsed[form] = float('inf')
+            for _ in range(repeats):
+                start = time.perf_counter()
+                results[form] = function(*dfs)
+                elapsed[form] = min(elapsed[form],
+                                    time.perf_counter() - start)
+        assert len(results["str"]) == len(results["int64"]), \
+            f"The {step} step differs between location_id forms."
+        print(f"{step:<10}{elapsed['str']:>10.3f}{elapsed['int64']:>11.3f}"
+              f"{elapsed['str'] / elapsed['int64']:>8.1f}x")
+    # Memory used by the location_ids of the availability records
+    memory = {
+        form: dfs[0]['location_id'].memory_usage(index=False, deep=True)
+        for form, dfs in forms.items()
+    }
+    print(f"{'memory':<10}{memory['str'] / 1024 ** 2:>6.1f} MiB"
+          f"{memory['int64'] / 1024 ** 2:>7.1f} MiB"
+          f"{memory['str'] / memory['int64']:>8.1f}x")
+
+
+if __name__ == "__main__":
+    # Size of the synthetic data
+    n_bsls = 1_000_000
+    records_per_bsl = 5
+    n_challenged = 100_000
+    # Number of timed runs of each step
+    repeats = 3
+
+    benchmark_location_ids(
+        n_bsls=n_bsls,
+        records_per_bsl=records_per_bsl,
+        n_challenged=n_challenged,
+        repeats=repeats,
+    )
@@ -1,27 +1,218 @@
 import json
 import os
-
-from pathlib import Path
+import shutil
 
 import pandas as pd
 
-from utils import AVAILABILITY_DTYPES
+from storage_utils import TableWriter, check_storage_format, concat_tables, \
+    find_table, iter_table, read_table, table_path, write_table
+from utils import BSL_INDEX_DTYPES, COMPACT_AVAILABILITY_DTYPES, \
+    available_memory, bsl_index_path, bsl_table_path, run_in_process_pool, \
+    write_bsl_index
+
+# Columns of the BSL geolocation table
+BSL_GEOLOCATION_COLS = [
+    'location_id',
+    'block_geoid',
+    'as_of_date',
+    'last_seen_as_of_date',
+]
+# Data types of the BSL geolocation table (As of Dates are loaded as strings)
+BSL_GEOLOCATION_DTYPES = {
+    **COMPACT_AVAILABILITY_DTYPES,
+    'as_of_date': str,
+    'last_seen_as_of_date': str,
+}
+# Peak memory (bytes) needed to fold a BSL record of a bucket, including the
+# temporary copies made while folding
+BSL_RECORD_MEMORY = 256
+
+
+def fold_as_of_date(bsl_df, aod_df, as_of_date):
+    """Folds the BSLs of an As of Date into the BSL geolocation data of the
+    previous As of Dates, so that the most up-to-date location of each BSL
+    wins, whatever the state it is in.
+
+    Args:
+        bsl_df: Dataframe with the BSL geolocation data (see
+        BSL_GEOLOCATION_COLS) indexed by location_id. BSLs are known as of
+        'as_of_date' at their current block and were last seen as of
+        'last_seen_as_of_date' (categoricals including the As of Date).
+
+        aod_df: Dataframe with the location_id and block_geoid of the BSLs in
+        the As of Date, one record per BSL.
+
+        as_of_date: As of Date being folded, later than the ones in bsl_df.
+
+    Returns:
+        The updated BSL geolocation data indexed by location_id.
+    """
+    aod_df = aod_df.set_index('location_id')
+    # BSLs that are new or whose location changed are known as of the As of
+    # Date. Otherwise, they are known as of the same As of Date as before.
+    previous_df = bsl_df.reindex(aod_df.index)
+    moved = previous_df['block_geoid'] != aod_df['block_geoid']
+    aod_df['as_of_date'] = previous_df['as_of_date'].where(~moved, as_of_date)
+    aod_df['last_seen_as_of_date'] = pd.Series(
+        as_of_date,
+        index=aod_df.index,
+        dtype=bsl_df['last_seen_as_of_date'].dtype,
+    )
+    # Replace the records of the BSLs in the As of Date
+    bsl_df = pd.concat([bsl_df[~bsl_df.index.isin(aod_df.index)], aod_df])
+    return bsl_df
+
+
+def spill_records(chunks, spill_path, name, n_buckets, storage_format):
+    """Hash-partitions records by location_id (i.e., location_id modulo the
+    number of buckets) into a spill table per bucket, so that every record of
+    a BSL ends up in the same bucket. Records keep their relative order.
 
+    Args:
+        chunks: Iterable of dataframes with records (with a location_id
+        column).
+
+        spill_path: Directory of the spill tables, with a subdirectory per
+        bucket.
+
+        name: Name of the spill tables (e.g., the As of Date of the records).
+
+        n_buckets: Number of buckets.
+
+        storage_format: Storage format of the spill tables.
+
+    Returns:
+        List with the number of records spilled into each bucket.
+    """
+    writers = []
+    for bucket in range(n_buckets):
+        os.makedirs(f"{spill_path}/{bucket:04d}", exist_ok=True)
+        writers.append(TableWriter(f"{spill_path}/{bucket:04d}/{name}",
+                                   storage_format))
+    try:
+        for df in chunks:
+            buckets = df['location_id'].to_numpy() % n_buckets
+            for bucket, bucket_df in df.groupby(buckets, sort=False):
+                writers[bucket].write(bucket_df)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    for writer in writers:
+        writer.close()
+    return [writer.records for writer in writers]
+
+
+def resolve_bucket(bucket_path, new_as_of_dates, all_as_of_dates,
+                   storage_format):
+    """Determines the BSL geolocation of the BSLs of a bucket, folding the
+    records spilled for each new As of Date, in chronological order, into the
+    existing BSL geolocation records spilled (if any). The result is saved to
+    a 'bsl_geolocation' table in the bucket directory, sorted by location_id.
+
+    Args:
+        bucket_path: Directory of the spill tables of the bucket.
 
-def determine_bsl_geolocation_from_availability(source, destination):
+        new_as_of_dates: As of Dates to fold, in chronological order.
+
+        all_as_of_dates: Sorted list of the As of Dates in the existing and
+        new records.
+
+        storage_format: Storage format of the spill tables.
+
+    Returns:
+        The number of BSLs in the bucket.
+    """
+    aod_dtype = pd.CategoricalDtype(all_as_of_dates, ordered=True)
+    aod_dtypes = {
+        'as_of_date': aod_dtype,
+        'last_seen_as_of_date': aod_dtype,
+    }
+    if find_table(f"{bucket_path}/existing") is not None:
+        bsl_df = read_table(
+            f"{bucket_path}/existing",
+            dtype=BSL_GEOLOCATION_DTYPES,
+            columns=BSL_GEOLOCATION_COLS,
+        )
+    else:
+        bsl_df = pd.DataFrame(columns=BSL_GEOLOCATION_COLS).astype({
+            'location_id': 'int64',
+            'block_geoid': 'int64',
+        })
+    bsl_df = bsl_df.astype(aod_dtypes).set_index('location_id')
+    for as_of_date in new_as_of_dates:
+        if find_table(f"{bucket_path}/{as_of_date}") is None:
+            continue
+        aod_df = read_table(
+            f"{bucket_path}/{as_of_date}",
+            dtype=COMPACT_AVAILABILITY_DTYPES,
+        )
+        # A BSL may 'move' between (neighbooring) states, in which case the
+        # last state is kept
+        aod_df = aod_df.drop_duplicates(subset='location_id', keep='last')
+        # Keep only the most up-to-date location information
+        bsl_df = fold_as_of_date(bsl_df, aod_df, as_of_date)
+    bsl_df = bsl_df.sort_index().reset_index()
+    write_table(bsl_df[BSL_GEOLOCATION_COLS],
+                f"{bucket_path}/bsl_geolocation", storage_format)
+    return len(bsl_df)
+
+
+def determine_bsl_geolocation_from_availability(source, destination,
+                                                storage_format="csv",
+                                                incremental=False,
+                                                n_buckets=1,
+                                                max_workers=1,
+                                                memory_budget=None,
+                                                chunk_size=None):
     """Determines the geolocation (i.e., block_geoid) of each unique
     Broadband-Serviceable Location (BSL) in the availability data in the source
-    directory and saves this information to a file 'bsl_geolocation.csv' in the
-    destination directory.
+    directory and saves this information to a file 'bsl_geolocation.csv' (or
+    '.parquet') in the destination directory. The BSLs of each As of Date are
+    folded in chronological order, so the most up-to-date location of each
+    BSL wins, whatever the state. The file also stores the As of Date each BSL
+    was last seen as of.
+
+    BSLs are resolved out of core: records are first hash-partitioned by
+    location_id into spill files of a number of buckets, and each bucket is
+    then resolved independently (possibly in parallel), so the peak memory is
+    bounded by the size of the buckets rather than by the number of BSLs. The
+    resolved buckets are concatenated in order, each sorted by location_id.
+    The BSLs are also written to an index of memory-mappable arrays sorted by
+    location_id (see utils.bsl_index_path), so that BSLs can be looked up
+    without reading the whole file (see utils.lookup_bsl_index).
 
     Args:
         source: Directory where the availability data is stored.
 
         destination: Directory to save the BSL information.
+
+        storage_format: Storage format of the BSL information ('csv' or
+        'parquet').
+
+        incremental: Whether to update an existing BSL information file by
+        folding in only the As of Dates later than the last one it has seen.
+        Otherwise, nothing is done if the file already exists. As of Dates
+        earlier than the last one seen require building the file again. The
+        index is rebuilt whenever the file is updated (or if it is missing).
+
+        n_buckets: Number of buckets BSLs are partitioned into.
+
+        max_workers: Number of processes resolving buckets concurrently. If
+        1, buckets are resolved serially in the current process.
+
+        memory_budget: Maximum memory (bytes) to be used by the processes
+        concurrently, as estimated from the number of records of each bucket.
+        Defaults to the memory available when resolving starts.
+
+        chunk_size: Number of records read at a time while partitioning, or
+        None to read whole tables.
     """
-    # Check and abort in case file exists
-    destination_fn = f"{destination}/bsl_geolocation.csv"
-    if Path(destination_fn).is_file():
+    check_storage_format(storage_format)
+    # Check and abort in case file exists (and it is not to be updated)
+    destination_path = f"{destination}/bsl_geolocation"
+    index_path = bsl_index_path(destination_path)
+    if find_table(destination_path) is not None and not incremental:
         print("Consolidated file already exists. Nothing to do.")
         return
     # Determine As of Dates in the availability data
@@ -32,99 +223,146 @@ def determine_bsl_geolocation_from_availability(source, destination):
         print("Could not find the As of Dates metadata file.")
         return
     as_of_dates = sorted(aods_md['as_of_dates'])
-    # Create a dict that maps all available As of Dates for each State
-    states_aods = {}
-    # For each as of date
-    for as_of_date in as_of_dates:
-        # Determine the States with data available for the current As of Date
-        aod_path = f"{source}/{as_of_date}/"
-        try:
-            with open(f"{aod_path}/metadata.json") as f:
-                aod_md = json.load(f)
-        except FileNotFoundError:
-            print("Could not find the metadata file for as of date"
-                  f"{as_of_date}.")
-            return
-        aod_states = aod_md['states']
-        # Update the dict for each state to contina the current As of Date
-        for state_id in aod_states:
-            if state_id not in states_aods:
-                states_aods[state_id] = []
-            states_aods[state_id].append(as_of_date)
-    # Read the availability data for each technology, for each as of date, and
-    # for each state and determine the unique BSLs in the state
-    GEOS = ['state', 'county', 'tract', 'block_group', 'block']
-    BSL_COLS = ['location_id'] + [f"{geo}_geoid" for geo in GEOS]
-    # For each state
-    state_dfs = []
-    for state_id, state_aods in sorted(states_aods.items()):
-        print(f"State: {state_id}")
-        # For each as of date associated to the state
-        aod_dfs = []
-        for as_of_date in sorted(state_aods):
-            print(end=f"    As of Date: {as_of_date}", flush=True)
+    # Create destination directory
+    os.makedirs(destination, exist_ok=True)
+    spill_path = f"{destination}/bsl_geolocation.spill"
+    shutil.rmtree(spill_path, ignore_errors=True)
+    try:
+        # Partition the existing BSL information (if any), determining the
+        # As of Dates in it, and keep only the As of Dates later than the last
+        # one seen
+        bucket_records = [0] * n_buckets
+        seen_as_of_dates = set()
+        if find_table(destination_path) is not None:
+            print(end="Partitioning existing BSL information...", flush=True)
+
+            def existing_chunks():
+                for df in iter_table(destination_path,
+                                     dtype=BSL_GEOLOCATION_DTYPES,
+                                     columns=BSL_GEOLOCATION_COLS,
+                                     chunk_size=chunk_size):
+                    seen_as_of_dates.update(df['as_of_date'].unique())
+                    seen_as_of_dates.update(
+                        df['last_seen_as_of_date'].unique()
+                    )
+                    yield df
+
+            records = spill_records(existing_chunks(), spill_path, "existing",
+                                    n_buckets, storage_format)
+            bucket_records = [a + b for a, b in zip(bucket_records, records)]
+            last_seen = max(seen_as_of_dates, default="")
+            as_of_dates = [aod for aod in as_of_dates if aod > last_seen]
+            print(f"done (last As of Date seen: {last_seen})")
+            if not as_of_dates and os.path.isdir(index_path):
+                print("No new As of Dates. Nothing to do.")
+                return
+        # Read the BSL data for each as of date and for each state and
+        # partition it by location_id. GEOIDs at levels above the block are
+        # derived from block_geoid (see utils.add_geoids), so they are not
+        # stored.
+        BSL_COLS = ['location_id', 'block_geoid']
+        for as_of_date in as_of_dates:
+            print(f"As of Date: {as_of_date}")
+            # Determine the States with data available for the As of Date
             aod_path = f"{source}/{as_of_date}/"
-            state_fn = f"{aod_path}/{state_id}.csv"
-            # Load availability data for the pair <as_of_date, state>
-            aod_df = pd.read_csv(
-                state_fn,
-                dtype=AVAILABILITY_DTYPES,
-                usecols=BSL_COLS,
-            )
-            print(end=".", flush=True)
-            # > Each BSL location_id may appear multiple times for a state,
-            # each for a different provider and technology. Drop complete row
-            # duplicates.
-            aod_df = aod_df.drop_duplicates(subset=BSL_COLS)
-            print(end=".", flush=True)
-            # > Assert that each location_id only appears once after dropping
-            # complete row duplicates.
-            assert aod_df['location_id'].is_unique, \
-                   "Geospatial data is not consistent within a file."
-            print(end=".", flush=True)
-            # Add new column with As of Date information
-            aod_df['as_of_date'] = as_of_date
-            # Add to the list of as of date dataframes
-            aod_dfs.append(aod_df)
-            print("done", flush=True)
+            try:
+                with open(f"{aod_path}/metadata.json") as f:
+                    aod_md = json.load(f)
+            except FileNotFoundError:
+                print("Could not find the metadata file for as of date"
+                      f"{as_of_date}.")
+                return
+
+            def state_chunks():
+                # For each state (in order, so the last state of a BSL wins)
+                for state_id in sorted(aod_md['states']):
+                    print(end=f"    State: {state_id}", flush=True)
+                    # Load BSL data for the pair <as_of_date, state>
+                    chunks = iter_table(
+                        bsl_table_path(f"{aod_path}/{state_id}"),
+                        dtype=COMPACT_AVAILABILITY_DTYPES,
+                        columns=BSL_COLS,
+                        chunk_size=chunk_size,
+                    )
+                    for state_df in chunks:
+                        print(end=".", flush=True)
+                        yield state_df
+                    print("done", flush=True)
+
+            records = spill_records(state_chunks(), spill_path, as_of_date,
+                                    n_buckets, storage_format)
+            bucket_records = [a + b for a, b in zip(bucket_records, records)]
             # break
-        # Determine the unique BSLs across all as of dates for the state
-        print(end="    Determining unique BSLs across as of dates...",
+        # Resolve the BSLs of each bucket
+        print(f"Resolving BSLs in {n_buckets} buckets...", flush=True)
+        all_as_of_dates = sorted(seen_as_of_dates | set(as_of_dates))
+        tasks = [
+            (
+                (f"{spill_path}/{bucket:04d}", as_of_dates, all_as_of_dates,
+                 storage_format),
+                BSL_RECORD_MEMORY * n_records,
+            )
+            for bucket, n_records in enumerate(bucket_records)
+        ]
+        if max_workers == 1:
+            results = ((args, resolve_bucket(*args)) for args, _ in tasks)
+        else:
+            if memory_budget is None:
+                memory_budget = available_memory()
+            results = run_in_process_pool(
+                resolve_bucket,
+                tasks,
+                max_workers=max_workers,
+                memory_budget=memory_budget,
+            )
+        n_bsls = sum(n for _, n in results)
+        bucket_paths = [
+            table_path(f"{spill_path}/{bucket:04d}/bsl_geolocation",
+                       storage_format)
+            for bucket in range(n_buckets)
+        ]
+        # Write the index of the BSLs (sorted by location_id)
+        print(end="Writing BSL index...", flush=True)
+        write_bsl_index(
+            (
+                df
+                for path in bucket_paths
+                for df in iter_table(path,
+                                     dtype=BSL_GEOLOCATION_DTYPES,
+                                     columns=list(BSL_INDEX_DTYPES),
+                                     chunk_size=chunk_size)
+            ),
+            index_path,
+            n_bsls,
+        )
+        print("done")
+        # Write consolidate data to file (concatenating the buckets)
+        print(end=f"Writing consolidated data ({n_bsls} BSLs) to file...",
               flush=True)
-        state_df = pd.concat(aod_dfs, ignore_index=True)
-        aod_dfs = None  # Help free up memory
-        # Keep only the most up-to-date location information. Drop more recent
-        # location data that exactly matches older data (first occurence).
-        state_df = state_df.drop_duplicates(subset=BSL_COLS, keep='first')
-        # Drop older location data for a BSL that does not match the most
-        # up-to-date data (last occurence).
-        state_df = state_df.drop_duplicates(subset='location_id', keep='last')
-        # Add to the list of state dataframes
-        state_dfs.append(state_df)
-        print("done", flush=True)
-        # break
-    # Determine the unique BSLs across all states
-    print(end="Determining unique BSLs across states...", flush=True)
-    bsl_df = pd.concat(state_dfs, ignore_index=True)
-    # A BSL may 'move' between (neighbooring) states across As of Dates. We
-    # must keep only the most up-to-date location information, whatever the
-    # state.
-    # > Start by making sure the records are sorted increasing by As of Date
-    bsl_df = bsl_df.sort_values(by='as_of_date')
-    # > Drop location_id duplicates keeping the last record (latest As of Date)
-    bsl_df = bsl_df.drop_duplicates(subset='location_id', keep='last')
-    print("done", flush=True)
-    # Write consolidate data to file
-    print(end="Writing consolidated data to file...", flush=True)
-    # > Create destination directory
-    os.makedirs(destination, exist_ok=True)
-    bsl_df.to_csv(destination_fn, index=False)
-    print("done")
+        concat_tables(bucket_paths, destination_path, storage_format)
+        print("done")
+    finally:
+        shutil.rmtree(spill_path, ignore_errors=True)
 
 
 if __name__ == "__main__":
     source = "data/processed/bdc/availability/fixed/"
     destination = "data/processed/bdc/availability/fixed/"
+    # Storage format of the BSL information ('csv' or 'parquet')
+    storage_format = "csv"
+    # Update existing BSL information with new As of Dates only
+    incremental = True
+    # Number of buckets BSLs are partitioned into (bounding the memory used
+    # to resolve each bucket) and number of processes resolving them
+    n_buckets = 64
+    max_workers = os.cpu_count()
+    # Number of records read at a time while partitioning
+    chunk_size = 1024 * 1024
 
     determine_bsl_geolocation_from_availability(source=source,
-                                                destination=destination)
+                                                destination=destination,
+                                                storage_format=storage_format,
+                                                incremental=incremental,
+                                                n_buckets=n_buckets,
+                                                max_workers=max_workers,
+                                                chunk_size=chunk_size)
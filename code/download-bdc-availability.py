@@ -1,40 +1,211 @@
 import json
 import os
-import requests
+import queue
+import threading
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from credentials import BDC_USERNAME, BDC_HASH_VALUE
 
+from download_utils import BDC_API_URL, MAX_REQUEST_RATE, \
+    MAX_REQUEST_RETRIES, RequestScheduler, build_selection, create_session, \
+    download_file, is_selected, list_as_of_dates, list_files_per_as_of_date, \
+    load_sync_manifest, save_changed_partitions, save_sync_manifest, sync_file
+from storage_utils import check_storage_format, find_table, read_table
+from utils import RAW_AVAILABILITY_DTYPES, AvailabilityTableWriter, \
+    augment_availability_data, concat_availability_tables
 
-def download_fixed_availability_data(headers, destination):
+
+def consolidate_downloaded_files(file_queue, process_destination, keep_raw,
+                                 scheduler, api_url, pruned, failed_files,
+                                 storage_format, n_buckets=None):
+    """Consolidates and augments availability files as soon as they are
+    downloaded. Each file is augmented into temporary part files (of
+    availability offerings, BSLs, and providers), and the consolidated
+    <as_of_date, state> files are committed (i.e., the parts are concatenated
+    in the order of the state metadata) once all of the state's files have
+    been processed.
+    The consolidated files are identical to the ones created by
+    process-bdc-availability.py.
+
+    Args:
+        file_queue: Queue of (as_of_date, state_id, state_md, file_md,
+        file_path) items to process. A None item stops the consumer.
+
+        process_destination: Directory to save the consolidated and augmented
+        availability data.
+
+        keep_raw: Whether to keep the downloaded ZIP files of a state once its
+        consolidated file has been committed.
+
+        scheduler: Request scheduler used to download again raw files deleted
+        by a previous run.
+
+        api_url: Base URL of the BDC API.
+
+        pruned: List extended with the (manifest) paths of the raw files
+        deleted after their state was committed.
+
+        failed_files: List extended with (file label, error) tuples of the
+        files that could not be processed, and with (state label, error)
+        tuples of the states that could not be committed or pruned.
+
+        storage_format: Storage format of the consolidated data (see
+        storage_utils.STORAGE_FORMATS).
+
+        n_buckets: Number of location_id buckets of the consolidated data
+        (see utils.concat_availability_tables), or None for none.
+    """
+    processed = {}
+    while True:
+        item = file_queue.get()
+        if item is None:
+            break
+        as_of_date, state_id, smd, fmd, file_path = item
+        file_lbl = f"{as_of_date}/{state_id}/{fmd['file_name']}"
+        aod_save_path = f"{process_destination}/{as_of_date}/"
+        part_path = f"{aod_save_path}/{state_id}.{fmd['file_name']}.part"
+        os.makedirs(aod_save_path, exist_ok=True)
+        # Raw files deleted after a previous commit must be downloaded again
+        if not Path(file_path).is_file():
+            result = download_file(scheduler, api_url, 'availability',
+                                   fmd['file_id'], file_path)
+            if result['error'] is not None:
+                print(f"    {file_lbl}: {result['error']}: Failed to get file"
+                      f" {fmd['file_id']}.")
+                failed_files.append((file_lbl, result['error']))
+                continue
+        try:
+            file_df = read_table(file_path, dtype=RAW_AVAILABILITY_DTYPES)
+            file_df = augment_availability_data(file_df)
+            with AvailabilityTableWriter(part_path, storage_format) as writer:
+                writer.write(file_df)
+        except Exception as e:
+            print(f"    {file_lbl}: Failed to process file ({e}).")
+            failed_files.append((file_lbl, f"processing failed ({e})"))
+            continue
+        print(f"    {file_lbl}: processed")
+        done = processed.setdefault((as_of_date, state_id), set())
+        done.add(fmd['file_name'])
+        if len(done) < len(smd['files']):
+            continue
+        # Commit the consolidated files for the pair <as_of_date, state>
+        state_lbl = f"{as_of_date}/{state_id}"
+        try:
+            concat_availability_tables(
+                [
+                    f"{aod_save_path}/{state_id}.{state_fmd['file_name']}.part"
+                    for state_fmd in smd['files']
+                ],
+                f"{aod_save_path}/{state_id}",
+                storage_format,
+                n_buckets,
+            )
+        except Exception as e:
+            print(f"    {state_lbl}: Failed to commit state ({e}).")
+            failed_files.append((state_lbl, f"commit failed ({e})"))
+            continue
+        print(f"    {state_lbl}: committed")
+        # Delete the raw files of the state if they are not to be kept
+        if not keep_raw:
+            state_path = str(Path(file_path).parent)
+            try:
+                for state_fmd in smd['files']:
+                    os.remove(f"{state_path}/{state_fmd['file_name']}.zip")
+                    pruned.append(f"{state_lbl}/{state_fmd['file_name']}.zip")
+            except Exception as e:
+                print(f"    {state_lbl}: Failed to prune raw files ({e}).")
+                failed_files.append((state_lbl, f"pruning failed ({e})"))
+
+
+def download_fixed_availability_data(headers, destination,
+                                     as_of_date_range=None, state_fips=None,
+                                     technology_codes=None, max_workers=8,
+                                     revalidate=True,
+                                     max_rate=MAX_REQUEST_RATE,
+                                     max_retries=MAX_REQUEST_RETRIES,
+                                     process_destination=None,
+                                     keep_raw=True, storage_format="csv",
+                                     n_buckets=None, api_url=BDC_API_URL):
     """Downloads the requested availability data into the given directory.
 
     Directories and files are named according to the following pattern:
         <fixed|mobile>/<as_of_date>/
             <state_fips>_<state_name>_<technology_code>_<technology_desc>.zip
 
+    Downloads are incremental: a sync manifest keyed by file_id records the
+    size, publish date and checksum of every file, and only new, re-published
+    or damaged files are downloaded. The (as_of_date, state, technology)
+    partitions whose files changed are saved to 'changed_partitions.json'.
+
     Args:
         headers: Headers to use for web requests. Should include username and
         hash_value.
 
         destination: Directory to save the downloaded data into.
+
+        as_of_date_range: Optional (start, end) pair of As of Dates
+        (YYYY-MM-DD), both inclusive, to download. Either end may be None.
+
+        state_fips: Optional list of state FIPS codes to download.
+
+        technology_codes: Optional list of technology codes to download.
+
+        max_workers: Maximum number of files (and file lists) downloaded
+        concurrently. All workers share a single pool of HTTP connections.
+
+        revalidate: Whether to make conditional requests to check if files
+        already downloaded were re-published under the same file_id.
+
+        max_rate: Maximum rate (requests/s) of requests to the API. The rate
+        is lowered automatically while the API throttles requests.
+
+        max_retries: Maximum number of retries of a throttled or failed
+        request (with exponential backoff).
+
+        process_destination: Optional directory to save the consolidated and
+        augmented availability data into. If given, each file is handed to
+        the consolidation step (see process-bdc-availability.py) as soon as it
+        is downloaded, overlapping downloads and processing. Only states
+        without a consolidated file or with changed files are processed.
+
+        keep_raw: Whether to keep the downloaded ZIP files of a state once its
+        consolidated file has been committed. Only used along with
+        'process_destination'.
+
+        storage_format: Storage format of the consolidated data, i.e., 'csv'
+        or 'parquet' (see process-bdc-availability.py).
+
+        n_buckets: Number of location_id buckets of the consolidated data, or
+        None for none (see process-bdc-availability.py).
+
+        api_url: Base URL of the BDC API.
+
+    The selected subset of the data is saved in the top-level 'metadata.json'
+    file, and only the selected As of Dates, states and technologies are
+    listed in the metadata files read by downstream stages.
     """
     # Set up auxiliary variables
-    api_url = "https://broadbandmap.fcc.gov/api/public/map/"
-    headers["User-Agent"] = "challenge-explorer 0.0.1"
-    session = requests.Session()
-    session.headers.update(headers)
+    scheduler = RequestScheduler(
+        create_session(headers, pool_size=max_workers),
+        max_rate=max_rate,
+        max_retries=max_retries,
+    )
+    selection = build_selection(
+        as_of_date_range=as_of_date_range,
+        state_fips=state_fips,
+        technology_codes=technology_codes,
+    )
     # Get list of as of dates for availability data
-    response = session.get(f"{api_url}/listAsOfDates")
-    if response.status_code == 200:
-        as_of_dates = []
-        for item in response.json()['data']:
-            if item['data_type'] == 'availability':
-                as_of_date = item['as_of_date'][:10]  # Future: Use DateTime
-                as_of_dates.append(as_of_date)
+    as_of_dates = list_as_of_dates(scheduler, api_url, 'availability')
+    if as_of_dates is not None:
+        as_of_dates = [
+            as_of_date for as_of_date in as_of_dates
+            if is_selected(selection, as_of_date=as_of_date)
+        ]
         os.makedirs(f"{destination}", exist_ok=True)
         aods_md = {
             'as_of_dates': as_of_dates,
+            'selection': selection,
         }
         print(f"Found the following As of Dates: {as_of_dates}")
         with open(f"{destination}/metadata.json", "w") as f:
@@ -42,24 +213,51 @@ def download_fixed_availability_data(headers, destination):
     else:
         print("Failed to get 'As of Dates' for Availability Data")
         return
+    # Get the file lists for every 'As of Date' present in parallel
+    aods_files = list_files_per_as_of_date(
+        scheduler,
+        api_url,
+        'availability',
+        as_of_dates,
+        max_workers=max_workers,
+    )
     # Download the files for state-based fixed-broadband availability data for
     # every 'As of Date' present
-    for as_of_date in as_of_dates:
-        print(f"As of Date: {as_of_date}")
-        aod_path = f"{destination}/{as_of_date}/"
-        os.makedirs(aod_path, exist_ok=True)
-        aod_md = {
-            'states': []
-        }
-        url = f"{api_url}/downloads/listAvailabilityData/{as_of_date}"
-        response = session.get(url)
-        if response.status_code == 200:
-            files = response.json()['data']
-
+    manifest = load_sync_manifest(destination)
+    path_entries = {entry['path']: entry for entry in manifest.values()}
+    changed_partitions = []
+    aods_states_md = {}
+    # Set up the consumer consolidating files as they are downloaded
+    partitions = {}
+    pruned = []
+    failed_files = []
+    if process_destination is not None:
+        check_storage_format(storage_format)
+        file_queue = queue.Queue()
+        consumer = threading.Thread(
+            target=consolidate_downloaded_files,
+            args=(file_queue, process_destination, keep_raw, scheduler,
+                  api_url, pruned, failed_files, storage_format, n_buckets),
+        )
+        consumer.start()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloads = {}
+        for as_of_date in as_of_dates:
+            files = aods_files[as_of_date]
+            if files is None:
+                print(f"Failed to get file list for as of date {as_of_date}")
+                failed_files.append((as_of_date, "file list unavailable"))
+                break
+            aod_path = f"{destination}/{as_of_date}/"
             states_md = {}
             for fmd in files:
                 if fmd['category'] == 'State' \
-                        and fmd['subcategory'] == 'Fixed Broadband':
+                        and fmd['subcategory'] == 'Fixed Broadband' \
+                        and is_selected(
+                            selection,
+                            state_fips=fmd['state_fips'],
+                            technology_code=fmd['technology_code'],
+                        ):
                     if fmd['state_fips'] not in states_md:
                         states_md[fmd['state_fips']] = {
                             "state_fips": fmd['state_fips'],
@@ -71,49 +269,162 @@ def download_fixed_availability_data(headers, destination):
                          f"_{fmd['technology_code_desc'].replace(' ', '')}"
                     fmd['file_name'] = fn
                     states_md[fmd['state_fips']]['files'].append(fmd)
+            aods_states_md[as_of_date] = states_md
 
             for _, smd in states_md.items():
                 state_id = f"{smd['state_fips']}_" \
                            f"{smd['state_name'].replace(' ', '')}"
-                aod_md['states'].append(state_id)
-                print(f"    State: {state_id}")
                 state_path = f"{aod_path}/{state_id}/"
                 os.makedirs(state_path, exist_ok=True)
+                state_save_path = \
+                    f"{process_destination}/{as_of_date}/{state_id}"
+                partitions[(as_of_date, state_id)] = {
+                    'state_md': smd,
+                    'synced': [],
+                    'process': process_destination is not None
+                    and find_table(state_save_path) is None,
+                }
                 for fmd in smd['files']:
-                    print(end=f"        {fmd['file_name']}: ")
+                    file_lbl = f"{as_of_date}/{state_id}/{fmd['file_name']}"
                     file_path = f"{state_path}/{fmd['file_name']}.zip"
-                    # If file has been downloaded previously, skip
-                    if Path(file_path).is_file():
-                        print("skipping")
-                        continue
-                    # Else, download the file
-                    file_url = f"{api_url}/downloads/downloadFile/" \
-                               f"availability/{fmd['file_id']}"
-                    r = session.get(file_url)
-                    if r.status_code == 200:
-                        with open(file_path, "wb") as f:
-                            f.write(r.content)
-                        print("done")
-                    else:
-                        print(f"{r.status_code}: Failed to get file"
-                              f" {fmd['file_id']}.")
-                        break
-                    # break # testing
-                with open(f"{state_path}/metadata.json", "w") as f:
-                    json.dump(smd, f, indent=4)
-            with open(f"{aod_path}/metadata.json", "w") as f:
+                    # Schedule the file to be synced with its previous
+                    # download
+                    future = executor.submit(
+                        sync_file,
+                        scheduler,
+                        api_url,
+                        'availability',
+                        fmd['file_id'],
+                        file_path,
+                        path_entries.get(f"{file_lbl}.zip"),
+                        revalidate,
+                    )
+                    downloads[future] = \
+                        (file_lbl, as_of_date, state_id, fmd, file_path)
+        # Report downloads as they complete and keep the manifest up to date
+        try:
+            for future in as_completed(downloads):
+                file_lbl, as_of_date, state_id, fmd, file_path = \
+                    downloads[future]
+                changed, entry, error = future.result()
+                if error is not None:
+                    print(f"    {file_lbl}: {error}: Failed to get file"
+                          f" {fmd['file_id']}.")
+                    failed_files.append((file_lbl, error))
+                    continue
+                # Replace the entry of a file re-published with a new file_id
+                previous = path_entries.get(f"{file_lbl}.zip")
+                if previous is not None:
+                    manifest.pop(previous['file_id'], None)
+                technology = int(fmd['technology_code'])
+                entry.update({
+                    'as_of_date': as_of_date,
+                    'state': state_id,
+                    'technology': technology,
+                    'path': f"{file_lbl}.zip",
+                })
+                manifest[fmd['file_id']] = entry
+                if changed:
+                    changed_partitions.append(
+                        (as_of_date, state_id, technology)
+                    )
+                    print(f"    {file_lbl}: done")
+                else:
+                    print(f"    {file_lbl}: unchanged")
+                # Hand the file over to the consolidation step if its state
+                # has to be (re)processed
+                if process_destination is None:
+                    continue
+                partition = partitions[(as_of_date, state_id)]
+                partition['synced'].append((fmd, file_path))
+                to_process = []
+                if partition['process']:
+                    to_process = [(fmd, file_path)]
+                elif changed:
+                    partition['process'] = True
+                    to_process = partition['synced']
+                for synced_fmd, synced_file_path in to_process:
+                    file_queue.put((as_of_date, state_id,
+                                    partition['state_md'], synced_fmd,
+                                    synced_file_path))
+        finally:
+            if process_destination is not None:
+                file_queue.put(None)
+                consumer.join()
+                pruned = set(pruned)
+                for entry in manifest.values():
+                    if entry['path'] in pruned:
+                        entry['pruned'] = True
+            save_sync_manifest(destination, manifest)
+    save_changed_partitions(destination, changed_partitions)
+    print(f"{len(changed_partitions)} partitions changed")
+    scheduler.report(failed_files)
+    # Save the metadata for every As of Date and State
+    for as_of_date, states_md in aods_states_md.items():
+        aod_path = f"{destination}/{as_of_date}/"
+        aod_md = {
+            'states': []
+        }
+        for _, smd in states_md.items():
+            state_id = f"{smd['state_fips']}_" \
+                       f"{smd['state_name'].replace(' ', '')}"
+            aod_md['states'].append(state_id)
+            with open(f"{aod_path}/{state_id}/metadata.json", "w") as f:
+                json.dump(smd, f, indent=4)
+        with open(f"{aod_path}/metadata.json", "w") as f:
+            json.dump(aod_md, f, indent=4)
+        if process_destination is not None:
+            aod_save_path = f"{process_destination}/{as_of_date}/"
+            os.makedirs(aod_save_path, exist_ok=True)
+            with open(f"{aod_save_path}/metadata.json", "w") as f:
                 json.dump(aod_md, f, indent=4)
-        else:
-            print(f"Failed to get file list for as of date {as_of_date}")
-            return
-        # break # testing
+    if process_destination is not None:
+        with open(f"{process_destination}/metadata.json", "w") as f:
+            json.dump(aods_md, f, indent=4)
 
 
 if __name__ == "__main__":
+    from credentials import BDC_USERNAME, BDC_HASH_VALUE
+
     headers = {
         "username": BDC_USERNAME,
         "hash_value": BDC_HASH_VALUE,
     }
     destination = "data/raw/bdc/availability/fixed/"
+    # Subset of the data to download (None downloads everything), e.g.,
+    # ("2023-06-30", None), ["01", "11"], and [10, 40, 50]
+    as_of_date_range = None
+    state_fips = None
+    technology_codes = None
+    # Number of concurrent downloads
+    max_workers = 8
+    # Check whether previously downloaded files were re-published
+    revalidate = True
+    # Maximum request rate (requests/s) and retries of failed requests
+    max_rate = 5.0
+    max_retries = 5
+    # Consolidate and augment files as soon as they are downloaded (stage 2.1)
+    # into the given directory (None only downloads them), and whether to
+    # keep the raw files of the states already consolidated
+    process_destination = None
+    keep_raw = True
+    # Storage format of the consolidated data ('csv' or 'parquet')
+    storage_format = "csv"
+    # Number of location_id buckets of the consolidated data (None for none)
+    n_buckets = None
 
-    download_fixed_availability_data(headers=headers, destination=destination)
+    download_fixed_availability_data(
+        headers=headers,
+        destination=destination,
+        as_of_date_range=as_of_date_range,
+        state_fips=state_fips,
+        technology_codes=technology_codes,
+        max_workers=max_workers,
+        revalidate=revalidate,
+        max_rate=max_rate,
+        max_retries=max_retries,
+        process_destination=process_destination,
+        keep_raw=keep_raw,
+        storage_format=storage_format,
+        n_buckets=n_buckets,
+    )
@@ -1,39 +1,83 @@
 import json
 import os
-import requests
 
-from pathlib import Path
-from credentials import BDC_USERNAME, BDC_HASH_VALUE
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from download_utils import BDC_API_URL, MAX_REQUEST_RATE, \
+    MAX_REQUEST_RETRIES, RequestScheduler, build_selection, create_session, \
+    is_selected, list_as_of_dates, list_files_per_as_of_date, \
+    load_sync_manifest, save_changed_partitions, save_sync_manifest, sync_file
 
-def download_resolved_fixed_challenge_data(headers, destination):
+
+def download_resolved_fixed_challenge_data(headers, destination,
+                                           as_of_date_range=None,
+                                           state_fips=None,
+                                           max_workers=8,
+                                           revalidate=True,
+                                           max_rate=MAX_REQUEST_RATE,
+                                           max_retries=MAX_REQUEST_RETRIES,
+                                           api_url=BDC_API_URL):
     """Downloads the resolved fixed challenge data into the given directory.
 
     Directories and files are named according to the following pattern:
         fixed_resolved/<as_of_date>/<state_fips>_<state_name>.zip
 
+    Downloads are incremental: a sync manifest keyed by file_id records the
+    size, publish date and checksum of every file, and only new, re-published
+    or damaged files are downloaded. The (as_of_date, state) partitions whose
+    files changed are saved to 'changed_partitions.json'.
+
     Args:
         headers: Headers to use for web requests. Should include username and
         hash_value.
 
         destination: Directory to save the downloaded data into.
+
+        as_of_date_range: Optional (start, end) pair of As of Dates
+        (YYYY-MM-DD), both inclusive, to download. Either end may be None.
+
+        state_fips: Optional list of state FIPS codes to download.
+
+        max_workers: Maximum number of files (and file lists) downloaded
+        concurrently. All workers share a single pool of HTTP connections.
+
+        revalidate: Whether to make conditional requests to check if files
+        already downloaded were re-published under the same file_id.
+
+        max_rate: Maximum rate (requests/s) of requests to the API. The rate
+        is lowered automatically while the API throttles requests.
+
+        max_retries: Maximum number of retries of a throttled or failed
+        request (with exponential backoff).
+
+        api_url: Base URL of the BDC API.
+
+    The selected subset of the data is saved in the top-level 'metadata.json'
+    file, and only the selected As of Dates and states are listed in the
+    metadata files read by downstream stages. Challenge files cover every
+    technology, so they cannot be selected by technology.
     """
     # Set up auxiliary variables
-    api_url = "https://broadbandmap.fcc.gov/api/public/map/"
-    headers["User-Agent"] = "challenge-explorer 0.0.1"
-    session = requests.Session()
-    session.headers.update(headers)
+    scheduler = RequestScheduler(
+        create_session(headers, pool_size=max_workers),
+        max_rate=max_rate,
+        max_retries=max_retries,
+    )
+    selection = build_selection(
+        as_of_date_range=as_of_date_range,
+        state_fips=state_fips,
+    )
     # Get list of as of dates for challenge data
-    response = session.get(f"{api_url}/listAsOfDates")
-    if response.status_code == 200:
-        as_of_dates = []
-        for item in response.json()['data']:
-            if item['data_type'] == 'challenge':
-                as_of_date = item['as_of_date'][:10]  # Future: Use DateTime
-                as_of_dates.append(as_of_date)
+    as_of_dates = list_as_of_dates(scheduler, api_url, 'challenge')
+    if as_of_dates is not None:
+        as_of_dates = [
+            as_of_date for as_of_date in as_of_dates
+            if is_selected(selection, as_of_date=as_of_date)
+        ]
         os.makedirs(f"{destination}/", exist_ok=True)
         aods_md = {
             'as_of_dates': as_of_dates,
+            'selection': selection,
         }
         print(f"Found the following As of Dates: {as_of_dates}")
         with open(f"{destination}/metadata.json", "w") as f:
@@ -41,64 +85,123 @@ def download_resolved_fixed_challenge_data(headers, destination):
     else:
         print("Failed to get 'As of Dates' for Challenge Data")
         return
+    # Get the file lists for every 'As of Date' available in parallel
+    aods_files = list_files_per_as_of_date(
+        scheduler,
+        api_url,
+        'challenge',
+        as_of_dates,
+        max_workers=max_workers,
+    )
     # Download the files for state-based fixed-broadband challenge data for
     # evert 'As of Date' available.
-    for as_of_date in as_of_dates:
-        print(f"As of Date: {as_of_date}")
-        aod_path = f"{destination}/{as_of_date}/"
-        os.makedirs(aod_path, exist_ok=True)
-        aod_md = {
-            'states': []
-        }
-        url = f"{api_url}/downloads/listChallengeData/{as_of_date}"
-        response = session.get(url)
-        if response.status_code == 200:
-            files = response.json()['data']
+    manifest = load_sync_manifest(destination)
+    path_entries = {entry['path']: entry for entry in manifest.values()}
+    changed_partitions = []
+    failed_files = []
+    aods_md = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloads = {}
+        for as_of_date in as_of_dates:
+            files = aods_files[as_of_date]
+            if files is None:
+                print(f"Failed to get file list for as of date {as_of_date}")
+                failed_files.append((as_of_date, "file list unavailable"))
+                break
+            aod_path = f"{destination}/{as_of_date}/"
+            os.makedirs(aod_path, exist_ok=True)
+            aod_md = {
+                'states': []
+            }
+            aods_md[as_of_date] = aod_md
             for fmd in files:
-                if fmd['category'] == 'Fixed Challenge - Resolved':
+                if fmd['category'] == 'Fixed Challenge - Resolved' \
+                        and is_selected(selection,
+                                        state_fips=fmd['state_fips']):
                     state_id = f"{fmd['state_fips']}" \
                          f"_{fmd['state_name'].replace(' ', '')}"
-                    print(end=f"    State: {state_id} ")
                     fmd['file_name'] = state_id
                     file_path = f"{aod_path}/{state_id}.zip"
-                    # If file has been downloaded previously, skip
-                    if Path(file_path).is_file():
-                        aod_md['states'].append(state_id)
-                        print("skipping")
-                        continue
-                    # Else, download the file
-                    file_url = f"{api_url}/downloads/downloadFile/" \
-                               f"challenge/{fmd['file_id']}"
-                    r = session.get(file_url)
-                    if r.status_code == 200:
-                        with open(file_path, "wb") as f:
-                            f.write(r.content)
-                        print("downloaded")
-                    else:
-                        print(
-                            f"\n{r.status_code}: Failed to get file "
-                            f"{fmd['file_id']} for {state_id}."
-                        )
-                        continue
-                    aod_md['states'].append(state_id)
-                    # break  # testing
-            aod_md['states'] = sorted(set(aod_md['states']))
-            with open(f"{aod_path}/metadata.json", "w") as f:
-                json.dump(aod_md, f, indent=4)
-            print('done')
-        else:
-            print(f"Failed to get file list for as of date {as_of_date}")
-            return
+                    # Schedule the file to be synced with its previous
+                    # download
+                    future = executor.submit(
+                        sync_file,
+                        scheduler,
+                        api_url,
+                        'challenge',
+                        fmd['file_id'],
+                        file_path,
+                        path_entries.get(f"{as_of_date}/{state_id}.zip"),
+                        revalidate,
+                    )
+                    downloads[future] = (as_of_date, state_id, fmd['file_id'])
+        # Report downloads as they complete and keep the manifest up to date
+        try:
+            for future in as_completed(downloads):
+                as_of_date, state_id, file_id = downloads[future]
+                changed, entry, error = future.result()
+                if error is not None:
+                    print(f"    {as_of_date}/{state_id}: {error}: Failed to"
+                          f" get file {file_id} for {state_id}.")
+                    failed_files.append((f"{as_of_date}/{state_id}", error))
+                    continue
+                aods_md[as_of_date]['states'].append(state_id)
+                # Replace the entry of a file re-published with a new file_id
+                file_lbl = f"{as_of_date}/{state_id}.zip"
+                previous = path_entries.get(file_lbl)
+                if previous is not None:
+                    manifest.pop(previous['file_id'], None)
+                entry.update({
+                    'as_of_date': as_of_date,
+                    'state': state_id,
+                    'technology': None,
+                    'path': file_lbl,
+                })
+                manifest[file_id] = entry
+                if changed:
+                    changed_partitions.append((as_of_date, state_id, None))
+                    print(f"    {as_of_date}/{state_id}: downloaded")
+                else:
+                    print(f"    {as_of_date}/{state_id}: unchanged")
+        finally:
+            save_sync_manifest(destination, manifest)
+    save_changed_partitions(destination, changed_partitions)
+    # Save the metadata for every As of Date
+    for as_of_date, aod_md in aods_md.items():
+        aod_md['states'] = sorted(set(aod_md['states']))
+        with open(f"{destination}/{as_of_date}/metadata.json", "w") as f:
+            json.dump(aod_md, f, indent=4)
+    print('done')
+    scheduler.report(failed_files)
 
 
 if __name__ == "__main__":
+    from credentials import BDC_USERNAME, BDC_HASH_VALUE
+
     headers = {
         "username": BDC_USERNAME,
         "hash_value": BDC_HASH_VALUE,
     }
     destination = "data/raw/bdc/challenge/fixed_resolved"
+    # Subset of the data to download (None downloads everything), e.g.,
+    # ("2023-06-30", None) and ["01", "11"]
+    as_of_date_range = None
+    state_fips = None
+    # Number of concurrent downloads
+    max_workers = 8
+    # Check whether previously downloaded files were re-published
+    revalidate = True
+    # Maximum request rate (requests/s) and retries of failed requests
+    max_rate = 5.0
+    max_retries = 5
 
     download_resolved_fixed_challenge_data(
         headers=headers,
         destination=destination,
+        as_of_date_range=as_of_date_range,
+        state_fips=state_fips,
+        max_workers=max_workers,
+        revalidate=revalidate,
+        max_rate=max_rate,
+        max_retries=max_retries,
     )
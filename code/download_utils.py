@@ -0,0 +1,662 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+# FCC Broadband Data Collection (BDC) Public Data API
+BDC_API_URL = "https://broadbandmap.fcc.gov/api/public/map"
+BDC_USER_AGENT = "challenge-explorer 0.0.1"
+# Size of the chunks streamed from the API to disk (bytes)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of attempts to (resume and) complete a file download
+DOWNLOAD_ATTEMPTS = 3
+# Default maximum request rate (requests/s) and number of retries of a request
+MAX_REQUEST_RATE = 5.0
+MAX_REQUEST_RETRIES = 5
+# Responses that are retried (throttling and transient server errors)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# Files (in the download directory) recording the state of the last sync
+SYNC_MANIFEST_FN = "sync_manifest.json"
+CHANGED_PARTITIONS_FN = "changed_partitions.json"
+# Endpoints listing the files available for each data type
+LIST_ENDPOINTS = {
+    "availability": "listAvailabilityData",
+    "challenge": "listChallengeData",
+}
+
+
+def create_session(headers, pool_size=1):
+    """Creates a web session for the BDC API whose connection pool can be
+    shared by up to 'pool_size' concurrent workers.
+
+    Args:
+        headers: Headers to use for web requests. Should include username and
+        hash_value.
+
+        pool_size: Maximum number of connections kept open to the API.
+
+    Returns:
+        A requests.Session configured with the given headers.
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    session.headers["User-Agent"] = BDC_USER_AGENT
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _retry_after(response):
+    """Determines the delay (seconds) requested by the Retry-After header of a
+    response, or None if there is no (valid) header."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=timezone.utc)
+    return max((retry_date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class RequestScheduler:
+    """Schedules the requests made to the BDC API by concurrent workers
+    sharing a web session.
+
+    Requests are paced by a token bucket refilled at the current request
+    rate. Throttled (429) and failed (5xx, connection errors) requests are
+    retried with exponential backoff and full jitter, or after the delay given
+    by their Retry-After header. A 429 response also pauses every worker and
+    halves the request rate, which then grows back additively towards
+    'max_rate' as requests succeed. Requests that still fail after
+    'max_retries' retries are recorded in 'failures'.
+    """
+
+    def __init__(self, session, max_rate=MAX_REQUEST_RATE, burst=None,
+                 max_retries=MAX_REQUEST_RETRIES, backoff_base=1.0,
+                 backoff_max=60.0):
+        """Creates a request scheduler.
+
+        Args:
+            session: Web session to make the requests with.
+
+            max_rate: Maximum request rate (requests/s).
+
+            burst: Maximum number of requests made at once (defaults to one
+            second's worth of requests).
+
+            max_retries: Maximum number of retries of each request.
+
+            backoff_base: Backoff (seconds) before the first retry, doubled on
+            each following retry.
+
+            backoff_max: Maximum backoff (seconds) before a retry.
+        """
+        self.session = session
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst if burst is not None else max(max_rate, 1)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = []
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        """Blocks until a request can be made under the current rate."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens = self._tokens - 1
+                        self.requests = self.requests + 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _throttle(self, delay):
+        """Halves the request rate and pauses all requests for 'delay'
+        seconds."""
+        with self._lock:
+            self.throttled = self.throttled + 1
+            self.rate = max(self.rate / 2, self.max_rate / 64)
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + delay)
+
+    def _recover(self):
+        """Increases the request rate after a successful request."""
+        with self._lock:
+            self.rate = min(self.rate + self.max_rate / 16, self.max_rate)
+
+    def backoff_delay(self, attempt):
+        """Determines the (jittered) delay before retry number 'attempt'
+        (starting from 0)."""
+        delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+        return random.uniform(0, delay)
+
+    def get(self, url, **kwargs):
+        """Makes a GET request, retrying it if throttled or failed.
+
+        Args:
+            url: URL to request.
+
+            **kwargs: Arguments passed on to requests.Session.get.
+
+        Returns:
+            The response of the last attempt. Its status code is one of the
+            RETRY_STATUS_CODES if every attempt failed.
+
+        Raises:
+            requests.RequestException: If the last attempt raised it.
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    self.failures.append((url, type(e).__name__))
+                    raise
+                delay = self.backoff_delay(attempt)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    self._recover()
+                    return response
+                if attempt == self.max_retries:
+                    self.failures.append((url, f"{response.status_code}"))
+                    return response
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                if response.status_code == 429:
+                    self._throttle(delay)
+                response.close()
+            with self._lock:
+                self.retries = self.retries + 1
+            time.sleep(delay)
+
+    def report(self, failed_files=()):
+        """Prints a final report of the requests made, the requests that
+        failed, and the files that could not be downloaded.
+
+        Args:
+            failed_files: List of (file label, error) tuples of the files that
+            could not be downloaded.
+        """
+        print(f"Requests: {self.requests} ({self.retries} retries,"
+              f" {self.throttled} throttled)")
+        if self.failures:
+            print(f"Requests that failed after {self.max_retries} retries:")
+            for url, error in self.failures:
+                print(f"    {url}: {error}")
+        if failed_files:
+            print(f"Failed to get {len(failed_files)} files:")
+            for file_lbl, error in sorted(failed_files):
+                print(f"    {file_lbl}: {error}")
+
+
+def list_as_of_dates(scheduler, api_url, data_type):
+    """Lists the As of Dates available for the given data type.
+
+    Args:
+        scheduler: Request scheduler (see RequestScheduler) to make requests
+        with.
+
+        api_url: Base URL of the BDC API.
+
+        data_type: Either 'availability' or 'challenge'.
+
+    Returns:
+        The list of As of Dates (YYYY-MM-DD), or None if the request failed.
+    """
+    try:
+        response = scheduler.get(f"{api_url}/listAsOfDates")
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    as_of_dates = []
+    for item in response.json()['data']:
+        if item['data_type'] == data_type:
+            as_of_date = item['as_of_date'][:10]  # Future: Use DateTime
+            as_of_dates.append(as_of_date)
+    return as_of_dates
+
+
+def build_selection(as_of_date_range=None, state_fips=None,
+                    technology_codes=None):
+    """Builds the description of the subset of the BDC data to download. The
+    selection is saved in the 'metadata.json' file of the download directory
+    so that downstream stages know they handle a partial dataset.
+
+    Args:
+        as_of_date_range: Optional (start, end) pair of As of Dates
+        (YYYY-MM-DD), both inclusive. Either end may be None.
+
+        state_fips: Optional list of state FIPS codes (e.g., ["01", "11"]).
+
+        technology_codes: Optional list of technology codes (e.g., [10, 50]).
+
+    Returns:
+        A dict with the selection, where None stands for "all".
+    """
+    selection = {
+        'as_of_date_range': None,
+        'state_fips': None,
+        'technology_codes': None,
+    }
+    if as_of_date_range is not None:
+        selection['as_of_date_range'] = list(as_of_date_range)
+    if state_fips is not None:
+        selection['state_fips'] = sorted(
+            f"{int(fips):02d}" for fips in state_fips
+        )
+    if technology_codes is not None:
+        selection['technology_codes'] = sorted(
+            int(tc) for tc in technology_codes
+        )
+    return selection
+
+
+def is_selected(selection, as_of_date=None, state_fips=None,
+                technology_code=None):
+    """Checks whether a file (or As of Date) belongs to the given selection.
+
+    Args:
+        selection: Selection dict (see build_selection).
+
+        as_of_date: As of Date (YYYY-MM-DD) of the file, if any.
+
+        state_fips: State FIPS code of the file, if any.
+
+        technology_code: Technology code of the file, if any.
+
+    Returns:
+        True if the file is part of the selection.
+    """
+    if as_of_date is not None and selection['as_of_date_range'] is not None:
+        start, end = selection['as_of_date_range']
+        if (start is not None and as_of_date < start) \
+                or (end is not None and as_of_date > end):
+            return False
+    if state_fips is not None and selection['state_fips'] is not None:
+        if f"{int(state_fips):02d}" not in selection['state_fips']:
+            return False
+    if technology_code is not None \
+            and selection['technology_codes'] is not None:
+        if int(technology_code) not in selection['technology_codes']:
+            return False
+    return True
+
+
+def list_files(scheduler, api_url, data_type, as_of_date):
+    """Lists the files available for the given data type and As of Date.
+
+    Args:
+        scheduler: Request scheduler (see RequestScheduler) to make requests
+        with.
+
+        api_url: Base URL of the BDC API.
+
+        data_type: Either 'availability' or 'challenge'.
+
+        as_of_date: As of Date (YYYY-MM-DD) of the files.
+
+    Returns:
+        The list of file metadata dicts, or None if the request failed.
+    """
+    url = f"{api_url}/downloads/{LIST_ENDPOINTS[data_type]}/{as_of_date}"
+    try:
+        response = scheduler.get(url)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.json()['data']
+
+
+def list_files_per_as_of_date(scheduler, api_url, data_type, as_of_dates,
+                              max_workers=1):
+    """Lists the files available for each As of Date, fetching the listings
+    of up to 'max_workers' As of Dates in parallel.
+
+    Args:
+        scheduler: Request scheduler (see RequestScheduler) to make requests
+        with.
+
+        api_url: Base URL of the BDC API.
+
+        data_type: Either 'availability' or 'challenge'.
+
+        as_of_dates: As of Dates (YYYY-MM-DD) to list the files for.
+
+        max_workers: Maximum number of concurrent requests.
+
+    Returns:
+        A dict mapping each As of Date to its list of file metadata dicts (or
+        None if the listing could not be fetched).
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = executor.map(
+            lambda aod: list_files(scheduler, api_url, data_type, aod),
+            as_of_dates,
+        )
+        return dict(zip(as_of_dates, listings))
+
+
+def is_downloaded(file_path):
+    """Checks whether a file has been completely downloaded, i.e., it exists
+    and its ZIP central directory is readable. Files truncated by runs that
+    predate the atomic downloads fail this check.
+
+    Args:
+        file_path: Path of the downloaded file.
+
+    Returns:
+        True if the file exists and is a readable ZIP file.
+    """
+    return Path(file_path).is_file() and zipfile.is_zipfile(file_path)
+
+
+def _content_size(response):
+    """Determines the total size of the file being downloaded from the headers
+    of the response, or None if it cannot be determined."""
+    if 'Content-Encoding' in response.headers:
+        return None
+    if response.status_code == 206:
+        content_range = response.headers.get('Content-Range', '')
+        total = content_range.rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get('Content-Length', '')
+    return int(content_length) if content_length.isdigit() else None
+
+
+def _verify_zip(file_path):
+    """Checks the integrity (CRC) of every member of a ZIP file."""
+    try:
+        with zipfile.ZipFile(file_path) as zf:
+            return zf.testzip() is None
+    except zipfile.BadZipFile:
+        return False
+
+
+def download_file(scheduler, api_url, data_type, file_id, file_path,
+                  validators=None,
+                  chunk_size=DOWNLOAD_CHUNK_SIZE,
+                  max_attempts=DOWNLOAD_ATTEMPTS):
+    """Downloads a single BDC file into the given path.
+
+    The file is streamed in chunks to a temporary '<file_path>.part' file,
+    which is only renamed to 'file_path' once its size and ZIP integrity have
+    been verified. Interrupted downloads (in this or a previous run) are
+    resumed from the temporary file with HTTP Range requests.
+
+    Args:
+        scheduler: Request scheduler (see RequestScheduler) to make requests
+        with.
+
+        api_url: Base URL of the BDC API.
+
+        data_type: Either 'availability' or 'challenge'.
+
+        file_id: Identifier of the file in the BDC API.
+
+        file_path: Path to save the downloaded file into.
+
+        validators: Optional dict with the 'etag' and/or 'publish_date'
+        (Last-Modified) of a previous download of the file, used to make a
+        conditional request.
+
+        chunk_size: Number of bytes held in memory while streaming the file.
+
+        max_attempts: Number of attempts to (resume and) complete the
+        download.
+
+    Returns:
+        A dict with the 'error' of the download (None if it succeeded),
+        whether the file was 'not_modified' since the given validators, and
+        the 'etag' and 'publish_date' sent by the API for the file.
+    """
+    file_url = f"{api_url}/downloads/downloadFile/{data_type}/{file_id}"
+    part_path = f"{file_path}.part"
+    result = {
+        'error': None,
+        'not_modified': False,
+        'etag': None,
+        'publish_date': None,
+    }
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            time.sleep(scheduler.backoff_delay(attempt - 1))
+        # Resume from the temporary file left by an interrupted download
+        offset = 0
+        if Path(part_path).is_file():
+            offset = os.path.getsize(part_path)
+        request_headers = {}
+        if offset > 0:
+            request_headers['Range'] = f"bytes={offset}-"
+        elif validators:
+            if validators.get('etag'):
+                request_headers['If-None-Match'] = validators['etag']
+            if validators.get('publish_date'):
+                request_headers['If-Modified-Since'] = \
+                    validators['publish_date']
+        try:
+            with scheduler.get(file_url, headers=request_headers,
+                               stream=True) as r:
+                if r.status_code == 304:
+                    result['not_modified'] = True
+                    return result
+                if r.status_code == 416:
+                    # The temporary file is not a prefix of the file anymore
+                    os.remove(part_path)
+                    result['error'] = "invalid partial download"
+                    continue
+                if r.status_code not in [200, 206]:
+                    result['error'] = f"{r.status_code}"
+                    return result
+                result['etag'] = r.headers.get('ETag')
+                result['publish_date'] = r.headers.get('Last-Modified')
+                # The server may ignore the Range header and send everything
+                mode = "ab" if r.status_code == 206 else "wb"
+                expected_size = _content_size(r)
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+        except requests.RequestException as e:
+            result['error'] = f"{type(e).__name__}"
+            continue
+        # Verify the size and integrity of the downloaded file
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size < expected_size:
+            result['error'] = \
+                f"incomplete download ({size}/{expected_size} bytes)"
+            continue
+        if (expected_size is not None and size > expected_size) \
+                or not _verify_zip(part_path):
+            os.remove(part_path)
+            result['error'] = "corrupted download"
+            continue
+        os.replace(part_path, file_path)
+        result['error'] = None
+        return result
+    return result
+
+
+def file_sha256(file_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Computes the SHA-256 checksum of a file.
+
+    Args:
+        file_path: Path of the file.
+
+        chunk_size: Number of bytes read at a time.
+
+    Returns:
+        The hexadecimal SHA-256 digest of the file contents.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_sync_manifest(destination):
+    """Loads the sync manifest of a download directory. The manifest maps the
+    'file_id' of every file downloaded into the directory to a dict with its
+    partition (as_of_date, state, technology), relative 'path', 'size',
+    'sha256' checksum, and the 'etag' and 'publish_date' sent by the API.
+    Entries of files deleted once processed are flagged as 'pruned'.
+
+    Args:
+        destination: Directory the data is downloaded into.
+
+    Returns:
+        The manifest dict (empty if the directory has not been synced yet).
+    """
+    try:
+        with open(f"{destination}/{SYNC_MANIFEST_FN}") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_sync_manifest(destination, manifest):
+    """Atomically saves the sync manifest of a download directory.
+
+    Args:
+        destination: Directory the data is downloaded into.
+
+        manifest: The manifest dict (see load_sync_manifest).
+    """
+    manifest_fn = f"{destination}/{SYNC_MANIFEST_FN}"
+    with open(f"{manifest_fn}.part", "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(f"{manifest_fn}.part", manifest_fn)
+
+
+def save_changed_partitions(destination, partitions):
+    """Saves the partitions changed by the last sync of a download directory,
+    so that later stages can reprocess only those.
+
+    Args:
+        destination: Directory the data is downloaded into.
+
+        partitions: List of (as_of_date, state, technology) tuples. The
+        technology is None for data not partitioned by technology.
+    """
+    partitions_md = [
+        {
+            'as_of_date': as_of_date,
+            'state': state_id,
+            'technology': technology,
+        }
+        for as_of_date, state_id, technology in sorted(set(partitions),
+                                                       key=str)
+    ]
+    with open(f"{destination}/{CHANGED_PARTITIONS_FN}", "w") as f:
+        json.dump(partitions_md, f, indent=4)
+
+
+def sync_file(scheduler, api_url, data_type, file_id, file_path, entry,
+              revalidate=True):
+    """Synchronizes a single BDC file with its previous download (if any).
+
+    The file is downloaded if it is not on disk, if it does not match its
+    manifest entry, or if it was re-published under a new file_id. When
+    'revalidate' is set and the API sent an ETag or Last-Modified header for
+    the previous download, a conditional request checks whether the file was
+    re-published under the same file_id. Files on disk that are not in the
+    manifest yet (e.g., downloaded before manifests existed) are adopted as
+    they are, and files marked as 'pruned' in the manifest (i.e., deleted
+    once processed) are not downloaded again unless they changed.
+
+    Args:
+        scheduler: Request scheduler (see RequestScheduler) to make requests
+        with.
+
+        api_url: Base URL of the BDC API.
+
+        data_type: Either 'availability' or 'challenge'.
+
+        file_id: Identifier of the file in the BDC API.
+
+        file_path: Path to save the downloaded file into.
+
+        entry: Manifest entry of the previous download into 'file_path', or
+        None.
+
+        revalidate: Whether to make conditional requests for unchanged
+        file_ids.
+
+    Returns:
+        A tuple (changed, entry, error), where 'changed' tells whether the
+        contents of 'file_path' changed, 'entry' is the updated manifest entry
+        (without partition information) and 'error' describes a failed
+        download (None otherwise).
+    """
+    on_disk = is_downloaded(file_path)
+    validators = None
+    # Files deleted after being processed are considered to be on disk
+    if entry is not None and entry['file_id'] == file_id \
+            and (entry.get('pruned') or (
+                on_disk and entry['size'] == os.path.getsize(file_path)
+            )):
+        if not revalidate \
+                or not (entry.get('etag') or entry.get('publish_date')):
+            return False, entry, None
+        validators = entry
+    elif entry is None and on_disk:
+        entry = {
+            'file_id': file_id,
+            'size': os.path.getsize(file_path),
+            'sha256': file_sha256(file_path),
+            'etag': None,
+            'publish_date': None,
+        }
+        return False, entry, None
+    result = download_file(scheduler, api_url, data_type, file_id, file_path,
+                           validators=validators)
+    if result['error'] is not None:
+        return False, entry, result['error']
+    if result['not_modified']:
+        return False, entry, None
+    new_entry = {
+        'file_id': file_id,
+        'size': os.path.getsize(file_path),
+        'sha256': file_sha256(file_path),
+        'etag': result['etag'],
+        'publish_date': result['publish_date'],
+    }
+    changed = entry is None or entry['sha256'] != new_entry['sha256']
+    return changed, new_entry, None
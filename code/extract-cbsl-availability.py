@@ -1,35 +1,63 @@
 import json
 import os
 
-from pathlib import Path
+import numpy as np
 
-import pandas as pd
-
-from utils import AVAILABILITY_DTYPES
+from storage_utils import TableWriter, check_storage_format, find_table, \
+    read_table
+from utils import COMPACT_AVAILABILITY_DTYPES, COMPACT_CHALLENGE_DTYPES, \
+    empty_availability_records, iter_cbsl_records, location_ids_digest, \
+    read_cbsl_digest, write_cbsl_digest
 
 
 def extract_challenging_bsl_availability(availability_source,
                                          challenge_source_fn,
-                                         destination):
+                                         destination,
+                                         memory_budget=None,
+                                         storage_format="csv"):
     """Extracts availability records for all BSLs engaged in at least one
     challenge. Records are augmented to contain service status ratings and as
-    of dates relative to the records.
+    of dates relative to the records. The BSL table of each <as_of_date,
+    state> pair is read first, so that states without challenging BSLs are
+    skipped without reading their availability records. Availability tables
+    bucketed by location_id (see storage_utils.BucketedTableWriter) are read
+    only in the buckets holding challenging BSLs.
+
+    The challenged location_ids each table holds the records of are recorded
+    (see utils.write_cbsl_digest), so that tables written for the same
+    challenged BSLs (e.g., by process-bdc-availability.py in the consolidation
+    pass) are kept. When the challenged BSLs change, the records of the BSLs
+    still challenged are kept, and only the newly challenged BSLs are looked
+    up in the BSL tables.
 
     Args:
         availability_source: Directory where the availability data is stored.
 
-        challenge_source_fn: Name of file containing the consolidated challenge
-        data.
+        challenge_source_fn: Path of the consolidated challenge data (see
+        storage_utils.resolve_table).
 
         destination: Directory to save the filtered and consolidated engaged
         BSL availability data.
+
+        memory_budget: Memory (bytes) available to hold availability records.
+        If given, state files are streamed in chunks of as many records as fit
+        in it. Otherwise, state files are loaded whole.
+
+        storage_format: Storage format of the extracted data ('csv' or
+        'parquet').
     """
+    check_storage_format(storage_format)
     # Load consolidated challenge file
     print(end="Loading challenge data...", flush=True)
-    c_df = pd.read_csv(challenge_source_fn, usecols=["location_id"], dtype=str)
+    c_df = read_table(
+        challenge_source_fn,
+        columns=["location_id"],
+        dtype=COMPACT_CHALLENGE_DTYPES,
+    )
     print("done")
-    # Build set of unique engaged BSL location_ids
-    cbsl_ids = set(c_df.location_id.unique())
+    # Determine the unique engaged BSL location_ids
+    cbsl_ids = c_df.location_id.unique()
+    cbsl_digest = location_ids_digest(cbsl_ids)
     # Determine As of Dates in the availability data
     try:
         with open(f'{availability_source}/metadata.json') as f:
@@ -43,11 +71,13 @@ def extract_challenging_bsl_availability(availability_source,
         print(f"As of Date: {as_of_date}")
         aod_path = f"{availability_source}/{as_of_date}/"
         aod_save_path = f"{destination}/{as_of_date}/"
-        save_fn = f"{aod_save_path}/cbsl.csv"
+        save_path = f"{aod_save_path}/cbsl"
         # Create destination directory for As of Date
         os.makedirs(aod_save_path, exist_ok=True)
-        # Check and skip in case summary files already exist for the as of date
-        if Path(save_fn).is_file():
+        # Check and skip in case the file already exists for the same
+        # challenged BSLs
+        exists = find_table(save_path) is not None
+        if exists and read_cbsl_digest(aod_save_path) == cbsl_digest:
             print("Consolidated file already exists. Skipping.")
             continue
         # Determine States in the As of Date
@@ -59,39 +89,61 @@ def extract_challenging_bsl_availability(availability_source,
                   f" {as_of_date}.")
             return
         states = sorted(aod_md['states'])
-        # Extract records from each state individually
-        for state_id in states:
-            print(end=f"    State: {state_id}", flush=True)
-            state_fn = f"{aod_path}/{state_id}.csv"
-            # Load availability data for the pair <as_of_date, state>
-            a_df = pd.read_csv(
-                state_fn,
-                dtype=AVAILABILITY_DTYPES,
-            )
-            print(end=".", flush=True)
-            # Filter out records from non-challenging BSLs
-            a_df = a_df[a_df.location_id.isin(cbsl_ids)]
-            print(end=".", flush=True)
-            # Write (partial) challenging BSL data to file
-            a_df.to_csv(
-                save_fn,
-                index=False,
-                mode='a',
-                header=not Path(save_fn).is_file(),
-            )
-            print("done")
-            # break
+        with TableWriter(save_path, storage_format) as writer:
+            # Keep the records of the BSLs still challenged (if the file was
+            # written for other challenged BSLs), and extract the records of
+            # the other challenged BSLs only
+            new_cbsl_ids = cbsl_ids
+            if exists:
+                print(end="    Updating the consolidated file...", flush=True)
+                a_df = read_table(
+                    save_path,
+                    dtype=COMPACT_AVAILABILITY_DTYPES,
+                    filters=[('location_id', 'in', cbsl_ids)],
+                )
+                new_cbsl_ids = np.setdiff1d(cbsl_ids, a_df['location_id'])
+                if len(a_df) > 0:
+                    writer.write(a_df)
+                print("done")
+            # Extract records from each state individually, unless no BSLs
+            # are left to extract
+            extract_states = states if len(new_cbsl_ids) > 0 else []
+            for state_id in extract_states:
+                print(end=f"    State: {state_id}", flush=True)
+                # Load availability records of challenging BSLs for the pair
+                # <as_of_date, state>, one chunk of records at a time
+                chunks = iter_cbsl_records(f"{aod_path}/{state_id}",
+                                           new_cbsl_ids, memory_budget)
+                for a_df in chunks:
+                    print(end=".", flush=True)
+                    # Write (partial) challenging BSL data to file
+                    writer.write(a_df)
+                print("done")
+                # break
+            # Write an empty table if no state has challenging BSLs, so that
+            # the table exists (and replaces any table written before)
+            if writer.records == 0 and states:
+                writer.write(
+                    empty_availability_records(f"{aod_path}/{states[0]}")
+                )
+        write_cbsl_digest(aod_save_path, cbsl_ids)
         # break
 
 
 if __name__ == "__main__":
     availability_source = "data/processed/bdc/availability/fixed/"
     challenge_source_fn = "data/processed/bdc/challenge/fixed_resolved/" \
-                          "challenge.csv"
+                          "challenge"
     destination = "data/processed/bdc/availability/fixed/"
+    # Memory (bytes) to read state files in chunks (None for whole files)
+    memory_budget = 2 * 1024 ** 3
+    # Storage format of the extracted data ('csv' or 'parquet')
+    storage_format = "csv"
 
     extract_challenging_bsl_availability(
         availability_source=availability_source,
         challenge_source_fn=challenge_source_fn,
-        destination=destination
+        destination=destination,
+        memory_budget=memory_budget,
+        storage_format=storage_format,
     )
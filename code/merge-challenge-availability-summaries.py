@@ -3,6 +3,7 @@ import os
 
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 
@@ -32,7 +33,7 @@ def merge_challenge_and_availability_summaries(challenge_source,
         {"desc": "block", "key": "geoid"},
         {"desc": "bsl", "key": "location_id", "desc_a": "cbsl"},
     ]
-    DTYPES = {"geoid": str, "location_id": str}
+    DTYPES = {"geoid": str, "location_id": np.int64}
     # Determine As of Dates in the availability data
     try:
         with open(f'{availability_source}/metadata.json') as f:
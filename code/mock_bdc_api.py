@@ -0,0 +1,424 @@
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import TECHNOLOGIES
+
+# Synthetic catalog served by the mock API
+MOCK_AS_OF_DATES = ["2023-06-30", "2023-12-31", "2024-06-30"]
+MOCK_STATES = [
+    ("01", "Alabama", "AL"),
+    ("11", "District of Columbia", "DC"),
+    ("44", "Rhode Island", "RI"),
+    ("50", "Vermont", "VT"),
+]
+MOCK_TECHNOLOGY_CODES = [10, 40, 50, 60, 61, 70, 71, 72, 0]
+# Columns of the synthetic files
+AVAILABILITY_COLUMNS = [
+    "frn", "provider_id", "brand_name", "location_id", "technology",
+    "max_advertised_download_speed", "max_advertised_upload_speed",
+    "low_latency", "business_residential_code", "state_usps", "block_geoid",
+    "h3_res8_id",
+]
+CHALLENGE_COLUMNS = [
+    "challenge_id", "location_id", "location_state", "data_vintage", "frn",
+    "provider_id", "provider_brand_name", "holding_company_name",
+    "technology", "category_code", "category_code_desc", "request_date",
+    "request_method_code_desc", "date_received", "withdraw_date", "outcome",
+    "adjudication_date", "adjudication_code", "adjudication_code_desc",
+]
+CHALLENGE_OUTCOMES = [
+    "Challenge Upheld - Provider Conceded",
+    "Challenge Upheld - Service Change",
+    "Challenge Upheld - Adjudicated by FCC",
+    "Challenge Overturned",
+    "Challenge Withdrawn",
+]
+# Number of distinct BSLs per state
+BSLS_PER_STATE = 100000
+# Size of the chunks written to throttled connections (bytes)
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def _location_block_geoid(state_fips, location_index, as_of_date):
+    """Determines the (synthetic) block GEOID of a BSL. A few BSLs 'move'
+    across As of Dates."""
+    seed = f"{state_fips}-{location_index}"
+    if location_index % 97 == 0:
+        seed = f"{seed}-{as_of_date}"
+    rnd = random.Random(seed)
+    return f"{state_fips}{rnd.randint(1, 9) * 2 - 1:03d}" \
+           f"{rnd.randint(100, 120):04d}{rnd.randint(0, 3):02d}" \
+           f"{rnd.randint(1, 3)}{rnd.randint(0, 40):03d}"
+
+
+def generate_availability_csv(state, technology_code, as_of_date, n_rows,
+                              seed):
+    """Generates the CSV contents of a synthetic availability file.
+
+    Args:
+        state: (state_fips, state_name, state_usps) tuple of the file.
+
+        technology_code: Technology code of the file.
+
+        as_of_date: As of Date (YYYY-MM-DD) of the file.
+
+        n_rows: Number of availability records in the file.
+
+        seed: Seed of the random number generator.
+
+    Returns:
+        The CSV contents as a string.
+    """
+    state_fips, _, state_usps = state
+    rnd = random.Random(seed)
+    out = io.StringIO()
+    out.write(",".join(AVAILABILITY_COLUMNS) + "\n")
+    locations = rnd.sample(range(BSLS_PER_STATE), min(n_rows, BSLS_PER_STATE))
+    for location_index in locations:
+        provider = rnd.randint(0, 19)
+        location_id = 1000000000 + int(state_fips) * 10000000 \
+            + location_index
+        block_geoid = _location_block_geoid(state_fips, location_index,
+                                            as_of_date)
+        out.write(
+            f"{provider:010d},{130000 + provider},Provider {provider},"
+            f"{location_id},{technology_code},"
+            f"{rnd.choice([0, 10, 25, 100, 300, 1000, 2000])},"
+            f"{rnd.choice([0, 1, 3, 20, 100, 1000])},"
+            f"{rnd.choice([0, 1, 1, 1])},{rnd.choice(['R', 'B', 'X', 'X'])},"
+            f"{state_usps},{block_geoid},"
+            f"88{rnd.randrange(16 ** 7):07x}fffffff\n"
+        )
+    return out.getvalue()
+
+
+def generate_challenge_csv(state, as_of_date, n_rows, seed):
+    """Generates the CSV contents of a synthetic resolved challenge file.
+
+    Args:
+        state: (state_fips, state_name, state_usps) tuple of the file.
+
+        as_of_date: As of Date (YYYY-MM-DD) of the file.
+
+        n_rows: Number of challenge records in the file.
+
+        seed: Seed of the random number generator.
+
+    Returns:
+        The CSV contents as a string.
+    """
+    state_fips, _, state_usps = state
+    rnd = random.Random(seed)
+    out = io.StringIO()
+    out.write(",".join(CHALLENGE_COLUMNS) + "\n")
+    for _ in range(n_rows):
+        provider = rnd.randint(0, 19)
+        # Challenges are resolved again (with a later date) in later files
+        challenge_id = int(state_fips) * 10000000 + rnd.randrange(n_rows * 2)
+        location_id = 1000000000 + int(state_fips) * 10000000 \
+            + rnd.randrange(BSLS_PER_STATE)
+        outcome = rnd.choice(CHALLENGE_OUTCOMES)
+        category_code = rnd.choice([1, 2, 3, 4, 5, 6, 8, 9])
+        out.write(
+            f"{challenge_id},{location_id},{state_usps},June 2023,"
+            f"{provider:010d},{130000 + provider},Provider {provider},"
+            f"Holding {provider // 4},"
+            f"{rnd.choice(MOCK_TECHNOLOGY_CODES)},{category_code},"
+            f"Category {category_code},2023-07-01,Web Form,2023-07-02,,"
+            f"{outcome},{as_of_date[:8]}{rnd.randint(1, 28):02d},"
+            f"{outcome[:1]},{outcome}\n"
+        )
+    return out.getvalue()
+
+
+def zip_csv(name, csv_contents):
+    """Compresses CSV contents into a (deterministic) ZIP file.
+
+    Args:
+        name: Name of the CSV file inside the ZIP file (without extension).
+
+        csv_contents: CSV contents as a string.
+
+    Returns:
+        The ZIP file as bytes.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        info = zipfile.ZipInfo(f"{name}.csv", (2024, 1, 1, 0, 0, 0))
+        zf.writestr(info, csv_contents, zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+
+def build_catalog(as_of_dates=MOCK_AS_OF_DATES, states=MOCK_STATES,
+                  technology_codes=MOCK_TECHNOLOGY_CODES):
+    """Builds the catalog of files served by the mock API.
+
+    Args:
+        as_of_dates: As of Dates (YYYY-MM-DD) with data.
+
+        states: List of (state_fips, state_name, state_usps) tuples with data.
+
+        technology_codes: Technology codes with availability data.
+
+    Returns:
+        A dict with the 'as_of_dates', the per-As of Date 'listings' of each
+        data type, and the 'files' (file_id: description) served by the API.
+    """
+    catalog = {
+        'as_of_dates': list(as_of_dates),
+        'listings': {'availability': {}, 'challenge': {}},
+        'files': {},
+    }
+    file_id = 100000
+    for as_of_date in as_of_dates:
+        availability_files = []
+        challenge_files = []
+        for state in states:
+            state_fips, state_name, _ = state
+            for technology_code in technology_codes:
+                file_id = file_id + 1
+                technology_desc = TECHNOLOGIES[technology_code].split("] ")[1]
+                availability_files.append({
+                    "file_id": str(file_id),
+                    "category": "State",
+                    "subcategory": "Fixed Broadband",
+                    "technology_code": str(technology_code),
+                    "technology_code_desc": technology_desc,
+                    "state_fips": state_fips,
+                    "state_name": state_name,
+                    "file_type": "csv",
+                    "file_name": f"bdc_{state_fips}_{technology_code}"
+                                 f"_fixed_broadband_{as_of_date}",
+                })
+                catalog['files'][str(file_id)] = \
+                    ('availability', as_of_date, state, technology_code)
+            file_id = file_id + 1
+            challenge_files.append({
+                "file_id": str(file_id),
+                "category": "Fixed Challenge - Resolved",
+                "state_fips": state_fips,
+                "state_name": state_name,
+                "file_type": "csv",
+                "file_name": f"bdc_{state_fips}_fixed_challenge_resolved"
+                             f"_{as_of_date}",
+            })
+            catalog['files'][str(file_id)] = \
+                ('challenge', as_of_date, state, None)
+        catalog['listings']['availability'][as_of_date] = availability_files
+        catalog['listings']['challenge'][as_of_date] = challenge_files
+    return catalog
+
+
+class MockBDCRequestHandler(BaseHTTPRequestHandler):
+    """Handles requests to the mock BDC API. The configuration and catalog
+    are attributes of the server (see start_mock_server)."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_body(self, body, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        # Throttle the connection to the configured bandwidth
+        bandwidth = self.server.bandwidth
+        for i in range(0, len(body), WRITE_CHUNK_SIZE):
+            chunk = body[i:i + WRITE_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+
+    def _send_json(self, data):
+        self._send_body(json.dumps({"data": data}).encode())
+
+    def _send_error(self, status, headers=None):
+        self._send_body(b"", status=status, headers=headers)
+
+    def do_GET(self):
+        server = self.server
+        server.record_request()
+        if server.latency:
+            time.sleep(server.latency)
+        # Inject throttling and server errors
+        if server.random() < server.error_rate:
+            if server.random() < 0.5:
+                retry_after = str(server.retry_after)
+                return self._send_error(429, {"Retry-After": retry_after})
+            return self._send_error(503)
+        parts = self.path.strip("/").split("/")
+        catalog = server.catalog
+        if parts[-1] == "listAsOfDates":
+            return self._send_json([
+                {"data_type": data_type, "as_of_date": f"{aod}T00:00:00"}
+                for aod in catalog['as_of_dates']
+                for data_type in ["availability", "challenge"]
+            ])
+        if len(parts) >= 3 and parts[-3] == "downloads":
+            data_type = {
+                "listAvailabilityData": "availability",
+                "listChallengeData": "challenge",
+            }.get(parts[-2])
+            listings = catalog['listings'].get(data_type, {})
+            if parts[-1] in listings:
+                return self._send_json(listings[parts[-1]])
+        if len(parts) >= 4 and parts[-3] == "downloadFile":
+            if parts[-1] in catalog['files']:
+                return self._send_file(parts[-1])
+        return self._send_error(404)
+
+    def _send_file(self, file_id):
+        body = self.server.file_contents(file_id)
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._send_error(304)
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        status = 200
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and range_header.endswith("-"):
+            start = int(range_header[6:-1])
+            if start >= len(body):
+                return self._send_error(
+                    416, {"Content-Range": f"bytes */{len(body)}"}
+                )
+            headers["Content-Range"] = \
+                f"bytes {start}-{len(body) - 1}/{len(body)}"
+            body = body[start:]
+            status = 206
+        self._send_body(body, status=status, headers=headers)
+
+
+class MockBDCServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the catalog, configuration and request
+    counter of the mock BDC API."""
+
+    daemon_threads = True
+
+    def __init__(self, address, catalog, rows_per_file, latency, bandwidth,
+                 error_rate, retry_after, seed):
+        super().__init__(address, MockBDCRequestHandler)
+        self.catalog = catalog
+        self.rows_per_file = rows_per_file
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.seed = seed
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def record_request(self):
+        with self._lock:
+            self.requests = self.requests + 1
+
+    def file_contents(self, file_id):
+        """Generates (once) and returns the ZIP file with the given id."""
+        with self._lock:
+            if file_id in self._files:
+                return self._files[file_id]
+        data_type, as_of_date, state, technology_code = \
+            self.catalog['files'][file_id]
+        seed = f"{self.seed}-{file_id}"
+        if data_type == 'availability':
+            csv_contents = generate_availability_csv(
+                state, technology_code, as_of_date, self.rows_per_file, seed
+            )
+        else:
+            csv_contents = generate_challenge_csv(
+                state, as_of_date, max(self.rows_per_file // 100, 1), seed
+            )
+        contents = zip_csv(f"file_{file_id}", csv_contents)
+        with self._lock:
+            self._files[file_id] = contents
+        return contents
+
+
+def start_mock_server(host="127.0.0.1", port=0, catalog=None,
+                      rows_per_file=1000, latency=0.0, bandwidth=None,
+                      error_rate=0.0, retry_after=1, seed=0):
+    """Starts a local stand-in for the FCC Broadband Map API in a background
+    thread. It implements the listAsOfDates, listAvailabilityData,
+    listChallengeData and downloadFile endpoints with synthetic ZIP payloads,
+    and supports Range requests and ETag-based conditional requests.
+
+    Args:
+        host: Host name to bind the server to.
+
+        port: Port to bind the server to (0 picks a free port).
+
+        catalog: Catalog of files to serve (see build_catalog). Defaults to
+        the MOCK_* As of Dates, states and technologies.
+
+        rows_per_file: Number of records in each availability file (challenge
+        files have 1% of it).
+
+        latency: Delay (seconds) added to every request.
+
+        bandwidth: Maximum transfer rate (bytes/s) of each connection, or None
+        for no limit.
+
+        error_rate: Fraction of requests answered with 429 (with a
+        Retry-After header) or 503 errors.
+
+        retry_after: Seconds sent in the Retry-After header of 429 errors.
+
+        seed: Seed of the synthetic data and of the injected errors.
+
+    Returns:
+        The running MockBDCServer. Its API URL is
+        f"http://{host}:{server.server_port}", and server.shutdown() stops it.
+    """
+    if catalog is None:
+        catalog = build_catalog()
+    server = MockBDCServer(
+        (host, port),
+        catalog=catalog,
+        rows_per_file=rows_per_file,
+        latency=latency,
+        bandwidth=bandwidth,
+        error_rate=error_rate,
+        retry_after=retry_after,
+        seed=seed,
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    host = "127.0.0.1"
+    port = 8080
+    # Synthetic data and network conditions
+    rows_per_file = 1000
+    latency = 0.05
+    bandwidth = 10 * 1024 * 1024
+    error_rate = 0.0
+
+    server = start_mock_server(
+        host=host,
+        port=port,
+        rows_per_file=rows_per_file,
+        latency=latency,
+        bandwidth=bandwidth,
+        error_rate=error_rate,
+    )
+    print(f"Serving the mock BDC API at http://{host}:{port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
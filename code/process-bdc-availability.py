@@ -3,28 +3,70 @@ import os
 
 from pathlib import Path
 
-import pandas as pd
+from storage_utils import check_storage_format, delete_table, find_table
+from utils import available_memory, cbsl_part_path, concat_cbsl_tables, \
+    consolidate_availability_files, estimate_augment_memory, \
+    read_challenged_location_ids, run_in_process_pool
 
-from utils import AVAILABILITY_DTYPES, RELIABLE_TECHNOLOGY_CODES
 
-
-def consolidate_and_agument_availability_data(source, destination):
+def consolidate_and_agument_availability_data(source, destination,
+                                              max_workers=1,
+                                              memory_budget=None,
+                                              process_memory_budget=None,
+                                              storage_format="csv",
+                                              n_buckets=None,
+                                              challenge_source=None):
     """First, consolidates availability data across technology files for each
     <as_of_date, state> pair. Second, augments availability data with geoIDs at
     different geographic levels (e.g., states, counties) and with the service
     status (i.e., unserved, underserved, served).
 
+    Pairs are independent, so they can be processed in parallel by a pool of
+    processes. Large states are started first, and only as many of them run
+    concurrently as fit within the memory budget. The consolidated files are
+    identical regardless of the number of processes.
+
+    Files can also be streamed in chunks of records, bounding the memory used
+    by each process regardless of the size of the files.
+
+    Optionally, the availability records of the BSLs engaged in at least one
+    challenge are written to the challenging BSL availability table (cbsl) of
+    each As of Date in the same pass, so that they need not be extracted from
+    the consolidated files later (see extract-cbsl-availability.py).
+
     Args:
         source: Directory where the availability data is stored.
 
         destination: Directory to save the consolidated and augmented
         availability data.
+
+        max_workers: Number of processes consolidating pairs concurrently. If
+        1, pairs are consolidated serially in the current process.
+
+        memory_budget: Maximum memory (bytes) to be used by the processes
+        concurrently, as estimated from the size of the files of each pair.
+        Defaults to the memory available when processing starts.
+
+        process_memory_budget: Memory (bytes) each process may use to hold the
+        records being augmented. If given, files are read, augmented, and
+        written in chunks of as many records as fit in it. Otherwise, files
+        are loaded whole.
+
+        storage_format: Storage format of the consolidated data, i.e., 'csv'
+        or 'parquet' (typed and compressed columns, see storage_utils).
+
+        n_buckets: Number of buckets the consolidated data of each pair is
+        split into by location_id, each sorted by location_id (see
+        storage_utils.BucketedTableWriter), or None for a single (unsorted)
+        file per pair.
+
+        challenge_source: Directory where the (raw) challenge data is stored,
+        whose challenged BSLs are written to the challenging BSL availability
+        table of each As of Date consolidated, or None for no such table.
     """
+    check_storage_format(storage_format)
     # Create destination directory
     os.makedirs(destination, exist_ok=True)
-    # Define auxiliary variables
-    GEOS = ['state', 'county', 'tract', 'block_group']
-    GEOID_LENS = [2, 5, 11, 12]
     # Determine As of Dates in the availability data
     try:
         with open(f'{source}/metadata.json') as f:
@@ -36,7 +78,23 @@ def consolidate_and_agument_availability_data(source, destination):
     # Save availability data metadata to destination directory
     with open(f"{destination}/metadata.json", 'w') as f:
         json.dump(aods_md, f, indent=4)
-    # Consolidate data for each as_of_date separately
+    # Determine the challenged BSLs (if any)
+    cbsl_ids = None
+    if challenge_source is not None:
+        print(end="Loading challenged BSLs...", flush=True)
+        try:
+            cbsl_ids = read_challenged_location_ids(challenge_source)
+            print("done")
+        except FileNotFoundError:
+            print("Could not find the challenge data. Skipping challenging"
+                  " BSL availability.")
+        except ValueError as e:
+            print(f"Could not read the challenged BSLs ({e}). Skipping"
+                  " challenging BSL availability.")
+    # Determine the <as_of_date, state> pairs to consolidate
+    tasks = []
+    cbsl_aods = {}
+    complete = True
     for as_of_date in as_of_dates:
         print(f"As of Date: {as_of_date}")
         aod_path = f"{source}/{as_of_date}/"
@@ -50,7 +108,8 @@ def consolidate_and_agument_availability_data(source, destination):
         except FileNotFoundError:
             print("Could not find the metadata file for as_of_date"
                   f"{as_of_date}.")
-            return
+            complete = False
+            break
         states = sorted(aod_md['states'])
         # Save as_of_date metadata to destination directory
         with open(f"{aod_save_path}/metadata.json", "w") as f:
@@ -59,75 +118,93 @@ def consolidate_and_agument_availability_data(source, destination):
         # as_of_date
         skip = False
         for state in states:
-            if Path(f"{aod_save_path}/{state}.csv").is_file():
+            if find_table(f"{aod_save_path}/{state}") is not None:
                 skip = True
                 break
         if skip:
             print("One or more consolidated files already exist. Skipping")
             continue
-        # Consolidate data for each pair <as_of_date, state> in a separate file
         for state_id in states:
-            print(f"    State: {state_id}")
             state_path = f"{aod_path}/{state_id}/"
-            state_save_fn = f"{aod_save_path}/{state_id}.csv"
+            state_save_path = f"{aod_save_path}/{state_id}"
             # Determine technology files in the state
             try:
                 with open(f"{state_path}/metadata.json") as f:
                     smd = json.load(f)
             except FileNotFoundError:
                 print(f"Could not find the metadata file for {state_id}.")
-                return
-            files = smd['files']
-            # Consolidate and augment data on a per-file basis
-            for fmd in files:
-                print(end=f"        File: {fmd['file_name']}", flush=True)
-                file_path = f"{state_path}/{fmd['file_name']}.zip"
-                # Load dataframe from file
-                file_df = pd.read_csv(file_path, dtype=AVAILABILITY_DTYPES)
-                print(end=".", flush=True)
-                # Determine GeoIDs at different geographic levels
-                for geo, geoid_len in zip(GEOS, GEOID_LENS):
-                    if geo not in ["block_geoid"]:
-                        file_df[f"{geo}_geoid"] = file_df['block_geoid'].apply(
-                            lambda x: str(x)[:geoid_len] if x else x
-                        )
-                print(end=".", flush=True)
-                # Determine the service statuses of each availability record
-                unserved_index = \
-                    (~file_df.technology.isin(RELIABLE_TECHNOLOGY_CODES)) | \
-                    (file_df.business_residential_code.isin(['B'])) | \
-                    (file_df.max_advertised_download_speed < 25) | \
-                    (file_df.max_advertised_upload_speed < 3) | \
-                    (file_df.low_latency == 0)
-                underserved_index = \
-                    ~unserved_index & (
-                        (file_df.max_advertised_download_speed < 100) |
-                        (file_df.max_advertised_upload_speed < 20) |
-                        (file_df.low_latency == 0)
-                    )
-                served_index = ~unserved_index & ~underserved_index
-                file_df.loc[unserved_index, 'status'] = 2  # Unserved
-                file_df.loc[underserved_index, 'status'] = 1  # Underserved
-                file_df.loc[served_index, 'status'] = 0  # Served
-                print(end=".", flush=True)
-                # Write (partial) augmented data to file
-                file_df.to_csv(
-                    state_save_fn,
-                    index=False,
-                    mode='a',
-                    header=not Path(state_save_fn).is_file(),
-                )
-                print("done")
-                # break
-            # break
-        # break
+                complete = False
+                break
+            file_paths = [
+                f"{state_path}/{fmd['file_name']}.zip" for fmd in smd['files']
+            ]
+            # Delete challenging BSL tables left by interrupted runs
+            if cbsl_ids is not None:
+                delete_table(cbsl_part_path(state_save_path))
+            tasks.append((
+                (file_paths, state_save_path, process_memory_budget,
+                 storage_format, n_buckets, cbsl_ids),
+                estimate_augment_memory(file_paths, process_memory_budget),
+            ))
+        if not complete:
+            break
+        if cbsl_ids is not None and states:
+            cbsl_aods[aod_save_path] = [
+                f"{aod_save_path}/{state_id}" for state_id in states
+            ]
+    # Consolidate data for each pair <as_of_date, state> in a separate file
+    print(f"Consolidating {len(tasks)} <as_of_date, state> pairs")
+    if max_workers == 1:
+        results = (
+            (args, consolidate_availability_files(*args))
+            for args, _ in tasks
+        )
+    else:
+        if memory_budget is None:
+            memory_budget = available_memory()
+        results = run_in_process_pool(
+            consolidate_availability_files,
+            tasks,
+            max_workers=max_workers,
+            memory_budget=memory_budget,
+        )
+    for (file_paths, state_save_path, *_), n_records in results:
+        print(f"    {Path(state_save_path).parent.name}/"
+              f"{Path(state_save_path).name}: {len(file_paths)} files,"
+              f" {n_records} records...done")
+    # Concatenate the challenging BSL availability records of the states of
+    # each As of Date consolidated
+    for aod_save_path, state_save_paths in cbsl_aods.items():
+        print(end=f"    {Path(aod_save_path).name}/cbsl...", flush=True)
+        concat_cbsl_tables(state_save_paths, aod_save_path, cbsl_ids,
+                           storage_format)
+        print("done")
 
 
 if __name__ == "__main__":
     source = "data/raw/bdc/availability/fixed/"
     destination = "data/processed/bdc/availability/fixed/"
+    # Number of processes consolidating <as_of_date, state> pairs concurrently
+    max_workers = os.cpu_count()
+    # Memory (bytes) available to the processes (None for available memory)
+    memory_budget = None
+    # Memory (bytes) per process to read files in chunks (None for whole files)
+    process_memory_budget = 2 * 1024 ** 3
+    # Storage format of the consolidated data ('csv' or 'parquet')
+    storage_format = "csv"
+    # Number of location_id buckets of the consolidated data (None for none)
+    n_buckets = None
+    # Directory of the challenge data whose challenged BSLs are extracted in
+    # the same pass (None for extract-cbsl-availability.py to extract them)
+    challenge_source = "data/raw/bdc/challenge/fixed_resolved/"
 
     consolidate_and_agument_availability_data(
         source=source,
         destination=destination,
+        max_workers=max_workers,
+        memory_budget=memory_budget,
+        process_memory_budget=process_memory_budget,
+        storage_format=storage_format,
+        n_buckets=n_buckets,
+        challenge_source=challenge_source,
     )
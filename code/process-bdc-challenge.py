@@ -3,28 +3,153 @@ import os
 
 from pathlib import Path
 
-import numpy as np
 import pandas as pd
-import us
+
+from storage_utils import check_storage_format, find_table, read_table, \
+    write_table
+from utils import CHALLENGE_PROVIDER_COLUMNS, COMPACT_CHALLENGE_DTYPES, \
+    STATE_ABBRS, apply_dtypes, available_memory, bsl_index_path, \
+    challenge_state_geoids, check_provider_keys, determine_outcome_codes, \
+    latest_challenges, lookup_bsl_index, provider_keys, \
+    provider_table_path, read_bsl_index, read_challenge_files
+
+# File (in the destination directory) recording the challenge files ingested
+INGESTED_FILES_FN = "ingested_files.json"
+# Key of the fingerprint of the BSL geolocation index the ingested challenges
+# were located in (see bsl_index_fingerprint) in the ingested files record
+BSL_INDEX_KEY = "bsl_index"
+
+
+def file_fingerprint(file_path):
+    """Determines the fingerprint of a file (i.e., its size and modification
+    time), which changes whenever the file is downloaded again."""
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def bsl_index_fingerprint(index_path):
+    """Determines the fingerprint of the BSL geolocation index (i.e., the
+    fingerprints of its arrays), which changes whenever the index is written
+    again (e.g., to add the BSLs of new As of Dates), or None if the index
+    does not exist."""
+    if not Path(index_path).is_dir():
+        return None
+    return {
+        name: file_fingerprint(f"{index_path}/{name}")
+        for name in sorted(os.listdir(index_path))
+    }
+
+
+def locate_challenges(challenges, bsl_index):
+    """Looks up the geolocation (i.e., the Census Block GEOID and the As of
+    Date) of the BSLs of challenge records in the BSL geolocation index, and
+    updates their location_state from it.
+
+    Args:
+        challenges: Dataframe with challenge records.
+
+        bsl_index: BSL geolocation index (see utils.read_bsl_index).
+
+    Returns:
+        The challenge records with their 'block_geoid', 'as_of_date' and
+        'location_state' columns updated.
+    """
+    bsls = lookup_bsl_index(bsl_index, challenges['location_id'])
+    challenges = challenges.reset_index(drop=True)
+    challenges['block_geoid'] = bsls['block_geoid']
+    challenges['as_of_date'] = bsls['as_of_date']
+    # Challenges to unknown BSLs have no block_geoid (missing values)
+    challenges = apply_dtypes(challenges, COMPACT_CHALLENGE_DTYPES)
+    # Update location_state from the state GeoID (derived from block_geoid
+    # where available). GEOIDs at levels above the block are derived from
+    # block_geoid when needed (see utils.add_geoids), so they are not stored.
+    challenges['location_state'] = challenge_state_geoids(challenges).map(
+        STATE_ABBRS
+    ).astype("category")
+    return challenges
+
+
+def augment_challenge_data(challenges, bsl_index):
+    """Augments challenge records with outcome codes and the geolocation of
+    their BSLs, and replaces their provider columns with a provider key.
+
+    Args:
+        challenges: Dataframe with (deduplicated) challenge records.
+
+        bsl_index: BSL geolocation index (see utils.read_bsl_index).
+
+    Returns:
+        (challenges, providers) tuple with the augmented challenge records
+        and their provider records.
+    """
+    # Make simpler to determine challenge outcome with outcome code column
+    challenges['outcome_code'] = determine_outcome_codes(challenges)
+    # Look up the location of the challenged BSLs, preserving location_id
+    # keys on challenge data
+    print(end="Looking up BSL location data on location_id...")
+    n_challenges = challenges.shape[0]
+    challenges = locate_challenges(challenges, bsl_index)
+    print("done")
+    # Assert
+    assert challenges.shape[0] == n_challenges, \
+        "There are more challenges in the augmented data than in the" \
+        " original data."
+    # Replace the provider columns with a provider key, storing the providers
+    # in a provider table (see utils.read_providers)
+    challenges['provider_key'] = provider_keys(challenges,
+                                               CHALLENGE_PROVIDER_COLUMNS)
+    providers = check_provider_keys(
+        challenges[['provider_key'] + CHALLENGE_PROVIDER_COLUMNS]
+    )
+    challenges = challenges.drop(columns=CHALLENGE_PROVIDER_COLUMNS)
+    return challenges, providers
 
 
 def consolidate_and_augment_challenge_data(challenge_source,
                                            bsl_source,
-                                           destination):
+                                           destination,
+                                           storage_format="csv",
+                                           max_workers=1,
+                                           memory_budget=None,
+                                           incremental=False):
     """First, consolidates challenge data across As of Datas present in the
     'source' directory combining challenges from all states into a single CSV
     file in the 'destination' directory. Second, augments challenge data with
-    geospatial location data (GEOID and H3).
+    geospatial location data (GEOID and H3). The challenge files ingested are
+    recorded in a file 'ingested_files.json' in the destination directory,
+    together with the fingerprint of the BSL geolocation index they were
+    located in.
 
     Args:
         challenge_source: Directory where the challenge data is stored.
 
-        bsl_source: Directory where the BSL data is stored.
+        bsl_source: Directory where the BSL data (and its index, see
+        utils.bsl_index_path) is stored.
 
         destination: Directory to save the consolidated and augmented challenge
         data.
+
+        storage_format: Storage format of the consolidated challenge data
+        ('csv' or 'parquet').
+
+        max_workers: Number of processes reading challenge files
+        concurrently. If 1, files are read in the current process.
+
+        memory_budget: Maximum memory (bytes) to be used by the processes
+        concurrently, as estimated from the (uncompressed) file sizes.
+        Defaults to the memory available when reading starts.
+
+        incremental: Whether to update existing consolidated challenge data
+        by merging in only the challenge files not ingested yet (i.e., new or
+        downloaded again), keeping the record with the latest adjudication
+        date of each challenge. Only the records of those files are
+        augmented, unless the BSL geolocation index changed since the last
+        run, in which case every consolidated challenge is located again.
+        Otherwise, nothing is done if the file already exists.
     """
-    if Path(f"{destination}/challenge.csv").is_file():
+    check_storage_format(storage_format)
+    challenge_path = f"{destination}/challenge"
+    if find_table(challenge_path) is not None and not incremental:
         print("Consolidated file already exists. Nothing to do.")
         return
     # CONSOLIDATE
@@ -35,9 +160,22 @@ def consolidate_and_augment_challenge_data(challenge_source,
     except FileNotFoundError:
         print("Could not find the As of Dates metadata file.")
         return
+    # Load the record of the challenge files ingested into the consolidated
+    # data (if any)
+    ingested_fn = f"{destination}/{INGESTED_FILES_FN}"
+    ingested = {}
+    if find_table(challenge_path) is not None:
+        try:
+            with open(ingested_fn) as f:
+                ingested = json.load(f)
+        except FileNotFoundError:
+            pass
+    ingested_index = ingested.pop(BSL_INDEX_KEY, None)
 
-    # Load every challenge file and concatenate into a single dataframe.
-    challenges = pd.DataFrame()
+    # Determine the challenge file of every state in every As of Date not
+    # ingested yet
+    file_paths = []
+    files = {}
     as_of_dates = sorted(aods_md['as_of_dates'])
     for as_of_date in as_of_dates:
         print(f"As of Date: {as_of_date}")
@@ -55,80 +193,93 @@ def consolidate_and_augment_challenge_data(challenge_source,
             print(f"    State: {state_id}")
             state_filename = f"{aod_path}/{state_id}.zip"
             if Path(state_filename).is_file():
-                state_df = pd.read_csv(
-                    state_filename,
-                    dtype=str,
-                    low_memory=False,
-                )
-                challenges = pd.concat([challenges, state_df],
-                                       ignore_index=True)
+                file_key = f"{as_of_date}/{state_id}"
+                files[file_key] = {
+                    'as_of_date': as_of_date,
+                    'state': state_id,
+                    **file_fingerprint(state_filename),
+                }
+                if ingested.get(file_key) != files[file_key]:
+                    file_paths.append(state_filename)
             else:
                 print(f"Could not find the data file for state {state_id}.")
                 return
-    # Remove challenge duplicates, keeping the entry with the latest adj date
-    challenges = challenges.sort_values(by='adjudication_date')
-    challenges = challenges.drop_duplicates(subset='challenge_id', keep='last')
-    # AUGMENT
-    # Make simpler to determine challenge outcome with outcome code column
-    upheld_oc = [
-        'Challenge Upheld - Provider Conceded',
-        'Challenge Upheld - Service Change',
-        'Challenge Upheld - Adjudicated by FCC',
-    ]
-    overturned_oc = ['Challenge Overturned']
-    withdrawn_oc = ['Challenge Withdrawn']
-    upheld_index = challenges['outcome'].isin(upheld_oc)
-    challenges.loc[upheld_index, 'outcome_code'] = 0  # Upheld
-    overturned_index = challenges['outcome'].isin(overturned_oc)
-    challenges.loc[overturned_index, 'outcome_code'] = 1  # Overtuned
-    withdrawn_index = challenges['outcome'].isin(withdrawn_oc)
-    challenges.loc[withdrawn_index, 'outcome_code'] = 2  # Withdrawn
-    challenges['outcome_code'] = challenges['outcome_code'].astype(np.int8)
-    # Load BSL location data
-    print(end="Loading consolidated BSL location data...")
-    filename = f"{bsl_source}/bsl_geolocation.csv"
-    bsls = pd.read_csv(filename, dtype=str, low_memory=False)
-    print("done")
-    # Join dataframes preserving location_id keys on challenge data
-    print(end="Merging data on location_id...")
-    n_challenges = challenges.shape[0]
-    challenges = pd.merge(
-        left=challenges,
-        right=bsls,
-        how="left",
-        on="location_id",
-    )
-    # Determine state-, county-, tract-, and block-group-level GeoIDs
-    geos = ['state', 'county', 'tract', 'block_group']
-    lens = [2, 5, 11, 12]
-    for geo, length in zip(geos, lens):
-        if f"{geo}_geoid" not in list(challenges.columns):
-            challenges[f"{geo}_geoid"] = challenges['block_geoid'].apply(
-                lambda x: str(x)[:length] if x else x
-            )
-    # Add state_geoid to challenges without block_geoid based on the
-    # location_state state abbreviation
-    STATES = us.STATES_AND_TERRITORIES + [us.states.DC]
-    abbr2fips = us.states.mapping('abbr', 'fips', states=STATES)
-    challenges.loc[challenges.block_geoid.isna(), 'state_geoid'] = \
-        challenges[challenges.block_geoid.isna()].location_state.apply(
-            lambda x: abbr2fips[x]
+    # The consolidated challenges must be located again if the BSL
+    # geolocation index changed since they were located (e.g., BSLs of new As
+    # of Dates were added to it)
+    index_path = bsl_index_path(f"{bsl_source}/bsl_geolocation")
+    index_fingerprint = bsl_index_fingerprint(index_path)
+    relocate = bool(ingested) and ingested_index != index_fingerprint
+    if not file_paths and not relocate:
+        print("No new challenge files. Nothing to do.")
+        return
+    # Open the (memory-mapped) BSL location index
+    bsl_index = read_bsl_index(index_path)
+    if bsl_index is None:
+        print("Could not find the BSL geolocation index.")
+        return
+    # Load the consolidated challenges (and their providers), if any,
+    # locating them again if the BSL geolocation index changed
+    provider_path = provider_table_path(challenge_path)
+    c_dfs = []
+    p_dfs = []
+    if ingested:
+        print(end="Loading the consolidated data...", flush=True)
+        consolidated = read_table(challenge_path,
+                                  dtype=COMPACT_CHALLENGE_DTYPES)
+        p_dfs.append(read_table(provider_path, dtype=COMPACT_CHALLENGE_DTYPES))
+        print("done")
+        if relocate:
+            print(end="Locating the consolidated data in the updated BSL"
+                      " geolocation index...", flush=True)
+            consolidated = locate_challenges(consolidated, bsl_index)
+            print("done")
+        c_dfs.append(consolidated)
+    if file_paths:
+        # Load every challenge file (in parallel) and concatenate them into a
+        # single dataframe at once
+        print(end=f"Loading {len(file_paths)} challenge files...", flush=True)
+        if max_workers > 1 and memory_budget is None:
+            memory_budget = available_memory()
+        challenges = read_challenge_files(
+            file_paths,
+            max_workers=max_workers,
+            memory_budget=memory_budget,
         )
-    print("done")
-    # Update location_state from state_geoid
-    fips2abbr = us.states.mapping('fips', 'abbr', states=STATES)
-    challenges.location_state = challenges.state_geoid.apply(
-        lambda x: fips2abbr[x]
-    )
-    # Assert
-    assert challenges.shape[0] == n_challenges, \
-        "There are more challenges in the augmented data than in the" \
-        " original data."
-    # Save augmented dataframe to file
+        print("done")
+        # Remove challenge duplicates, keeping the entry with the latest adj
+        # date
+        challenges = latest_challenges(challenges)
+        # AUGMENT
+        challenges, providers = augment_challenge_data(challenges, bsl_index)
+        c_dfs.append(challenges)
+        p_dfs.append(providers)
+    # Merge the new challenges (and their providers) into the consolidated
+    # data (if any), keeping the entry with the latest adj date
+    if len(c_dfs) > 1:
+        print(end="Merging into the consolidated data...", flush=True)
+        challenges = pd.concat(c_dfs, ignore_index=True)
+        challenges = latest_challenges(challenges)
+        challenges = apply_dtypes(challenges, COMPACT_CHALLENGE_DTYPES)
+        providers = check_provider_keys(pd.concat(p_dfs, ignore_index=True))
+        print("done")
+    else:
+        challenges = c_dfs[0]
+        providers = p_dfs[0]
+    # Save augmented dataframe (and its providers) to file, and record the
+    # files ingested
     print(end="Saving the consolidated and augmented dataframe to file...")
-    filename = f"{destination}/challenge.csv"
-    os.makedirs(destination, exist_ok=True)
-    challenges.to_csv(filename, index=False)
+    os.makedirs(os.path.dirname(provider_path), exist_ok=True)
+    write_table(providers, provider_path, storage_format)
+    write_table(challenges, challenge_path, storage_format)
+    with open(f"{ingested_fn}.part", "w") as f:
+        json.dump(
+            {**ingested, **files, BSL_INDEX_KEY: index_fingerprint},
+            f,
+            indent=4,
+            sort_keys=True,
+        )
+    os.replace(f"{ingested_fn}.part", ingested_fn)
     print("done")
 
 
@@ -136,9 +287,18 @@ if __name__ == "__main__":
     challenge_source = "data/raw/bdc/challenge/fixed_resolved/"
     bsl_source = "data/processed/bdc/availability/fixed/"
     destination = "data/processed/bdc/challenge/fixed_resolved/"
+    # Storage format of the consolidated challenge data ('csv' or 'parquet')
+    storage_format = "csv"
+    # Number of processes reading challenge files (one per CPU core)
+    max_workers = os.cpu_count()
+    # Merge challenge files not ingested yet into existing consolidated data
+    incremental = True
 
     consolidate_and_augment_challenge_data(
         challenge_source=challenge_source,
         bsl_source=bsl_source,
         destination=destination,
+        storage_format=storage_format,
+        max_workers=max_workers,
+        incremental=incremental,
     )
@@ -0,0 +1,635 @@
+import json
+import operator
+import os
+import shutil
+import zipfile
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet storage is optional
+    pa = None
+    ds = None
+    pq = None
+
+# Storage formats of the processed data (format: file extension), in order of
+# preference when looking up a table
+STORAGE_FORMATS = {
+    "parquet": ".parquet",
+    "csv": ".csv",
+}
+# Parquet compression codec and number of records per row group (the unit
+# skipped by predicate pushdown using the row group statistics)
+PARQUET_COMPRESSION = "zstd"
+PARQUET_ROW_GROUP_SIZE = 1024 * 1024
+# File describing the bucketing of a bucketed table (see BucketedTableWriter)
+BUCKETS_FN = "_buckets.json"
+# Number of records read at a time when bucketing a table (see bucket_table)
+BUCKET_CHUNK_SIZE = 1024 * 1024
+# Filter operators (see read_table) applied to CSV tables
+FILTER_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda column, values: column.isin(values),
+    "not in": lambda column, values: ~column.isin(values),
+}
+
+
+def check_storage_format(storage_format):
+    """Checks that a storage format is known and that its dependencies are
+    installed, raising a ValueError otherwise."""
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown storage format '{storage_format}'.")
+    if storage_format == "parquet" and pq is None:
+        raise ValueError("The 'parquet' storage format requires pyarrow.")
+
+
+def table_path(path, storage_format):
+    """Determines the file path of a table (given by its path without file
+    extension) stored in the given format."""
+    return f"{path}{STORAGE_FORMATS[storage_format]}"
+
+
+def find_table(path):
+    """Determines the file path of a table, given by its path without file
+    extension, whatever the format it is stored in.
+
+    Args:
+        path: Path of the table without file extension (e.g.,
+        '<as_of_date>/<state_id>').
+
+    Returns:
+        The path of the table file (or directory, for bucketed tables), or
+        None if no file exists.
+    """
+    if read_bucketing(path) is not None:
+        return os.path.normpath(path)
+    for storage_format in STORAGE_FORMATS:
+        file_path = table_path(path, storage_format)
+        if Path(file_path).is_file():
+            return file_path
+    return None
+
+
+def read_bucketing(path):
+    """Reads the bucketing of a table, given by its path without file
+    extension (see BucketedTableWriter).
+
+    Returns:
+        Dictionary with the 'column' records are bucketed by, the number of
+        buckets ('n_buckets'), and the 'storage_format' of the buckets, or
+        None if the table is not bucketed.
+    """
+    try:
+        with open(os.path.join(path, BUCKETS_FN)) as f:
+            return json.load(f)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def bucket_path(path, bucket, storage_format):
+    """Determines the file path of a bucket of a bucketed table."""
+    return table_path(os.path.join(path, f"{bucket:04d}"), storage_format)
+
+
+def list_tables(directory):
+    """Lists the tables stored in a directory (in any storage format), sorted
+    by path, as paths without file extension. Temporary (part) files are not
+    tables."""
+    paths = set()
+    if Path(directory).is_dir():
+        for file_path in Path(directory).iterdir():
+            if file_path.is_file() \
+                    and file_path.suffix in STORAGE_FORMATS.values() \
+                    and not file_path.stem.endswith(".part"):
+                paths.add(str(file_path.with_suffix("")))
+    return sorted(paths)
+
+
+def delete_table(path, keep=None):
+    """Deletes the files of a table, given by its path without file extension,
+    in every storage format but the one to keep (if any). Bucketed tables are
+    always deleted."""
+    if read_bucketing(path) is not None:
+        shutil.rmtree(path)
+    for storage_format in STORAGE_FORMATS:
+        file_path = table_path(path, storage_format)
+        if storage_format != keep and Path(file_path).is_file():
+            os.remove(file_path)
+
+
+def resolve_table(path):
+    """Determines the file path of a table given either by its file path or by
+    its path without file extension (see find_table), raising a
+    FileNotFoundError if no file exists."""
+    if Path(path).suffix in [".zip", *STORAGE_FORMATS.values()]:
+        return path
+    file_path = find_table(path)
+    if file_path is None:
+        raise FileNotFoundError(f"Could not find a table file for {path}.")
+    return file_path
+
+
+def estimate_record_size(path, sample_size=1024 * 1024):
+    """Estimates the average size (bytes) of the records of a table. For
+    Parquet tables, it is the uncompressed size of the data per record. For
+    (zipped) CSV tables, it is estimated from a sample of the first records.
+
+    Args:
+        path: Path of the table (see resolve_table).
+
+        sample_size: Number of bytes sampled from the beginning of CSV files.
+
+    Returns:
+        The estimated average record size in bytes.
+    """
+    file_path = resolve_table(path)
+    # Buckets are (hash) samples of the records of bucketed tables
+    bucketing = read_bucketing(file_path)
+    if bucketing is not None:
+        file_path = bucket_path(file_path, 0, bucketing['storage_format'])
+    if file_path.endswith(STORAGE_FORMATS["parquet"]):
+        metadata = pq.ParquetFile(file_path).metadata
+        size = sum(
+            metadata.row_group(i).total_byte_size
+            for i in range(metadata.num_row_groups)
+        )
+        return size / max(metadata.num_rows, 1)
+    if zipfile.is_zipfile(file_path):
+        with zipfile.ZipFile(file_path) as zf:
+            with zf.open(zf.infolist()[0]) as f:
+                sample = f.read(sample_size)
+    else:
+        with open(file_path, 'rb') as f:
+            sample = f.read(sample_size)
+    return len(sample) / max(sample.count(b"\n"), 1)
+
+
+def _parquet_filter(filters):
+    """Converts filters (see read_table) into a pyarrow dataset expression."""
+    if not filters:
+        return None
+    return pq.filters_to_expression([
+        (column, op, list(value) if isinstance(value, (set, frozenset))
+         else value)
+        for column, op, value in filters
+    ])
+
+
+def _cast_parquet_chunk(df, dtype):
+    """Casts the columns of a chunk of a Parquet table stored as strings to the
+    (non-string) data types requested for them, and the ones stored as
+    categoricals to strings if requested, as done when reading CSV."""
+    if isinstance(dtype, dict):
+        for column, column_dtype in dtype.items():
+            if column not in df.columns:
+                continue
+            if column_dtype is not str \
+                    and pd.api.types.is_string_dtype(df[column]):
+                df[column] = df[column].astype(column_dtype)
+            elif column_dtype is str \
+                    and isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(column_dtype)
+    return df
+
+
+def _filter_csv_chunk(df, filters, columns):
+    """Applies filters (see read_table) to a chunk of a CSV table and drops
+    the columns read for filtering only."""
+    if filters:
+        mask = pd.Series(True, index=df.index)
+        for column, op, value in filters:
+            mask = mask & FILTER_OPERATORS[op](df[column], value)
+        df = df[mask]
+    if columns is not None:
+        df = df[[column for column in df.columns if column in columns]]
+    return df
+
+
+def iter_table(path, dtype=None, columns=None, filters=None, chunk_size=None):
+    """Reads a table in chunks of records, so that only one chunk is held in
+    memory at a time. Only the given columns are read and only the records
+    matching the filters are returned. For Parquet tables, both are pushed
+    down to the reader, which skips the row groups whose statistics rule out
+    the filters.
+
+    Args:
+        path: Path of the table (see resolve_table). Raw (zipped) CSV files
+        and bucketed tables (see BucketedTableWriter) are also supported.
+
+        dtype: Data types of the columns (see pd.read_csv). Parquet tables
+        store typed columns, so only their string columns are cast.
+
+        columns: List of the columns to read, or None for all. Columns are
+        returned in the order they are stored.
+
+        filters: List of (column, operator, value) tuples that records must
+        all match, or None. Operators are '==', '!=', '<', '<=', '>', '>=',
+        'in', and 'not in' (with a collection of values).
+
+        chunk_size: Number of records per chunk, or None to read the whole
+        table as a single chunk.
+
+    Yields:
+        Dataframes with consecutive chunks of (matching) records.
+    """
+    file_path = resolve_table(path)
+    bucketing = read_bucketing(file_path)
+    if bucketing is not None:
+        yield from _iter_bucketed_table(file_path, bucketing, dtype, columns,
+                                        filters, chunk_size)
+        return
+    if file_path.endswith(STORAGE_FORMATS["parquet"]):
+        dataset = ds.dataset(file_path, format="parquet")
+        if columns is not None:
+            columns = [
+                column for column in dataset.schema.names if column in columns
+            ]
+        expression = _parquet_filter(filters)
+        if chunk_size is None:
+            table = dataset.to_table(columns=columns, filter=expression)
+            yield _cast_parquet_chunk(table.to_pandas(), dtype)
+            return
+        batches = dataset.to_batches(
+            columns=columns,
+            filter=expression,
+            batch_size=chunk_size,
+        )
+        for batch in batches:
+            yield _cast_parquet_chunk(batch.to_pandas(), dtype)
+        return
+    # Read the filtered columns as well to apply the filters
+    usecols = None
+    if columns is not None:
+        usecols = list(columns) + [
+            column for column, _, _ in filters or [] if column not in columns
+        ]
+    if chunk_size is None:
+        df = pd.read_csv(file_path, dtype=dtype, usecols=usecols)
+        yield _filter_csv_chunk(df, filters, columns)
+        return
+    with pd.read_csv(file_path, dtype=dtype, usecols=usecols,
+                     chunksize=chunk_size) as reader:
+        for df in reader:
+            yield _filter_csv_chunk(df, filters, columns)
+
+
+def _iter_bucketed_table(path, bucketing, dtype, columns, filters,
+                         chunk_size):
+    """Reads a bucketed table in chunks of records (see iter_table), bucket by
+    bucket. Only the buckets that may hold records matching the '==' and 'in'
+    filters on the bucketing column are read, each filtered by its own
+    values only."""
+    column = bucketing['column']
+    n_buckets = bucketing['n_buckets']
+    filters = list(filters or [])
+    bucket_filters = {bucket: filters for bucket in range(n_buckets)}
+    for i, (filter_column, op, value) in enumerate(filters):
+        if filter_column != column or op not in ["==", "in"]:
+            continue
+        values = np.unique(np.asarray(
+            list(value) if isinstance(value, (set, frozenset)) else value,
+            dtype=np.int64,
+        ).ravel())
+        value_buckets = values % n_buckets
+        bucket_filters = {
+            int(bucket): (
+                bucket_filters[bucket][:i]
+                + [(column, "in", values[value_buckets == bucket])]
+                + bucket_filters[bucket][i + 1:]
+            )
+            for bucket in np.unique(value_buckets)
+            if bucket in bucket_filters
+        }
+    # Read a bucket even if no bucket may match, to return the columns
+    if not bucket_filters:
+        bucket_filters = {0: filters}
+    for bucket, filters in sorted(bucket_filters.items()):
+        yield from iter_table(
+            bucket_path(path, bucket, bucketing['storage_format']),
+            dtype=dtype,
+            columns=columns,
+            filters=filters or None,
+            chunk_size=chunk_size,
+        )
+
+
+def read_table(path, dtype=None, columns=None, filters=None):
+    """Reads a table into a dataframe (see iter_table for the arguments).
+    The buckets of bucketed tables are concatenated, in order, keeping their
+    categorical columns as such."""
+    chunks = list(iter_table(path, dtype=dtype, columns=columns,
+                             filters=filters))
+    if len(chunks) == 1:
+        return chunks[0]
+    df = pd.concat(chunks, ignore_index=True)
+    for column, column_dtype in chunks[0].dtypes.items():
+        if isinstance(column_dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype("category")
+    return df
+
+
+class TableWriter:
+    """Writes a table chunk by chunk into a temporary file, which replaces the
+    table file when the writer is closed. If an error interrupts the writing,
+    the temporary file is deleted and the table file is left untouched.
+
+    Usage:
+        with TableWriter(path, storage_format) as writer:
+            for df in chunks:
+                writer.write(df)
+    """
+
+    def __init__(self, path, storage_format="csv"):
+        """Creates a writer for a table.
+
+        Args:
+            path: Path of the table without file extension.
+
+            storage_format: Storage format of the table (see STORAGE_FORMATS).
+        """
+        check_storage_format(storage_format)
+        self.storage_format = storage_format
+        self.path = table_path(path, storage_format)
+        self.part_path = f"{self.path}.part"
+        self.records = 0
+        self._file = None
+        self._writer = None
+        self._schema = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, df):
+        """Appends the records of a dataframe to the table."""
+        if self.storage_format == "csv":
+            if self._file is None:
+                self._file = open(self.part_path, 'w', newline='')
+            df.to_csv(self._file, index=False,
+                      header=(self._file.tell() == 0))
+        else:
+            table = pa.Table.from_pandas(df, schema=self._schema,
+                                         preserve_index=False)
+            if self._writer is None:
+                # Columns without values in the first chunk are strings, and
+                # categoricals may get more categories in later chunks
+                fields = []
+                for field in table.schema:
+                    if pa.types.is_null(field.type):
+                        field = field.with_type(pa.string())
+                    elif pa.types.is_dictionary(field.type):
+                        field = field.with_type(pa.dictionary(
+                            pa.int32(),
+                            field.type.value_type,
+                        ))
+                    fields.append(field)
+                self._schema = pa.schema(fields,
+                                         metadata=table.schema.metadata)
+                table = table.cast(self._schema)
+                self._writer = pq.ParquetWriter(
+                    self.part_path,
+                    self._schema,
+                    compression=PARQUET_COMPRESSION,
+                )
+            self._writer.write_table(table,
+                                     row_group_size=PARQUET_ROW_GROUP_SIZE)
+        self.records = self.records + len(df)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+        if self._writer is not None:
+            self._writer.close()
+
+    def close(self):
+        """Completes the table, replacing the table file. Files of the table in
+        other formats (or bucketed) are deleted, so that readers never find
+        stale data.
+        Tables without any chunk written are not created."""
+        self._close_file()
+        if Path(self.part_path).is_file():
+            os.replace(self.part_path, self.path)
+            delete_table(self.path[:-len(Path(self.path).suffix)],
+                         keep=self.storage_format)
+
+    def abort(self):
+        """Discards the records written so far."""
+        self._close_file()
+        if Path(self.part_path).is_file():
+            os.remove(self.part_path)
+
+
+def write_table(df, path, storage_format="csv"):
+    """Writes a dataframe to a table (see TableWriter).
+
+    Args:
+        df: Dataframe to write.
+
+        path: Path of the table without file extension.
+
+        storage_format: Storage format of the table (see STORAGE_FORMATS).
+
+    Returns:
+        The path of the table file.
+    """
+    with TableWriter(path, storage_format) as writer:
+        writer.write(df)
+    return writer.path
+
+
+class BucketedTableWriter:
+    """Writes a table bucketed by an integer column chunk by chunk. Records
+    are assigned to buckets by their value of the column modulo the number of
+    buckets (a hash that does not depend on the data), and each bucket is
+    stored as a table sorted by the column, in a directory replacing the
+    table once the writer is closed. Thus, records with given values of the
+    column are found in a few buckets (see iter_table), whose Parquet row
+    groups span narrow ranges of the column. Records are spilled into the
+    buckets as written, so only one bucket is held in memory when sorting.
+
+    Usage:
+        with BucketedTableWriter(path, storage_format, column,
+                                 n_buckets) as writer:
+            for df in chunks:
+                writer.write(df)
+    """
+
+    def __init__(self, path, storage_format="csv", column="location_id",
+                 n_buckets=64, dtype=None):
+        """Creates a writer for a bucketed table.
+
+        Args:
+            path: Path of the table without file extension (i.e., the path of
+            the directory of its buckets).
+
+            storage_format: Storage format of the buckets (see
+            STORAGE_FORMATS).
+
+            column: Integer column records are bucketed and sorted by.
+
+            n_buckets: Number of buckets.
+
+            dtype: Data types of the columns (see pd.read_csv), used to read
+            the spilled records back from CSV files.
+        """
+        check_storage_format(storage_format)
+        self.storage_format = storage_format
+        self.column = column
+        self.n_buckets = n_buckets
+        self.dtype = dtype
+        self.path = os.path.normpath(path)
+        self.part_path = f"{self.path}.part"
+        self.records = 0
+        shutil.rmtree(self.part_path, ignore_errors=True)
+        os.makedirs(self.part_path)
+        self._writers = [
+            TableWriter(f"{self.part_path}/{bucket:04d}.unsorted",
+                        storage_format)
+            for bucket in range(n_buckets)
+        ]
+        self._empty_df = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, df):
+        """Appends the records of a dataframe to the table."""
+        if self._empty_df is None:
+            self._empty_df = df.iloc[:0]
+        buckets = df[self.column].to_numpy() % self.n_buckets
+        for bucket, bucket_df in df.groupby(buckets, sort=False):
+            self._writers[bucket].write(bucket_df)
+        self.records = self.records + len(df)
+
+    def close(self):
+        """Completes the table, sorting every bucket and replacing the table
+        (in any format). Tables without any chunk written are not
+        created."""
+        for writer in self._writers:
+            writer.close()
+        if self._empty_df is None:
+            shutil.rmtree(self.part_path)
+            return
+        for bucket, writer in enumerate(self._writers):
+            if Path(writer.path).is_file():
+                df = read_table(writer.path, dtype=self.dtype)
+                os.remove(writer.path)
+            else:
+                df = self._empty_df
+            write_table(
+                df.sort_values(by=self.column, kind="stable"),
+                f"{self.part_path}/{bucket:04d}",
+                self.storage_format,
+            )
+        with open(f"{self.part_path}/{BUCKETS_FN}", "w") as f:
+            json.dump({
+                'column': self.column,
+                'n_buckets': self.n_buckets,
+                'storage_format': self.storage_format,
+            }, f, indent=4)
+        delete_table(self.path)
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        """Discards the records written so far."""
+        for writer in self._writers:
+            writer.abort()
+        shutil.rmtree(self.part_path, ignore_errors=True)
+
+
+def bucket_table(path, column="location_id", n_buckets=64, dtype=None,
+                 chunk_size=BUCKET_CHUNK_SIZE):
+    """Rewrites a table as a bucketed table (see BucketedTableWriter) in the
+    same storage format, reading it in chunks of records.
+
+    Args:
+        path: Path of the table without file extension.
+
+        column: Integer column records are bucketed and sorted by.
+
+        n_buckets: Number of buckets.
+
+        dtype: Data types of the columns (see pd.read_csv).
+
+        chunk_size: Number of records read at a time.
+
+    Returns:
+        The path of the bucketed table (directory).
+    """
+    file_path = resolve_table(path)
+    bucketing = read_bucketing(file_path)
+    if bucketing is not None:
+        storage_format = bucketing['storage_format']
+    else:
+        storage_format = next(
+            storage_format
+            for storage_format, extension in STORAGE_FORMATS.items()
+            if file_path.endswith(extension)
+        )
+    with BucketedTableWriter(path, storage_format, column, n_buckets,
+                             dtype) as writer:
+        for df in iter_table(file_path, dtype=dtype, chunk_size=chunk_size):
+            writer.write(df)
+    return writer.path
+
+
+def concat_tables(part_paths, path, storage_format="csv"):
+    """Concatenates tables, in the given order, into a single table and
+    deletes them. CSV tables are concatenated as text, keeping the header of
+    the first table only, and Parquet tables are concatenated row group by
+    row group, so records are never parsed from text.
+
+    Args:
+        part_paths: File paths of the tables to concatenate, stored in the
+        given format.
+
+        path: Path of the table without file extension.
+
+        storage_format: Storage format of the tables (see STORAGE_FORMATS).
+
+    Returns:
+        The path of the table file.
+    """
+    if storage_format == "csv":
+        save_path = table_path(path, storage_format)
+        with open(f"{save_path}.part", "wb") as f:
+            for i, part_path in enumerate(part_paths):
+                with open(part_path, "rb") as pf:
+                    # Keep the header of the first table only
+                    if i > 0:
+                        pf.readline()
+                    shutil.copyfileobj(pf, f)
+        os.replace(f"{save_path}.part", save_path)
+        delete_table(path, keep=storage_format)
+    else:
+        with TableWriter(path, storage_format) as writer:
+            for part_path in part_paths:
+                part_file = pq.ParquetFile(part_path)
+                for i in range(part_file.num_row_groups):
+                    writer.write(part_file.read_row_group(i).to_pandas())
+        save_path = writer.path
+    for part_path in part_paths:
+        os.remove(part_path)
+    return save_path
@@ -5,7 +5,9 @@ from pathlib import Path
 
 import pandas as pd
 
-from utils import AVAILABILITY_DTYPES, TECHNOLOGY_CODES, STATUS_CODES
+from storage_utils import read_table
+from utils import COMPACT_AVAILABILITY_DTYPES, TECHNOLOGY_CODES, \
+    STATUS_CODES
 
 
 def summarize_availability_per_challenging_bsl(source, destination):
@@ -38,7 +40,7 @@ def summarize_availability_per_challenging_bsl(source, destination):
     # Summarize each As of Date individually
     for as_of_date in as_of_dates:
         print(f"As of Date: {as_of_date}")
-        aod_fn = f"{source}/{as_of_date}/cbsl.csv"
+        aod_path = f"{source}/{as_of_date}/cbsl"
         aod_save_path = f"{destination}/{as_of_date}/"
         summary_fn = f"{aod_save_path}/cbsl_summary.csv"
         # Create destination directory for As of Date
@@ -50,10 +52,10 @@ def summarize_availability_per_challenging_bsl(source, destination):
         Path(summary_fn).touch()
         # Load availability data for challenging BSLs in the as_of_date
         print(end="    Loading availability data...", flush=True)
-        a_df = pd.read_csv(
-            aod_fn,
-            dtype=AVAILABILITY_DTYPES,
-            usecols=AVAILABILITY_COLS,
+        a_df = read_table(
+            aod_path,
+            dtype=COMPACT_AVAILABILITY_DTYPES,
+            columns=AVAILABILITY_COLS,
         )
         print("done")
         # Determine number of unique BSLs
@@ -5,7 +5,9 @@ from pathlib import Path
 
 import pandas as pd
 
-from utils import AVAILABILITY_DTYPES, TECHNOLOGY_CODES, STATUS_CODES
+from storage_utils import read_table
+from utils import COMPACT_AVAILABILITY_DTYPES, decode_geoids, \
+    join_bsl_data, summarize_availability_data
 
 
 def summarize_availability_per_geographic_unit(source, destination):
@@ -13,7 +15,11 @@ def summarize_availability_per_geographic_unit(source, destination):
     units. The geographic levels under consideration are nation, states/
     territories/DC, counties, and census tracts. The summary data consists of
     counters on the number of availability records and BSLs overall as well as
-    for different access technologies for each geography unit.
+    for different access technologies for each geography unit. Counters are
+    computed for all the Census Blocks at once, with a few grouping
+    operations, and summed up into the counters of the coarser units (see
+    utils.summarize_availability_data), and the nationwide counters are the
+    sum of the state counters.
 
     Args:
         source: Directory where the availability data is stored.
@@ -29,7 +35,6 @@ def summarize_availability_per_geographic_unit(source, destination):
         'technology',
         'status',
     ]
-    AVAILABILITY_COLS = AVAILABILITY_COLS + [f"{geo}_geoid" for geo in GEOS]
     # Determine As of Dates in the availability data
     try:
         with open(f'{source}/metadata.json') as f:
@@ -67,136 +72,31 @@ def summarize_availability_per_geographic_unit(source, destination):
         aod_state_dfs = []
         for state_id in states:
             print(f"    State: {state_id}")
-            state_fn = f"{aod_path}/{state_id}.csv"
             # Load availability data for the pair <as_of_date, state>
             print(end="        Loading availability data...",
                   flush=True)
-            a_df = pd.read_csv(
-                state_fn,
-                dtype=AVAILABILITY_DTYPES,
-                usecols=AVAILABILITY_COLS,
+            a_df = read_table(
+                f"{aod_path}/{state_id}",
+                dtype=COMPACT_AVAILABILITY_DTYPES,
+                columns=AVAILABILITY_COLS,
             )
-            # Order records by service statuses
-            a_df = a_df.sort_values(by="status", ascending=True)
-            # Determine the service status of each BSL
-            bsl_df = a_df.drop(columns='technology').drop_duplicates(
-                subset='location_id', keep='first'
-            )
-            # Determine unique availability records for each pair of
-            # location_id and technology (keeping the record with the best
-            # service status for each pair)
-            unique_pairs_df = a_df.drop_duplicates(
-                subset=['location_id', 'technology'],
-                keep='first',
+            # Join the block GEOIDs of the BSLs (GEOIDs at levels above the
+            # block are their prefixes, see utils.rollup_counts)
+            a_df = join_bsl_data(
+                a_df,
+                f"{aod_path}/{state_id}",
+                columns=['block_geoid'],
             )
             print("done")
-            # Compute Sand write (partial) summary data to file
+            # Compute and write (partial) summary data to file
             print(end="        Computing and writing summary data to files",
                   flush=True)
+            summaries = summarize_availability_data(a_df, GEOS)
             # > For each geography level
             for geo in GEOS:
-                # Compute summary data at this geography level
-                group1_dl = []
-                for geoid, geoid_df in a_df.groupby(f"{geo}_geoid"):
-                    geoid_dict = {'geoid': geoid}
-                    # > Identification and total counts for the unit
-                    geoid_dict['total_records'] = \
-                        int(geoid_df.shape[0])
-                    geoid_dict['total_bsls'] = \
-                        geoid_df.location_id.nunique()
-                    # > Per-service-level record counts
-                    # >> Compute counts
-                    for sc, recs in geoid_df.status.value_counts().items():
-                        col = f"s{int(sc)}_records"
-                        geoid_dict[col] = recs
-                    # > Per-technology and per-technology+service-level record
-                    #   counts
-                    # >> Compute counts
-                    for tc, tc_df in geoid_df.groupby('technology'):
-                        # >>> Technology counts
-                        geoid_dict[f"t{tc}_records"] = tc_df.shape[0]
-                        # >>> Technology+service-level counts
-                        for sc, recs in tc_df.status.value_counts().items():
-                            col = f"t{tc}_s{int(sc)}_records"
-                            geoid_dict[col] = recs
-                    # Add to group1 summary dict list
-                    group1_dl.append(geoid_dict)
-
-                # > Per-service-level BSL counts
-                group2_dl = []
-                for geoid, geoid_df in bsl_df.groupby(f"{geo}_geoid"):
-                    geoid_dict = {'geoid': geoid}
-                    # >> Compute counts
-                    for sc, bsls in geoid_df.status.value_counts().items():
-                        geoid_dict[f"s{int(sc)}_bsls"] = bsls
-                    # Add to group2 summary dict list
-                    group2_dl.append(geoid_dict)
-
-                # > Per-technology and per-technology+service-level BSL counts
-                group3_dl = []
-                for geoid, geoid_df in unique_pairs_df.groupby(f"{geo}_geoid"):
-                    geoid_dict = {'geoid': geoid}
-                    # >> Compute counts
-                    for tc, tc_df in geoid_df.groupby('technology'):
-                        # >>> Technology counts
-                        tcol = f"t{tc}_bsls"
-                        geoid_dict[tcol] = tc_df.shape[0]
-                        # >>> Technology+service-level counts
-                        for sc, bsls in tc_df.status.value_counts().items():
-                            col = f"t{tc}_s{int(sc)}_bsls"
-                            geoid_dict[col] = bsls
-                    # Add to group3 summary dict list
-                    group3_dl.append(geoid_dict)
-
-                # Create dataframe for each group and merge columns
-                group1_df = pd.DataFrame().from_dict(group1_dl)
-                group2_df = pd.DataFrame().from_dict(group2_dl)
-                group3_df = pd.DataFrame().from_dict(group3_dl)
-                summary_df = pd.merge(
-                    left=group1_df,
-                    right=group2_df,
-                    on="geoid",
-                    how="outer",
-                )
-                summary_df = pd.merge(
-                    left=summary_df,
-                    right=group3_df,
-                    on="geoid",
-                    how="outer",
-                )
-                # Make sure all columns are present
-                summary_cols = ['geoid', 'total_records', 'total_bsls']
-                for sc in STATUS_CODES:
-                    for cnt in ['records', 'bsls']:
-                        value_lbl = f"s{int(sc)}_{cnt}"
-                        summary_cols.append(value_lbl)
-                        if value_lbl not in summary_df.columns:
-                            summary_df[value_lbl] = 0
-                for tc in TECHNOLOGY_CODES:
-                    for cnt in ['records', 'bsls']:
-                        value_lbl = f"t{int(tc)}_{cnt}"
-                        summary_cols.append(value_lbl)
-                        if value_lbl not in summary_df.columns:
-                            summary_df[value_lbl] = 0
-                for tc in TECHNOLOGY_CODES:
-                    for sc in STATUS_CODES:
-                        for cnt in ['records', 'bsls']:
-                            value_lbl = f"t{tc}_s{int(sc)}_{cnt}"
-                            summary_cols.append(value_lbl)
-                            if value_lbl not in summary_df.columns:
-                                summary_df[value_lbl] = 0
-                # Sort columns by clear order
-                summary_df = summary_df.sort_index(
-                    axis='columns',
-                    key=lambda x: pd.Index([summary_cols.index(y) for y in x])
-                )
-                # Replace NaN values (i.e., COI value not present for the
-                # geographic unit) with zeros
-                summary_df = summary_df.fillna(0)
-                # Change numeric column dtypes to int
-                for col in summary_df.columns:
-                    if col not in ['geoid']:
-                        summary_df[col] = summary_df[col].astype(int)
+                summary_df = summaries[geo]
+                # Decode GEOIDs into their published (zero-padded) form
+                summary_df['geoid'] = decode_geoids(summary_df['geoid'], geo)
                 # Write (partial) summary data to file
                 summary_fn = f"{aod_save_path}/{geo}_summary.csv"
                 summary_df.to_csv(
@@ -4,8 +4,9 @@ from pathlib import Path
 
 import pandas as pd
 
-from utils import CHALLENGE_DTYPES, OUTCOME_CODES, TECHNOLOGY_CODES, \
-    CATEGORY_CODES
+from storage_utils import read_table
+from utils import COMPACT_CHALLENGE_DTYPES, OUTCOME_CODES, \
+    TECHNOLOGY_CODES, CATEGORY_CODES
 
 
 def summarize_challenges_per_bsl(source_fn, destination):
@@ -14,7 +15,8 @@ def summarize_challenges_per_bsl(source_fn, destination):
     access technologies, and category reasons for each BSL.
 
     Args:
-        source_fn: Name of file containing the consolidated challenge data.
+        source_fn: Path of the consolidated challenge data (see
+        storage_utils.resolve_table).
 
         destination: Directory to save the summary data files.
     """
@@ -58,7 +60,11 @@ def summarize_challenges_per_bsl(source_fn, destination):
         return
     # Load consolidated challenge file
     print(end="Loading challenge data...", flush=True)
-    c_df = pd.read_csv(source_fn, dtype=CHALLENGE_DTYPES, low_memory=False)
+    c_df = read_table(
+        source_fn,
+        dtype=COMPACT_CHALLENGE_DTYPES,
+        columns=[bsl_id_col] + [coi['label'] for coi in COLUMNS_OF_INTEREST],
+    )
     print("done")
     # Summarize challenge data
     summary_dict_list = []
@@ -157,7 +163,7 @@ def summarize_challenges_per_bsl(source_fn, destination):
 
 
 if __name__ == "__main__":
-    source_fn = "data/processed/bdc/challenge/fixed_resolved/challenge.csv"
+    source_fn = "data/processed/bdc/challenge/fixed_resolved/challenge"
     destination = "data/processed/bdc/challenge/fixed_resolved/"
 
     summarize_challenges_per_bsl(source_fn=source_fn,
@@ -1,3 +1,22 @@
+import functools
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import zipfile
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import us
+
+from storage_utils import BucketedTableWriter, TableWriter, bucket_table, \
+    concat_tables, estimate_record_size, iter_table, list_tables, \
+    read_table, table_path
+
 
 # Availability Service Status (Codes)
 STATUS_CODES = [0, 1, 2]
@@ -58,6 +77,94 @@ CHALLENGE_DTYPES = {
     "block_geoid": str,
 }
 
+# Geographic levels (Level: GEOID length). GEOIDs are stored as integers and
+# only the Census Block GEOID is stored per record: the GEOID of every other
+# level is a prefix of it (see parent_geoids).
+GEOID_LENGTHS = {
+    "state": 2,
+    "county": 5,
+    "tract": 11,
+    "block_group": 12,
+    "block": 15,
+}
+# Geographic levels above the Census Block
+GEOS = [geo for geo in GEOID_LENGTHS if geo != "block"]
+# States/territories/DC (Abbreviation: integer state GEOID)
+STATES = us.STATES_AND_TERRITORIES + [us.states.DC]
+STATE_GEOIDS = {
+    abbr: int(fips)
+    for abbr, fips in us.states.mapping('abbr', 'fips', states=STATES).items()
+}
+# States/territories/DC (Integer state GEOID: Abbreviation)
+STATE_ABBRS = {geoid: abbr for abbr, geoid in STATE_GEOIDS.items()}
+
+# Memory-optimized data types of availability and challenge data, used to
+# load the data in every stage: categoricals for low-cardinality strings and
+# narrow integers for codes and speeds
+COMPACT_AVAILABILITY_DTYPES = {
+    **AVAILABILITY_DTYPES,
+    "provider_key": np.int64,
+    "frn": "category",
+    "location_id": np.int64,
+    "provider_id": np.uint32,
+    "brand_name": "category",
+    "technology": np.int8,
+    "max_advertised_download_speed": np.uint32,
+    "max_advertised_upload_speed": np.uint32,
+    "low_latency": np.int8,
+    "business_residential_code": "category",
+    "state_usps": "category",
+    "block_geoid": np.int64,
+    "status": np.int8,
+}
+COMPACT_CHALLENGE_DTYPES = {
+    **CHALLENGE_DTYPES,
+    "provider_key": np.int64,
+    "location_id": np.int64,
+    "location_state": "category",
+    "data_vintage": "category",
+    "frn": "category",
+    "provider_id": np.uint32,
+    "provider_brand_name": "category",
+    "holding_company_name": "category",
+    "technology": np.int8,
+    "category_code": np.int8,
+    "category_code_desc": "category",
+    "request_method_code_desc": "category",
+    "outcome": "category",
+    "outcome_code": np.int8,
+    "adjudication_code": "category",
+    "adjudication_code_desc": "category",
+    "block_geoid": "Int64",  # Missing for challenges to unknown BSLs
+}
+# Data types of the raw data as published by the FCC. Published location_ids
+# and GEOIDs are loaded as strings and encoded as integers once (see
+# encode_location_ids and encode_geoids), checking that the encoding is
+# lossless.
+RAW_AVAILABILITY_DTYPES = {
+    **COMPACT_AVAILABILITY_DTYPES,
+    "location_id": str,
+    "block_geoid": str,
+}
+RAW_CHALLENGE_DTYPES = {**COMPACT_CHALLENGE_DTYPES, "location_id": str}
+
+# Columns of the availability records that are properties of the BSL rather
+# than of the availability offering. They are stored once per BSL, in the BSL
+# (dimension) table of each <as_of_date, state> pair (see bsl_table_path),
+# instead of in every availability record.
+BSL_COLUMNS = ["location_id", "state_usps", "block_geoid", "h3_res8_id"]
+# Columns of the availability and challenge records identifying the provider.
+# They are stored once per provider, in provider (dimension) tables (see
+# provider_table_path), and replaced by a provider_key in every record (see
+# provider_keys).
+AVAILABILITY_PROVIDER_COLUMNS = ["frn", "provider_id", "brand_name"]
+CHALLENGE_PROVIDER_COLUMNS = [
+    "frn",
+    "provider_id",
+    "provider_brand_name",
+    "holding_company_name",
+]
+
 # Access Technologies (Codes)
 TECHNOLOGY_CODES = [10, 40, 50, 60, 61, 70, 71, 72, 0]
 RELIABLE_TECHNOLOGY_CODES = [10, 40, 50, 71, 72]
@@ -100,6 +207,14 @@ OUTCOMES_SHORT = {
     1: "O",
     2: "W",
 }
+# Challenge Outcomes (Published outcome: Code)
+PUBLISHED_OUTCOMES = {
+    "Challenge Upheld - Provider Conceded": 0,
+    "Challenge Upheld - Service Change": 0,
+    "Challenge Upheld - Adjudicated by FCC": 0,
+    "Challenge Overturned": 1,
+    "Challenge Withdrawn": 2,
+}
 
 # Challenge Categories (Codes)
 CATEGORY_CODES = [1, 2, 3, 4, 5, 6, 8, 9]
@@ -129,3 +244,1383 @@ CATEGORIES_SHORT = {
     8: "[8] No Signal",
     9: "[9] New Equipment",
 }
+
+
+def apply_dtypes(df, dtypes):
+    """Casts the columns of a dataframe to the given data types (e.g., after
+    concatenating dataframes with categoricals of different categories, which
+    yields object columns). Columns already of the given data types and
+    columns without a data type are left untouched.
+
+    Args:
+        df: Dataframe to cast.
+
+        dtypes: Data types of the columns (e.g., COMPACT_CHALLENGE_DTYPES).
+
+    Returns:
+        The dataframe with the columns cast.
+    """
+    for column, dtype in dtypes.items():
+        if column in df.columns \
+                and df[column].dtype != pd.api.types.pandas_dtype(dtype):
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def encode_location_ids(location_ids):
+    """Encodes location_ids as published by the FCC (i.e., decimal strings)
+    as int64 integers, checking that they can be decoded back into exactly
+    the published strings (see decode_location_ids).
+
+    Args:
+        location_ids: Series of location_ids as published.
+
+    Returns:
+        Series of int64 location_ids.
+
+    Raises:
+        ValueError: If a location_id is missing or is not a canonical decimal
+        integer (e.g., it has leading zeros).
+    """
+    if location_ids.isna().any():
+        raise ValueError("Missing location_ids.")
+    if not location_ids.str.fullmatch(r"0|[1-9][0-9]*").all():
+        raise ValueError("Location_ids that cannot be encoded losslessly.")
+    return location_ids.astype("Int64").astype(np.int64)
+
+
+def decode_location_ids(ids):
+    """Decodes int64 location_ids into the strings published by the FCC."""
+    return ids.astype(str)
+
+
+def encode_geoids(geoids, geo="block"):
+    """Encodes GEOIDs as published by the Census Bureau (i.e., fixed-length
+    decimal strings, possibly with leading zeros) as integers, checking that
+    they can be decoded back into exactly the published strings (see
+    decode_geoids).
+
+    Args:
+        geoids: Series of GEOIDs as published. Missing GEOIDs are kept as
+        missing values.
+
+        geo: Geographic level (see GEOID_LENGTHS) of the GEOIDs.
+
+    Returns:
+        Series of int64 GEOIDs, or of nullable Int64 GEOIDs if any is missing.
+
+    Raises:
+        ValueError: If a GEOID is not a decimal string of the length of the
+        geographic level.
+    """
+    present = geoids.notna()
+    if not geoids[present].str.fullmatch(
+            rf"[0-9]{{{GEOID_LENGTHS[geo]}}}").all():
+        raise ValueError(f"Malformed {geo} GEOIDs.")
+    encoded = geoids.astype("Int64")
+    if present.all():
+        return encoded.astype(np.int64)
+    return encoded
+
+
+def decode_geoids(geoids, geo="block"):
+    """Decodes integer GEOIDs of a geographic level (see GEOID_LENGTHS) into
+    the strings published by the Census Bureau, restoring their leading
+    zeros. Missing GEOIDs are kept as missing values."""
+    return geoids.astype(str).str.zfill(GEOID_LENGTHS[geo])
+
+
+def parent_geoids(block_geoids, geo, child_geo="block"):
+    """Determines the GEOIDs of a geographic level (see GEOID_LENGTHS) from
+    integer GEOIDs of a finer level (Census Blocks by default), i.e., their
+    prefixes of the level's length, by integer division."""
+    length = GEOID_LENGTHS[child_geo] - GEOID_LENGTHS[geo]
+    return block_geoids // 10 ** length
+
+
+def add_geoids(df, geos=GEOS):
+    """Adds the (integer) GEOIDs of the given geographic levels to every
+    record, derived from its Census Block GEOID. Records without a Census
+    Block GEOID get no GEOIDs either.
+
+    Args:
+        df: Dataframe with an integer 'block_geoid' column.
+
+        geos: Geographic levels (see GEOID_LENGTHS) of the GEOIDs to add.
+
+    Returns:
+        The dataframe with a '<geo>_geoid' column per geographic level.
+    """
+    for geo in geos:
+        df[f"{geo}_geoid"] = parent_geoids(df['block_geoid'], geo)
+    return df
+
+
+def challenge_state_geoids(c_df):
+    """Determines the (integer) state GEOID of every challenge from its Census
+    Block GEOID or, for challenges without one (i.e., to BSLs not found in the
+    availability data), from its location_state state abbreviation.
+
+    Args:
+        c_df: Dataframe with 'block_geoid' and 'location_state' columns.
+
+    Returns:
+        Series of Int64 state GEOIDs aligned with the challenges (missing for
+        challenges without a block_geoid or a known location_state).
+    """
+    state_geoids = parent_geoids(c_df['block_geoid'], 'state').astype("Int64")
+    # Only map the state abbreviations of challenges without a block_geoid,
+    # leaving unknown (or missing) abbreviations as missing values
+    unlocated = state_geoids.isna()
+    state_geoids[unlocated] = c_df.loc[unlocated, 'location_state'].map(
+        STATE_GEOIDS
+    ).astype("Int64")
+    return state_geoids
+
+
+def read_challenge_file(file_path):
+    """Reads a (zipped) resolved challenge file, encoding its location_ids as
+    integers (see encode_location_ids)."""
+    c_df = pd.read_csv(file_path, dtype=RAW_CHALLENGE_DTYPES)
+    c_df['location_id'] = encode_location_ids(c_df['location_id'])
+    return c_df
+
+
+def read_challenge_files(file_paths, max_workers=1, memory_budget=None):
+    """Reads resolved challenge files, concurrently in a pool of processes,
+    and concatenates them at once, in the given order, so records are copied
+    once rather than once per file.
+
+    Args:
+        file_paths: Paths of the (zipped) challenge files.
+
+        max_workers: Maximum number of processes reading files concurrently.
+        If 1, files are read in the current process.
+
+        memory_budget: Maximum memory (bytes) estimated for the files read
+        concurrently (see run_in_process_pool), or None for no limit.
+
+    Returns:
+        Dataframe with the challenge records (with the compact data types).
+    """
+    if max_workers == 1:
+        c_dfs = [read_challenge_file(file_path) for file_path in file_paths]
+    else:
+        tasks = [
+            ((file_path,), estimate_augment_memory([file_path]))
+            for file_path in file_paths
+        ]
+        results = dict(run_in_process_pool(
+            read_challenge_file,
+            tasks,
+            max_workers=max_workers,
+            memory_budget=memory_budget,
+        ))
+        c_dfs = [results[(file_path,)] for file_path in file_paths]
+    # Restore the categoricals of columns whose categories differ across
+    # files (concatenated as objects)
+    challenges = pd.concat(c_dfs, ignore_index=True)
+    return apply_dtypes(challenges, COMPACT_CHALLENGE_DTYPES)
+
+
+def latest_challenges(c_df):
+    """Removes duplicate challenges (i.e., challenges resolved again in later
+    files), keeping the record with the latest adjudication date. Records
+    without adjudication date are the latest, and ties are resolved in favor
+    of the last record. Only the distinct dates are sorted, and records are
+    grouped by challenge_id with a hash table, so the cost is linear in the
+    number of records, which keep their order.
+
+    Args:
+        c_df: Dataframe with challenge records.
+
+    Returns:
+        The challenge records with one record per challenge_id.
+    """
+    dates = pd.Categorical(c_df['adjudication_date'])
+    ranks = pd.Series(
+        np.where(dates.codes < 0, len(dates.categories), dates.codes),
+        index=c_df.index,
+    )
+    latest = ranks == ranks.groupby(c_df['challenge_id']).transform('max')
+    return c_df[latest].drop_duplicates(subset='challenge_id', keep='last')
+
+
+def determine_outcome_codes(c_df):
+    """Determines the outcome code of challenge records from their published
+    outcome (see PUBLISHED_OUTCOMES)."""
+    return c_df['outcome'].map(PUBLISHED_OUTCOMES).astype(np.int8)
+
+
+def determine_service_status(df):
+    """Determines the service status (i.e., unserved, underserved, served) of
+    every availability record.
+
+    Args:
+        df: Dataframe with availability records as published by the FCC.
+
+    Returns:
+        Array of status codes (np.int8) aligned with the records.
+    """
+    download = df['max_advertised_download_speed'].to_numpy()
+    upload = df['max_advertised_upload_speed'].to_numpy()
+    unserved = \
+        ~df['technology'].isin(RELIABLE_TECHNOLOGY_CODES).to_numpy() | \
+        df['business_residential_code'].isin(['B']).to_numpy() | \
+        (download < 25) | \
+        (upload < 3) | \
+        (df['low_latency'].to_numpy() == 0)
+    underserved = (download < 100) | (upload < 20)
+    status = np.zeros(len(df), dtype=np.int8)  # Served
+    status[underserved] = 1  # Underserved
+    status[unserved] = 2  # Unserved
+    return status
+
+
+def augment_availability_data(file_df):
+    """Augments availability records with their service status (i.e.,
+    unserved, underserved, served). Published location_ids and Census Block
+    GEOIDs are encoded as integers. GEOIDs at other geographic levels are
+    not stored, but derived when needed (see add_geoids).
+
+    Args:
+        file_df: Dataframe with availability records as published by the FCC
+        (see RAW_AVAILABILITY_DTYPES).
+
+    Returns:
+        The augmented dataframe.
+    """
+    if not pd.api.types.is_integer_dtype(file_df['location_id']):
+        file_df['location_id'] = encode_location_ids(file_df['location_id'])
+    if not pd.api.types.is_integer_dtype(file_df['block_geoid']):
+        file_df['block_geoid'] = encode_geoids(file_df['block_geoid'])
+    file_df['status'] = determine_service_status(file_df)
+    return file_df
+
+
+# Count columns of the availability summaries (see
+# summarize_availability_data), in order
+AVAILABILITY_SUMMARY_COLUMNS = (
+    ['total_records', 'total_bsls']
+    + [f"s{sc}_{cnt}" for sc in STATUS_CODES for cnt in ['records', 'bsls']]
+    + [
+        f"t{tc}_{cnt}"
+        for tc in TECHNOLOGY_CODES for cnt in ['records', 'bsls']
+    ]
+    + [
+        f"t{tc}_s{sc}_{cnt}"
+        for tc in TECHNOLOGY_CODES for sc in STATUS_CODES
+        for cnt in ['records', 'bsls']
+    ]
+)
+# Coded columns of the challenge summaries (label, prefix, and codes)
+CHALLENGE_SUMMARY_CODES = [
+    ("outcome_code", "o", OUTCOME_CODES),
+    ("technology", "t", TECHNOLOGY_CODES),
+    ("category_code", "c", CATEGORY_CODES),
+]
+# Combinations of coded columns counted by the challenge summaries (each
+# column, each pair of columns, and all three columns)
+CHALLENGE_SUMMARY_COMBINATIONS = [
+    combination
+    for n_columns in range(1, len(CHALLENGE_SUMMARY_CODES) + 1)
+    for combination in itertools.combinations(CHALLENGE_SUMMARY_CODES,
+                                              n_columns)
+]
+# Count columns of the challenge summaries (see summarize_challenge_data), in
+# order
+CHALLENGE_SUMMARY_COLUMNS = ['total_challenges', 'total_bsls'] + [
+    "_".join(
+        f"{prefix}{code}"
+        for (_, prefix, _), code in zip(combination, combination_codes)
+    ) + f"_{cnt}"
+    for combination in CHALLENGE_SUMMARY_COMBINATIONS
+    for combination_codes in itertools.product(
+        *[codes for _, _, codes in combination]
+    )
+    for cnt in ['challenges', 'bsls']
+]
+
+
+def unstack_counts(counts, name):
+    """Turns counts indexed by GEOID (first level) and codes (other levels, if
+    any) into a dataframe with a row per GEOID and a column per combination
+    of codes.
+
+    Args:
+        counts: Series with the counts.
+
+        name: Name of the columns, formatted with the codes of each column
+        (e.g., "t{}_s{}_records" for technology and status codes).
+
+    Returns:
+        The dataframe of counts.
+    """
+    if counts.index.nlevels == 1:
+        return counts.to_frame(name)
+    levels = list(range(1, counts.index.nlevels))
+    counts = counts.unstack(levels, fill_value=0)
+    keys = counts.columns
+    if len(levels) == 1:
+        keys = [(key,) for key in keys]
+    counts.columns = [name.format(*key) for key in keys]
+    return counts
+
+
+def count_matrix(counts, columns):
+    """Combines dataframes of counts (see unstack_counts) into a count matrix
+    with the given columns, in order, and a row per GEOID, in ascending
+    order. Counters not present for any GEOID are zero.
+
+    Args:
+        counts: List of dataframes of counts indexed by GEOID.
+
+        columns: Columns of the count matrix.
+
+    Returns:
+        The count matrix (a dataframe of integer counts indexed by GEOID).
+    """
+    return pd.concat(counts, axis='columns').sort_index().reindex(
+        columns=columns,
+        fill_value=0,
+    ).fillna(0).astype(int).rename_axis('geoid')
+
+
+def rollup_counts(counts, geos, base_geo="block"):
+    """Aggregates the count matrix of a geographic level up to coarser
+    geographic levels, summing the rows of the GEOIDs sharing the GEOID
+    prefix of each level (see parent_geoids). Each level is aggregated from
+    the next finer one, so its cost depends on the number of GEOIDs of that
+    level rather than on the number of records. Counts of distinct BSLs add
+    up as long as every BSL is in a single GEOID of the base level.
+
+    Args:
+        counts: Count matrix of the base level, indexed by (integer) GEOID
+        (see count_matrix).
+
+        geos: Geographic levels (see GEOID_LENGTHS) to aggregate to, which
+        may include the base level.
+
+        base_geo: Geographic level of the count matrix.
+
+    Returns:
+        Dictionary with the count matrix of each geographic level.
+    """
+    rollups = {}
+    child_geo = base_geo
+    for geo in sorted(geos, key=lambda x: GEOID_LENGTHS[x], reverse=True):
+        if geo != child_geo:
+            counts = counts.groupby(
+                parent_geoids(counts.index, geo, child_geo)
+            ).sum()
+            child_geo = geo
+        rollups[geo] = counts.rename_axis('geoid')
+    return rollups
+
+
+def count_availability_data(a_df, geo="block"):
+    """Counts availability records and BSLs per GEOID of a geographic level,
+    overall, per service status, per technology, and per technology and
+    service status (see AVAILABILITY_SUMMARY_COLUMNS). Each BSL (overall and
+    per technology) is counted under its best service status. Records, BSLs,
+    and <BSL, technology> pairs are grouped once by GEOID and codes, and the
+    coarser counts are summed from them.
+
+    Args:
+        a_df: Dataframe with availability records ('location_id',
+        'technology', and 'status' columns) and the (integer) GEOID of their
+        BSLs at the geographic level ('<geo>_geoid' column).
+
+        geo: Geographic level (see GEOID_LENGTHS) to count at.
+
+    Returns:
+        The count matrix (see count_matrix).
+    """
+    geoid_col = f"{geo}_geoid"
+    # Order records by service statuses
+    a_df = a_df.sort_values(by="status", ascending=True)
+    # Determine the service status of each BSL
+    bsl_df = a_df.drop_duplicates(subset='location_id', keep='first')
+    # Determine unique availability records for each pair of location_id and
+    # technology (keeping the record with the best service status for each
+    # pair)
+    unique_pairs_df = a_df.drop_duplicates(
+        subset=['location_id', 'technology'],
+        keep='first',
+    )
+    # Count records, BSLs, and <BSL, technology> pairs per GEOID and codes
+    records = a_df.groupby([geoid_col, 'technology', 'status']).size()
+    bsls = bsl_df.groupby([geoid_col, 'status']).size()
+    pairs = unique_pairs_df.groupby(
+        [geoid_col, 'technology', 'status']
+    ).size()
+    return count_matrix(
+        [
+            unstack_counts(records.groupby(level=0).sum(), "total_records"),
+            unstack_counts(bsls.groupby(level=0).sum(), "total_bsls"),
+            unstack_counts(records.groupby(level=[0, 2]).sum(),
+                           "s{}_records"),
+            unstack_counts(bsls, "s{}_bsls"),
+            unstack_counts(records.groupby(level=[0, 1]).sum(),
+                           "t{}_records"),
+            unstack_counts(pairs.groupby(level=[0, 1]).sum(), "t{}_bsls"),
+            unstack_counts(records, "t{}_s{}_records"),
+            unstack_counts(pairs, "t{}_s{}_bsls"),
+        ],
+        AVAILABILITY_SUMMARY_COLUMNS,
+    )
+
+
+def summarize_availability_data(a_df, geos):
+    """Summarizes availability records per GEOID at each of the given
+    geographic levels (see count_availability_data). The records are counted
+    once per Census Block, and the counts of the other levels are aggregated
+    from the block counts (see rollup_counts), as every BSL is in a single
+    Census Block.
+
+    Args:
+        a_df: Dataframe with availability records ('location_id',
+        'technology', and 'status' columns) and the (integer) Census Block
+        GEOID of their BSLs ('block_geoid' column).
+
+        geos: Geographic levels (see GEOID_LENGTHS) to summarize at.
+
+    Returns:
+        Dictionary with a summary dataframe per geographic level, with an
+        (integer) 'geoid' column and the count columns, and a row per GEOID
+        in ascending order.
+    """
+    block_counts = count_availability_data(a_df, "block")
+    return {
+        geo: counts.reset_index()
+        for geo, counts in rollup_counts(block_counts, geos).items()
+    }
+
+
+def count_challenge_data(c_df, geo="block"):
+    """Counts challenges and challenged BSLs per GEOID of a geographic level,
+    overall and per combination of codes of the coded columns (see
+    CHALLENGE_SUMMARY_COLUMNS). Challenges are grouped once by GEOID and the
+    codes of every coded column, and the coarser counts are summed from them,
+    while BSLs are counted once per combination of coded columns.
+
+    Args:
+        c_df: Dataframe with challenge records ('location_id' and the coded
+        columns) and the (integer) GEOID of their BSLs at the geographic
+        level ('<geo>_geoid' column).
+
+        geo: Geographic level (see GEOID_LENGTHS) to count at.
+
+    Returns:
+        The count matrix (see count_matrix).
+    """
+    geoid_col = f"{geo}_geoid"
+    labels = [label for label, _, _ in CHALLENGE_SUMMARY_CODES]
+    challenges = c_df.groupby([geoid_col] + labels).size()
+    counts = [
+        unstack_counts(challenges.groupby(level=0).sum(), "total_challenges"),
+        unstack_counts(
+            c_df.drop_duplicates(subset=[geoid_col, 'location_id']).groupby(
+                geoid_col
+            ).size(),
+            "total_bsls",
+        ),
+    ]
+    for combination in CHALLENGE_SUMMARY_COMBINATIONS:
+        columns = [label for label, _, _ in combination]
+        name = "_".join(f"{prefix}{{}}" for _, prefix, _ in combination)
+        levels = [0] + [1 + labels.index(label) for label in columns]
+        counts.append(unstack_counts(
+            challenges.groupby(level=levels).sum(),
+            f"{name}_challenges",
+        ))
+        bsl_df = c_df.drop_duplicates(
+            subset=[geoid_col] + columns + ['location_id']
+        )
+        counts.append(unstack_counts(
+            bsl_df.groupby([geoid_col] + columns).size(),
+            f"{name}_bsls",
+        ))
+    return count_matrix(counts, CHALLENGE_SUMMARY_COLUMNS)
+
+
+def summarize_challenge_data(c_df, geos):
+    """Summarizes challenge records per GEOID at each of the given geographic
+    levels (see count_challenge_data), and nationwide ('nation' level).
+    Challenges to located BSLs are counted once per Census Block, and those
+    to unknown BSLs (i.e., without a Census Block GEOID) once per state. The
+    counts of the other levels are aggregated from the block counts (see
+    rollup_counts), as every BSL is in a single Census Block, adding those of
+    unknown BSLs at the state level, and the nationwide counts are the sum of
+    the state counts, unless a BSL is in more than one state (i.e., an
+    unknown BSL challenged in files of several states), in which case they
+    are counted from the records.
+
+    Args:
+        c_df: Dataframe with challenge records ('location_id' and the coded
+        columns), the (integer) Census Block GEOID of their BSLs
+        ('block_geoid' column, missing for unknown BSLs), and their (integer)
+        state GEOID ('state_geoid' column, see challenge_state_geoids).
+
+        geos: Geographic levels (see GEOID_LENGTHS, or 'nation') to
+        summarize at.
+
+    Returns:
+        Dictionary with a summary dataframe per geographic level, with a
+        'geoid' column (integer, or empty for the nation) and the count
+        columns, and a row per GEOID in ascending order.
+    """
+    geo_levels = [geo for geo in geos if geo != "nation"]
+    if "nation" in geos and "state" not in geo_levels:
+        geo_levels.append("state")
+    located = c_df['block_geoid'].notna()
+    block_counts = count_challenge_data(
+        c_df[located].astype({'block_geoid': np.int64}),
+        "block",
+    )
+    rollups = rollup_counts(block_counts, geo_levels)
+    if "state" in rollups:
+        rollups["state"] = pd.concat([
+            rollups["state"],
+            count_challenge_data(c_df[~located], "state"),
+        ]).groupby(level=0).sum().rename_axis('geoid')
+    summaries = {}
+    for geo in geos:
+        if geo != "nation":
+            summaries[geo] = rollups[geo].reset_index()
+            continue
+        bsl_states = c_df[['location_id', 'state_geoid']].drop_duplicates()
+        if bsl_states['location_id'].duplicated().any():
+            nation_df = count_challenge_data(
+                c_df.assign(nation_geoid=0),
+                "nation",
+            )
+        else:
+            nation_df = rollups["state"].sum().to_frame(0).T
+        summaries[geo] = nation_df.reset_index(drop=True)
+        summaries[geo].insert(0, 'geoid', "")
+    return summaries
+
+
+def bsl_table_path(save_path):
+    """Determines the path (without file extension) of the BSL table of an
+    <as_of_date, state> pair given the path of its availability table (i.e.,
+    '<as_of_date>/bsl/<state_id>' for '<as_of_date>/<state_id>')."""
+    aod_path, state_id = os.path.split(os.path.normpath(save_path))
+    return os.path.join(aod_path, "bsl", state_id)
+
+
+def provider_table_path(save_path):
+    """Determines the path (without file extension) of the provider table of
+    a (fact) table given its path (i.e., '<as_of_date>/provider/<state_id>'
+    for '<as_of_date>/<state_id>'). The provider tables of the directory of
+    the fact table, together, make up its provider dimension (see
+    read_providers)."""
+    directory, name = os.path.split(os.path.normpath(save_path))
+    return os.path.join(directory, "provider", name)
+
+
+def provider_keys(df, columns):
+    """Determines the provider key of every record, i.e., the first 8 bytes
+    of the BLAKE2b hash of its provider columns, as a (signed) int64 integer.
+    Keys only depend on the provider, so tables written independently (e.g.,
+    by concurrent processes) share them. The hash is computed once per
+    provider.
+
+    Args:
+        df: Dataframe with the provider columns.
+
+        columns: Provider columns (e.g., AVAILABILITY_PROVIDER_COLUMNS).
+
+    Returns:
+        Array of int64 provider keys aligned with the records.
+    """
+    providers = df[columns].drop_duplicates()
+    providers['provider_key'] = [
+        int.from_bytes(
+            hashlib.blake2b(
+                "\x1f".join(
+                    "" if pd.isna(value) else str(value) for value in values
+                ).encode(),
+                digest_size=8,
+            ).digest(),
+            byteorder='little',
+            signed=True,
+        )
+        for values in providers.itertuples(index=False)
+    ]
+    return pd.merge(
+        left=df[columns],
+        right=providers,
+        how='left',
+        on=columns,
+    )['provider_key'].to_numpy()
+
+
+def split_availability_data(file_df):
+    """Splits augmented availability records into offering records (keyed by
+    location_id and provider_key), BSL records (see BSL_COLUMNS), with one
+    record per BSL, and provider records (see
+    AVAILABILITY_PROVIDER_COLUMNS), with one record per provider.
+
+    Args:
+        file_df: Dataframe with augmented availability records.
+
+    Returns:
+        (offerings, bsls, providers) tuple of dataframes.
+    """
+    file_df['provider_key'] = provider_keys(file_df,
+                                            AVAILABILITY_PROVIDER_COLUMNS)
+    bsl_df = file_df[BSL_COLUMNS].drop_duplicates(subset='location_id')
+    provider_df = file_df[
+        ['provider_key'] + AVAILABILITY_PROVIDER_COLUMNS
+    ].drop_duplicates(subset='provider_key')
+    file_df = file_df.drop(
+        columns=BSL_COLUMNS[1:] + AVAILABILITY_PROVIDER_COLUMNS
+    )
+    return file_df, bsl_df, provider_df
+
+
+class BSLTableWriter(TableWriter):
+    """Writes the BSL table of an <as_of_date, state> pair chunk by chunk (see
+    storage_utils.TableWriter), keeping only the first record of every BSL.
+    The location_ids written so far are kept in a sorted array."""
+
+    def __init__(self, path, storage_format="csv"):
+        super().__init__(path, storage_format)
+        self._location_ids = np.empty(0, dtype=np.int64)
+
+    def write(self, df):
+        """Appends the records of BSLs not written yet to the table."""
+        df = df[BSL_COLUMNS].drop_duplicates(subset='location_id')
+        location_ids = df['location_id'].to_numpy(dtype=np.int64)
+        positions = np.searchsorted(self._location_ids, location_ids)
+        positions = np.minimum(positions, len(self._location_ids) - 1)
+        if len(self._location_ids) > 0:
+            new = self._location_ids[positions] != location_ids
+            df = df[new]
+            location_ids = location_ids[new]
+        self._location_ids = np.union1d(self._location_ids, location_ids)
+        super().write(df)
+
+
+def check_provider_keys(provider_df):
+    """Checks that every provider key identifies a single provider, raising a
+    ValueError otherwise (i.e., on a hash collision).
+
+    Args:
+        provider_df: Dataframe with provider records (with a provider_key
+        column).
+
+    Returns:
+        The provider records, with one record per provider key.
+    """
+    provider_df = provider_df.drop_duplicates()
+    if not provider_df['provider_key'].is_unique:
+        raise ValueError("Provider key collision between providers.")
+    return provider_df
+
+
+class ProviderTableWriter(TableWriter):
+    """Writes a provider table chunk by chunk (see storage_utils.TableWriter),
+    keeping a single record per provider and checking that provider keys do
+    not collide (see check_provider_keys). The providers written so far are
+    kept in memory, since they are few."""
+
+    def __init__(self, path, storage_format="csv"):
+        super().__init__(path, storage_format)
+        self._providers = None
+
+    def write(self, df):
+        """Appends the records of providers not written yet to the table."""
+        df = check_provider_keys(df)
+        if self._providers is None:
+            self._providers = df
+        else:
+            written = df['provider_key'].isin(self._providers['provider_key'])
+            check_provider_keys(pd.concat([self._providers, df[written]]))
+            df = df[~written]
+            self._providers = pd.concat([self._providers, df],
+                                        ignore_index=True)
+        super().write(df)
+
+
+class AvailabilityTableWriter:
+    """Writes augmented availability records of an <as_of_date, state> pair
+    chunk by chunk into its availability (offerings), BSL, and provider tables
+    (see split_availability_data). The BSL and provider tables are committed
+    first, so that they exist whenever the availability table does. The
+    availability table may be bucketed by location_id (see
+    storage_utils.BucketedTableWriter). Optionally, the availability records
+    of challenging BSLs are also written to a separate table as they pass by
+    (see cbsl_part_path), so that they need not be extracted later.
+
+    Usage:
+        with AvailabilityTableWriter(save_path, storage_format) as writer:
+            for file_df in chunks:
+                writer.write(file_df)
+    """
+
+    def __init__(self, save_path, storage_format="csv", n_buckets=None,
+                 cbsl_ids=None):
+        """Creates a writer for the tables of an <as_of_date, state> pair.
+
+        Args:
+            save_path: Path of the availability table without file extension.
+
+            storage_format: Storage format of the tables (see
+            storage_utils.STORAGE_FORMATS).
+
+            n_buckets: Number of buckets of the availability table, or None
+            for a single (unsorted) table.
+
+            cbsl_ids: Array of challenged location_ids whose availability
+            records are also written to the challenging BSL table of the pair
+            (see cbsl_part_path), or None for no such table.
+        """
+        bsl_path = bsl_table_path(save_path)
+        provider_path = provider_table_path(save_path)
+        for path in [bsl_path, provider_path]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if n_buckets is None:
+            self.writer = TableWriter(save_path, storage_format)
+        else:
+            self.writer = BucketedTableWriter(
+                save_path,
+                storage_format,
+                column='location_id',
+                n_buckets=n_buckets,
+                dtype=COMPACT_AVAILABILITY_DTYPES,
+            )
+        self.bsl_writer = BSLTableWriter(bsl_path, storage_format)
+        self.provider_writer = ProviderTableWriter(provider_path,
+                                                   storage_format)
+        self.cbsl_ids = cbsl_ids
+        self.cbsl_writer = None
+        if cbsl_ids is not None:
+            self.cbsl_writer = TableWriter(cbsl_part_path(save_path),
+                                           storage_format)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        writers = [self.bsl_writer, self.provider_writer, self.writer]
+        if self.cbsl_writer is not None:
+            writers.insert(0, self.cbsl_writer)
+        if exc_type is None:
+            for writer in writers:
+                writer.close()
+        else:
+            for writer in writers:
+                writer.abort()
+
+    @property
+    def records(self):
+        """Number of availability records written."""
+        return self.writer.records
+
+    @property
+    def path(self):
+        """Path of the availability table file (or directory)."""
+        return self.writer.path
+
+    def write(self, file_df):
+        """Appends augmented availability records to the tables."""
+        file_df, bsl_df, provider_df = split_availability_data(file_df)
+        self.writer.write(file_df)
+        self.bsl_writer.write(bsl_df)
+        self.provider_writer.write(provider_df)
+        if self.cbsl_writer is not None:
+            cbsl_df = file_df[file_df['location_id'].isin(self.cbsl_ids)]
+            if len(cbsl_df) > 0:
+                self.cbsl_writer.write(cbsl_df)
+
+
+def cbsl_part_path(save_path):
+    """Determines the path (without file extension) of the challenging BSL
+    availability table of an <as_of_date, state> pair written during its
+    consolidation (see AvailabilityTableWriter), which is concatenated with
+    those of the other states into the challenging BSL availability table of
+    the As of Date (see concat_cbsl_tables). Like other part tables, it is
+    not listed as a table of the As of Date (see storage_utils.list_tables).
+
+    Args:
+        save_path: Path of the availability table without file extension.
+    """
+    path = Path(save_path)
+    return f"{path.parent}/cbsl.{path.name}.part"
+
+
+def concat_cbsl_tables(state_save_paths, aod_save_path, cbsl_ids,
+                       storage_format="csv"):
+    """Concatenates the challenging BSL availability tables written during
+    the consolidation of the states of an As of Date (see cbsl_part_path),
+    in the given order, into the challenging BSL availability table of the As
+    of Date, and records the challenged location_ids it holds the records of
+    (see write_cbsl_digest). States without challenging BSLs have no table,
+    and if no state has any, an empty table is written, so that the table
+    always exists along with its record.
+
+    Args:
+        state_save_paths: Paths of the availability tables of the states
+        without file extension.
+
+        aod_save_path: Directory of the As of Date.
+
+        cbsl_ids: Array of challenged location_ids the tables were written
+        for.
+
+        storage_format: Storage format of the tables (see
+        storage_utils.STORAGE_FORMATS).
+
+    Returns:
+        The path of the table file.
+    """
+    part_paths = [
+        table_path(cbsl_part_path(state_save_path), storage_format)
+        for state_save_path in state_save_paths
+    ]
+    part_paths = [path for path in part_paths if Path(path).is_file()]
+    if part_paths:
+        save_path = concat_tables(part_paths, f"{aod_save_path}/cbsl",
+                                  storage_format)
+    else:
+        with TableWriter(f"{aod_save_path}/cbsl", storage_format) as writer:
+            writer.write(empty_availability_records(state_save_paths[0]))
+        save_path = writer.path
+    write_cbsl_digest(aod_save_path, cbsl_ids)
+    return save_path
+
+
+def concat_availability_tables(part_paths, save_path, storage_format="csv",
+                               n_buckets=None):
+    """Concatenates the tables of <as_of_date, state> parts (e.g., one per
+    availability file) written by AvailabilityTableWriter, in the given
+    order, into the tables of the pair, and deletes them (see
+    storage_utils.concat_tables). BSL and provider records are deduplicated
+    across parts, and the availability table may then be bucketed (see
+    storage_utils.bucket_table).
+
+    Args:
+        part_paths: Paths of the availability tables of the parts without file
+        extension.
+
+        save_path: Path of the availability table without file extension.
+
+        storage_format: Storage format of the tables (see
+        storage_utils.STORAGE_FORMATS).
+
+        n_buckets: Number of buckets of the availability table, or None for a
+        single (unsorted) table.
+
+    Returns:
+        The path of the availability table file (or directory).
+    """
+    dimensions = [
+        (bsl_table_path, BSLTableWriter),
+        (provider_table_path, ProviderTableWriter),
+    ]
+    for dimension_path, writer_class in dimensions:
+        with writer_class(dimension_path(save_path), storage_format) as writer:
+            for part_path in part_paths:
+                writer.write(read_table(
+                    table_path(dimension_path(part_path), storage_format),
+                    dtype=COMPACT_AVAILABILITY_DTYPES,
+                ))
+        for part_path in part_paths:
+            os.remove(table_path(dimension_path(part_path), storage_format))
+    path = concat_tables(
+        [table_path(part_path, storage_format) for part_path in part_paths],
+        save_path,
+        storage_format,
+    )
+    if n_buckets is not None:
+        path = bucket_table(
+            save_path,
+            column='location_id',
+            n_buckets=n_buckets,
+            dtype=COMPACT_AVAILABILITY_DTYPES,
+        )
+    return path
+
+
+def join_bsl_data(a_df, save_path, columns, dtype=None):
+    """Joins availability records with columns of the BSL table of their
+    <as_of_date, state> pair. Only the given columns, and the BSLs in the
+    availability records, are read from the BSL table.
+
+    Args:
+        a_df: Dataframe with availability records (with a location_id
+        column).
+
+        save_path: Path of the availability table (see bsl_table_path).
+
+        columns: List of BSL columns (see BSL_COLUMNS) to join.
+
+        dtype: Data types of the BSL columns (defaults to
+        COMPACT_AVAILABILITY_DTYPES).
+
+    Returns:
+        The availability records, in the same order, with the BSL columns.
+    """
+    bsl_df = read_table(
+        bsl_table_path(save_path),
+        dtype=COMPACT_AVAILABILITY_DTYPES if dtype is None else dtype,
+        columns=['location_id'] + list(columns),
+    )
+    return pd.merge(left=a_df, right=bsl_df, how='left', on='location_id')
+
+
+def empty_availability_records(state_path):
+    """Reads an empty dataframe with the columns (and data types) of the
+    availability table of an <as_of_date, state> pair, e.g., to write a table
+    of availability records even if no record qualifies for it."""
+    return read_table(
+        state_path,
+        dtype=COMPACT_AVAILABILITY_DTYPES,
+        filters=[('location_id', 'in', np.empty(0, dtype=np.int64))],
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def read_providers(directory, dataset="availability"):
+    """Reads the provider dimension of the (fact) tables of a directory (e.g.,
+    an As of Date), i.e., its provider tables (see provider_table_path) with
+    one record per provider. Results are cached, so providers are read once
+    per directory; they must not be modified.
+
+    Args:
+        directory: Directory of the fact tables.
+
+        dataset: Dataset of the fact tables ('availability' or 'challenge'),
+        which determines the data types of the provider columns.
+
+    Returns:
+        Dataframe with the provider records, indexed by provider_key.
+    """
+    dtypes = COMPACT_CHALLENGE_DTYPES if dataset == "challenge" \
+        else COMPACT_AVAILABILITY_DTYPES
+    provider_df = pd.concat(
+        [
+            read_table(path, dtype=dtypes)
+            for path in list_tables(os.path.join(directory, "provider"))
+        ],
+        ignore_index=True,
+    )
+    provider_df = check_provider_keys(provider_df)
+    return apply_dtypes(provider_df, dtypes).set_index('provider_key')
+
+
+def join_provider_data(df, directory, columns, dataset="availability"):
+    """Resolves the provider columns of records through the (cached) provider
+    dimension of their directory (see read_providers).
+
+    Args:
+        df: Dataframe with records (with a provider_key column).
+
+        directory: Directory of the fact tables the records come from.
+
+        columns: List of provider columns (e.g., 'brand_name') to join.
+
+        dataset: Dataset of the records ('availability' or 'challenge').
+
+    Returns:
+        The records, in the same order, with the provider columns.
+    """
+    provider_df = read_providers(os.path.normpath(directory), dataset)
+    return pd.merge(
+        left=df,
+        right=provider_df[list(columns)],
+        how='left',
+        left_on='provider_key',
+        right_index=True,
+    )
+
+
+# Arrays of the BSL geolocation index (see bsl_index_path) and their data
+# types. As of Dates are stored as days (see numpy.datetime64).
+BSL_INDEX_DTYPES = {
+    "location_id": np.int64,
+    "block_geoid": np.int64,
+    "as_of_date": "datetime64[D]",
+}
+# File (in the directory of an As of Date) recording the challenged BSLs its
+# challenging BSL availability table was extracted for
+CBSL_METADATA_FN = "cbsl.json"
+# Number of BSLs sorted into the BSL geolocation index at a time
+BSL_INDEX_CHUNK_SIZE = 1024 * 1024
+
+
+def bsl_index_path(save_path):
+    """Determines the path of the index of the BSL geolocation table given
+    its path (i.e., the directory '<path>.index' for '<path>'). The index
+    stores an array per column (see BSL_INDEX_DTYPES) in NumPy's .npy format,
+    sorted by location_id, so that it can be memory-mapped and searched (see
+    lookup_bsl_index)."""
+    return f"{os.path.normpath(save_path)}.index"
+
+
+def write_bsl_index(chunks, index_path, n_bsls):
+    """Writes the BSL geolocation index from records in any order. Records
+    are copied into memory-mapped arrays, which are then sorted by location_id
+    into the index arrays chunk by chunk, so only the location_ids (and their
+    order) are held in memory. The index replaces any previous one once it is
+    complete.
+
+    Args:
+        chunks: Iterable of dataframes with BSL geolocation records (with the
+        columns of BSL_INDEX_DTYPES), one record per BSL.
+
+        index_path: Directory of the index (see bsl_index_path).
+
+        n_bsls: Total number of records in the chunks.
+    """
+    part_path = f"{index_path}.part"
+    shutil.rmtree(part_path, ignore_errors=True)
+    os.makedirs(part_path)
+    unsorted = {
+        name: np.lib.format.open_memmap(
+            f"{part_path}/{name}.unsorted.npy",
+            mode="w+",
+            dtype=dtype,
+            shape=(n_bsls,),
+        )
+        for name, dtype in BSL_INDEX_DTYPES.items()
+    }
+    start = 0
+    for df in chunks:
+        end = start + len(df)
+        for name, dtype in BSL_INDEX_DTYPES.items():
+            unsorted[name][start:end] = df[name].to_numpy().astype(dtype)
+        start = end
+    assert start == n_bsls, \
+        "The number of records differs from the size of the index."
+    order = np.argsort(unsorted['location_id'], kind='stable')
+    for name, dtype in BSL_INDEX_DTYPES.items():
+        array = np.lib.format.open_memmap(
+            f"{part_path}/{name}.npy",
+            mode="w+",
+            dtype=dtype,
+            shape=(n_bsls,),
+        )
+        for start in range(0, n_bsls, BSL_INDEX_CHUNK_SIZE):
+            positions = order[start:start + BSL_INDEX_CHUNK_SIZE]
+            array[start:start + len(positions)] = unsorted[name][positions]
+        array.flush()
+        del array
+        del unsorted[name]
+        os.remove(f"{part_path}/{name}.unsorted.npy")
+    shutil.rmtree(index_path, ignore_errors=True)
+    os.replace(part_path, index_path)
+
+
+def read_bsl_index(index_path):
+    """Opens the arrays of the BSL geolocation index, memory-mapped read-only,
+    so that only the pages searched are read from disk.
+
+    Args:
+        index_path: Directory of the index (see bsl_index_path).
+
+    Returns:
+        Dictionary with the index arrays (see BSL_INDEX_DTYPES), or None if
+        the index does not exist.
+    """
+    if not Path(index_path).is_dir():
+        return None
+    return {
+        name: np.load(f"{index_path}/{name}.npy", mmap_mode='r')
+        for name in BSL_INDEX_DTYPES
+    }
+
+
+def lookup_bsl_index(index, location_ids):
+    """Looks up the geolocation of BSLs in the BSL geolocation index with a
+    binary search (see numpy.searchsorted), so the cost depends on the number
+    of BSLs looked up rather than on the size of the index.
+
+    Args:
+        index: Index arrays (see read_bsl_index).
+
+        location_ids: Array-like of location_ids to look up.
+
+    Returns:
+        Dataframe with the block_geoid (Int64) and as_of_date (string) of
+        each location_id, in the same order, missing for unknown BSLs.
+    """
+    location_ids = np.asarray(location_ids, dtype=np.int64)
+    index_ids = index['location_id']
+    positions = np.searchsorted(index_ids, location_ids)
+    found = positions < len(index_ids)
+    found[found] = index_ids[positions[found]] == location_ids[found]
+    positions = positions[found]
+    block_geoids = np.zeros(len(location_ids), dtype=np.int64)
+    block_geoids[found] = index['block_geoid'][positions]
+    as_of_dates = np.full(len(location_ids), np.datetime64('NaT'),
+                          dtype="datetime64[D]")
+    as_of_dates[found] = index['as_of_date'][positions]
+    return pd.DataFrame({
+        'block_geoid': pd.Series(block_geoids, dtype="Int64").where(found),
+        'as_of_date': pd.Series(
+            np.datetime_as_string(as_of_dates, unit='D'),
+            dtype=str,
+        ).where(found),
+    })
+
+
+def read_challenged_location_ids(challenge_source):
+    """Determines the location_ids of the BSLs engaged in at least one
+    challenge from the (raw) resolved challenge files of every state in every
+    As of Date, reading only the columns needed to keep the latest record of
+    each challenge (see latest_challenges), like the consolidated challenge
+    data does, so that both yield the same location_ids.
+
+    Args:
+        challenge_source: Directory where the challenge data is stored.
+
+    Returns:
+        Sorted array with the unique (int64) location_ids.
+    """
+    with open(f"{challenge_source}/metadata.json") as f:
+        aods_md = json.load(f)
+    c_dfs = [pd.DataFrame({
+        column: pd.Series(dtype=RAW_CHALLENGE_DTYPES[column])
+        for column in ['challenge_id', 'location_id', 'adjudication_date']
+    })]
+    for as_of_date in sorted(aods_md['as_of_dates']):
+        aod_path = f"{challenge_source}/{as_of_date}"
+        with open(f"{aod_path}/metadata.json") as f:
+            aod_md = json.load(f)
+        for state_id in sorted(aod_md['states']):
+            c_dfs.append(read_table(
+                f"{aod_path}/{state_id}.zip",
+                dtype=RAW_CHALLENGE_DTYPES,
+                columns=['challenge_id', 'location_id', 'adjudication_date'],
+            ))
+    c_df = latest_challenges(pd.concat(c_dfs, ignore_index=True))
+    return np.unique(encode_location_ids(c_df['location_id']).to_numpy())
+
+
+def location_ids_digest(location_ids):
+    """Determines the digest (BLAKE2b) of a set of location_ids, which
+    identifies the set whatever the order and repetitions of its values."""
+    location_ids = np.unique(np.asarray(location_ids, dtype=np.int64))
+    return hashlib.blake2b(location_ids.astype("<i8").tobytes(),
+                           digest_size=16).hexdigest()
+
+
+def read_cbsl_digest(aod_save_path):
+    """Reads the digest of the challenged location_ids (see
+    location_ids_digest) the challenging BSL availability table of an As of
+    Date was extracted for, or None if it is unknown."""
+    try:
+        with open(f"{aod_save_path}/{CBSL_METADATA_FN}") as f:
+            return json.load(f)['location_ids_digest']
+    except (FileNotFoundError, KeyError):
+        return None
+
+
+def write_cbsl_digest(aod_save_path, cbsl_ids):
+    """Records the challenged location_ids the challenging BSL availability
+    table of an As of Date was extracted for (see read_cbsl_digest)."""
+    with open(f"{aod_save_path}/{CBSL_METADATA_FN}", "w") as f:
+        json.dump({
+            'n_location_ids': len(np.unique(cbsl_ids)),
+            'location_ids_digest': location_ids_digest(cbsl_ids),
+        }, f, indent=4)
+
+
+def iter_cbsl_records(state_path, cbsl_ids, memory_budget=None):
+    """Reads the availability records of challenging BSLs in an <as_of_date,
+    state> pair. The BSL table of the pair is read first, so that pairs
+    without challenging BSLs are skipped without reading their availability
+    records, and only the buckets of bucketed tables holding challenging BSLs
+    are read (see storage_utils.iter_table).
+
+    Args:
+        state_path: Path of the availability table of the pair.
+
+        cbsl_ids: Array of challenged location_ids.
+
+        memory_budget: Memory (bytes) available to hold availability records.
+        If given, the table is streamed in chunks of as many records as fit
+        in it. Otherwise, it is loaded whole.
+
+    Yields:
+        Dataframes with chunks of the availability records of challenging
+        BSLs (none if the pair has no challenging BSLs).
+    """
+    state_cbsl_ids = read_table(
+        bsl_table_path(state_path),
+        dtype=COMPACT_AVAILABILITY_DTYPES,
+        columns=['location_id'],
+        filters=[('location_id', 'in', cbsl_ids)],
+    )['location_id'].to_numpy()
+    if len(state_cbsl_ids) == 0:
+        return
+    yield from iter_table(
+        state_path,
+        dtype=COMPACT_AVAILABILITY_DTYPES,
+        filters=[('location_id', 'in', state_cbsl_ids)],
+        chunk_size=records_per_chunk(state_path, memory_budget),
+    )
+
+
+# Peak memory needed to load and augment an availability file (with the
+# compact data types), as a multiple of its (uncompressed) CSV size
+AUGMENT_MEMORY_FACTOR = 4
+
+
+def available_memory():
+    """Determines the memory (bytes) available to start new processes without
+    swapping, or None if it cannot be determined."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def records_per_chunk(file_path, memory_budget):
+    """Determines how many records of a table can be loaded and augmented at
+    a time within a memory budget.
+
+    Args:
+        file_path: Path of the table (see storage_utils.resolve_table).
+
+        memory_budget: Memory (bytes) available to hold a chunk of records, or
+        None to load the whole file at once.
+
+    Returns:
+        The number of records per chunk, or None for the whole file.
+    """
+    if memory_budget is None:
+        return None
+    record_memory = AUGMENT_MEMORY_FACTOR * estimate_record_size(file_path)
+    return max(1, int(memory_budget // record_memory))
+
+
+def estimate_augment_memory(file_paths, memory_budget=None):
+    """Estimates the peak memory (bytes) needed to consolidate and augment the
+    availability files of an <as_of_date, state> pair. Files are augmented one
+    at a time, so the estimate is driven by the largest (uncompressed) file,
+    unless files are read in chunks within a memory budget.
+
+    Args:
+        file_paths: Paths of the (zipped) availability files.
+
+        memory_budget: Memory (bytes) available to hold a chunk of records, or
+        None if files are loaded whole.
+
+    Returns:
+        The estimated peak memory in bytes.
+    """
+    largest = 0
+    for file_path in file_paths:
+        with zipfile.ZipFile(file_path) as zf:
+            size = sum(info.file_size for info in zf.infolist())
+        largest = max(largest, size)
+    if memory_budget is None:
+        return AUGMENT_MEMORY_FACTOR * largest
+    return min(AUGMENT_MEMORY_FACTOR * largest, memory_budget)
+
+
+def consolidate_availability_files(file_paths, save_path, memory_budget=None,
+                                   storage_format="csv", n_buckets=None,
+                                   cbsl_ids=None):
+    """Consolidates and augments the availability files of an <as_of_date,
+    state> pair into a single table of availability offerings, a table of the
+    BSLs they are offered at, and a table of their providers (see
+    AvailabilityTableWriter). The data is written to temporary files first,
+    which replace the table files once every file has been appended.
+
+    Args:
+        file_paths: Paths of the (zipped) availability files, in the order
+        they are consolidated.
+
+        save_path: Path of the consolidated table without file extension.
+
+        memory_budget: Memory (bytes) available to hold the records being
+        augmented. If given, files are streamed in chunks of as many records
+        as fit in it, so the peak memory does not depend on the file sizes.
+        Otherwise, files are loaded whole.
+
+        storage_format: Storage format of the consolidated table (see
+        storage_utils.STORAGE_FORMATS).
+
+        n_buckets: Number of buckets of the consolidated table (see
+        AvailabilityTableWriter), or None for a single (unsorted) table.
+
+        cbsl_ids: Array of challenged location_ids whose availability records
+        are also written to a challenging BSL table in the same pass (see
+        cbsl_part_path), or None for no such table.
+
+    Returns:
+        The number of records consolidated.
+    """
+    with AvailabilityTableWriter(save_path, storage_format, n_buckets,
+                                 cbsl_ids) as writer:
+        for file_path in file_paths:
+            chunks = iter_table(
+                file_path,
+                dtype=RAW_AVAILABILITY_DTYPES,
+                chunk_size=records_per_chunk(file_path, memory_budget),
+            )
+            for file_df in chunks:
+                # Augment data with service statuses (and encode identifiers)
+                file_df = augment_availability_data(file_df)
+                # Write (partial) offering, BSL, and provider data to files
+                writer.write(file_df)
+    return writer.records
+
+
+def run_in_process_pool(function, tasks, max_workers, memory_budget=None):
+    """Runs a function for every task in a pool of processes, yielding the
+    results as tasks complete. Tasks are started largest first, and only
+    while the memory estimated for the running tasks fits within the memory
+    budget; smaller tasks fill in the remaining budget. A task is always
+    started if no other task is running, even if it exceeds the budget.
+
+    Args:
+        function: Function to run. It must be importable (i.e., defined at
+        the top level of a module) by the worker processes.
+
+        tasks: List of (args, memory) tuples with the arguments of each call
+        and its estimated peak memory (bytes).
+
+        max_workers: Maximum number of processes running concurrently.
+
+        memory_budget: Maximum memory (bytes) estimated for the tasks running
+        concurrently, or None for no limit.
+
+    Yields:
+        (args, result) tuples of the completed tasks.
+    """
+    pending = sorted(tasks, key=lambda task: task[1], reverse=True)
+    running = {}
+    memory_in_use = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Start the largest pending tasks that fit within the budget
+            i = 0
+            while i < len(pending) and len(running) < max_workers:
+                args, memory = pending[i]
+                if running and memory_budget is not None \
+                        and memory_in_use + memory > memory_budget:
+                    i = i + 1
+                    continue
+                pending.pop(i)
+                future = executor.submit(function, *args)
+                running[future] = (args, memory)
+                memory_in_use = memory_in_use + memory
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                args, memory = running.pop(future)
+                memory_in_use = memory_in_use - memory
+                yield args, future.result()
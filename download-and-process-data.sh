@@ -13,6 +13,7 @@ time python3 code/download-bdc-challenge.py
 ###############################################################################
 # 2.1 Process BDC availability data. Depends on:
 # - code/download-bdc-availability.py
+# - code/download-bdc-challenge.py (challenging BSL availability, optional)
 time python3 code/process-bdc-availability.py
 
 # 2.2 Determine BSL geolocations from availability. Depends on: